@@ -0,0 +1,103 @@
+"""管理员公告（广播/多播）
+
+发送一条公告只写入 announcements 中的一行（见 migrations.py 第12步），与接收者数量无关：
+- 发给所有用户（audience=all）时不为每个用户写入任何数据，推送也只有一次 emit（所有连接都在 ROOM 房间中）
+- 发给指定用户（audience=list）时在同一事务中用 executemany 批量写入 announcement_recipients，
+  推送时以接收者各自的房间列表 emit 一次
+- 接收者的已读状态是一个按用户的已读水位（announcement_reads），用户第一次标记已读时才创建，
+  未读数和公告列表在用户读取时按水位计算
+
+不在线的用户下次打开页面时通过 /api/announcements 读取。
+"""
+import os
+from datetime import datetime
+
+import db
+
+AUDIENCE_ALL = 'all'
+AUDIENCE_LIST = 'list'
+
+# 所有 WebSocket 连接都加入的房间，广播公告时只向这个房间发送一次
+ROOM = 'announcements:all'
+
+MAX_CONTENT_LENGTH = 2000
+MAX_RECIPIENTS = int(os.environ.get('CHAT_ANNOUNCEMENT_MAX_RECIPIENTS', '100000'))
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# 公告对用户可见：发给所有用户，或用户在接收者中（主键 (user, announcement_id) 上的一次查找）
+_VISIBLE = '''(a.audience = 'all' OR EXISTS (
+    SELECT 1 FROM announcement_recipients r WHERE r.user = ? AND r.announcement_id = a.id))'''
+
+
+def to_client(announcement_id, sender, content, created_at):
+    """返回给客户端（接口和 WebSocket 事件）的公告格式"""
+    return {'id': announcement_id, 'sender': sender, 'content': content, 'createdAt': created_at}
+
+
+def create(sender, content, recipients=None):
+    """保存一条公告并返回其客户端格式；recipients 为 None 时发给所有用户，否则只发给其中的用户（已去重）"""
+    created_at = datetime.now().isoformat()
+    audience = AUDIENCE_ALL if recipients is None else AUDIENCE_LIST
+    with db.transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO announcements (sender, content, audience, created_at) VALUES (?, ?, ?, ?)
+        ''', (sender, content, audience, created_at))
+        announcement_id = cursor.lastrowid
+        if recipients is not None:
+            cursor.executemany('INSERT INTO announcement_recipients (user, announcement_id) VALUES (?, ?)',
+                               ((user, announcement_id) for user in recipients))
+    return to_client(announcement_id, sender, content, created_at)
+
+
+def _last_read_id(conn, user):
+    row = conn.execute('SELECT last_read_id FROM announcement_reads WHERE user = ?', (user,)).fetchone()
+    return row[0] if row else 0
+
+
+def _unread_count(conn, user, last_read_id):
+    return conn.execute(f'''
+        SELECT COUNT(*) FROM announcements a WHERE a.id > ? AND {_VISIBLE}
+    ''', (last_read_id, user)).fetchone()[0]
+
+
+def list_for(user, before=None, limit=DEFAULT_PAGE_SIZE):
+    """用户可见的公告（从新到旧），返回 (公告列表, 下一页的游标, 未读数)
+
+    before 为上一页返回的游标（只返回ID小于它的公告）；每条公告的 read 表示是否已读。
+    """
+    conditions = [_VISIBLE]
+    params = [user]
+    if before is not None:
+        conditions.append('a.id < ?')
+        params.append(before)
+    with db.connection() as conn:
+        last_read_id = _last_read_id(conn, user)
+        rows = conn.execute(f'''
+            SELECT a.id, a.sender, a.content, a.created_at
+            FROM announcements a
+            WHERE {' AND '.join(conditions)}
+            ORDER BY a.id DESC
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+        unread = _unread_count(conn, user, last_read_id)
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    items = []
+    for row in rows[:limit]:
+        item = to_client(*row)
+        item['read'] = row[0] <= last_read_id
+        items.append(item)
+    return items, next_cursor, unread
+
+
+def mark_read(user, announcement_id):
+    """把用户的已读水位推进到 announcement_id（只增不减，不超过最新的公告），返回剩余的未读数"""
+    with db.transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO announcement_reads (user, last_read_id, updated_at)
+            VALUES (?, MIN(?, (SELECT IFNULL(MAX(id), 0) FROM announcements)), ?)
+            ON CONFLICT (user) DO UPDATE SET
+                last_read_id = MAX(last_read_id, excluded.last_read_id),
+                updated_at = excluded.updated_at
+        ''', (user, announcement_id, datetime.now().isoformat()))
+        return _unread_count(cursor.connection, user, _last_read_id(cursor.connection, user))
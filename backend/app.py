@@ -1,15 +1,32 @@
-import sqlite3
-
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, send_from_directory, make_response, g, session
 from flask_wtf.csrf import CSRFProtect
 import json, pathlib, os
+import mimetypes
+import urllib.parse
+import hashlib
+import hmac
 from datetime import datetime
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import threading
 import time
-import uuid
-import requests
-import bcrypt
+
+import db
+import metrics
+import search
+import message_types
+import music
+import announcements
+import feedback as feedback_board  # 与反馈页面的视图函数 feedback() 区分
+import groups
+import passwords
+import tokens
+from users import OpsList, UserDirectory
+import write_queue
+import uploads
+import thumbnails
+from blobs import BlobStore, BlobTooLarge
+from concurrency import ASYNC_MODE, COOPERATIVE, wait_future
+from migrations import run_migrations
 
 # 添加日志模块
 import logging
@@ -33,16 +50,28 @@ app = Flask(__name__,
 # 使用环境变量管理SECRET_KEY，提供默认值
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
 
+# 请求体大小上限（普通表单上传的整个文件，或分块上传的单个分块）
+app.config['MAX_CONTENT_LENGTH'] = uploads.MAX_FILE_SIZE + 1024 * 1024
+
 # 初始化CSRF保护
 csrf = CSRFProtect(app)
 
 # 初始化SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*", logger=False, engineio_logger=False)
-
-# 移除了请求统计相关的代码
+# 异步模式由环境变量 CHAT_ASYNC_MODE 决定（生产环境通过 server.py 启动时为 eventlet/gevent）
+# 多进程部署时通过 CHAT_MESSAGE_QUEUE（Redis地址，如 redis://127.0.0.1:6379/0）在进程之间转发emit，
+# 否则房间只存在于当前进程内；本地测试可用 pubsub_broker.py 代替Redis
+MESSAGE_QUEUE = os.environ.get('CHAT_MESSAGE_QUEUE') or None
+MESSAGE_QUEUE_CHANNEL = os.environ.get('CHAT_MESSAGE_QUEUE_CHANNEL', 'chat-site')
+socketio = SocketIO(app, cors_allowed_origins="*", logger=False, engineio_logger=False,
+                    async_mode=ASYNC_MODE, message_queue=MESSAGE_QUEUE,
+                    channel=MESSAGE_QUEUE_CHANNEL)
+
+# 请求耗时、SQLite语句耗时和WebSocket事件统计（见 metrics.py），通过 /metrics 输出
+metrics.init_app(app, socketio)
 
 # 自定义日志处理
 from werkzeug.serving import WSGIRequestHandler
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 
 # 保存原始日志方法
 original_log = WSGIRequestHandler.log
@@ -56,98 +85,118 @@ def custom_log(self, type, message, *args):
 WSGIRequestHandler.log = custom_log
 
 ROOT = pathlib.Path(__file__).resolve().parent.parent
-USER_FILE = ROOT / 'data' / 'users.json'
-FRIENDS_DIR = ROOT / 'data' / 'users'
-DB_FILE = ROOT / 'data' / 'chat.db'
-UPLOAD_FOLDER = ROOT / 'uploads'
+# 数据目录和上传目录可通过环境变量指定（多实例测试、压测时使用独立的数据）
+DATA_DIR = pathlib.Path(os.environ.get('CHAT_DATA_DIR') or ROOT / 'data')
+USER_FILE = DATA_DIR / 'users.json'
+FRIENDS_DIR = DATA_DIR / 'users'
+DB_FILE = DATA_DIR / 'chat.db'
+UPLOAD_FOLDER = pathlib.Path(os.environ.get('CHAT_UPLOAD_DIR') or ROOT / 'uploads')
 os.makedirs(FRIENDS_DIR, exist_ok=True)
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# 移除了 @app.after_request 装饰器函数，不再记录请求统计
+# 附件的字节传输可以交给前端代理：x-accel（nginx 的 X-Accel-Redirect，需要配置对应的 internal location）
+# 或 x-sendfile（Apache mod_xsendfile、lighttpd）；不设置时由应用自己发送
+SENDFILE_MODE = os.environ.get('CHAT_SENDFILE', '').lower()
+SENDFILE_PREFIX = os.environ.get('CHAT_SENDFILE_PREFIX', '/protected-uploads').rstrip('/')
+if SENDFILE_MODE not in ('', 'x-accel', 'x-sendfile'):
+    raise RuntimeError(f"不支持的 CHAT_SENDFILE: {SENDFILE_MODE}（可选 x-accel 或 x-sendfile）")
+app.config['USE_X_SENDFILE'] = SENDFILE_MODE == 'x-sendfile'
+
+# 配置共享的数据库连接池（WAL模式），所有数据库访问都通过 db 模块进行
+db.configure(DB_FILE, cooperative=COOPERATIVE)
 
 def init_db():
-    """初始化数据库"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # 创建聊天记录表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            sender TEXT NOT NULL,
-            recipient TEXT NOT NULL,
-            content TEXT NOT NULL,
-            timestamp TEXT NOT NULL
-        )
-    ''')
-    
-    # 创建好友关系表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS friendships (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user1 TEXT NOT NULL,
-            user2 TEXT NOT NULL,
-            timestamp TEXT NOT NULL
-        )
-    ''')
-    
-    # 创建已读消息标记表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS read_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT NOT NULL,
-            message_id INTEGER NOT NULL,
-            timestamp TEXT NOT NULL
-        )
-    ''')
-    
-    # 创建图片表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS images (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT NOT NULL,
-            original_name TEXT NOT NULL,
-            uploader TEXT NOT NULL,
-            upload_time TEXT NOT NULL
-        )
-    ''')
-    
-    # 创建文件表
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT NOT NULL,
-            original_name TEXT NOT NULL,
-            file_size INTEGER NOT NULL,
-            file_type TEXT NOT NULL,
-            uploader TEXT NOT NULL,
-            upload_time TEXT NOT NULL
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    """初始化数据库：按顺序执行尚未应用的结构迁移（见 migrations.py）"""
+    # 多个进程同时启动时，迁移连接在SQLite中等待其他进程的迁移完成
+    with db.blocking_connection() as conn:
+        version = run_migrations(conn)
+    logger.info(f"数据库结构版本: {version}")
+    # 旧版本保存在 feedback.json 中的反馈导入数据库（只导入一次）
+    feedback_board.import_json(FEEDBACK_FILE)
+    # 旧版本带类型前缀的消息在后台分批改写，不阻塞启动
+    message_types.start_backfill()
+
+# 用户目录缓存：users.json 只在文件变化或写入时重新加载
+user_directory = UserDirectory(USER_FILE)
 
 def load_users():
-    with open(USER_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    """获取用户数据副本（需要修改并保存时使用）"""
+    return user_directory.snapshot()
 
 def save_users(users):
-    with open(USER_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=4)
+    """原子写入用户数据并刷新缓存"""
+    user_directory.save(users)
+
+def user_exists(username):
+    """检查用户是否存在（查内存缓存，无磁盘I/O）"""
+    return user_directory.exists(username)
 
 def hash_password(password):
-    """使用bcrypt哈希密码"""
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
-    return hashed.decode('utf-8')
+    """使用bcrypt哈希密码（在进程池中计算，见 passwords.py）"""
+    return passwords.hash_password(password)
 
 def verify_password(password, hashed_password):
-    """验证密码是否匹配"""
+    """验证密码是否匹配（在进程池中计算，见 passwords.py）"""
+    return passwords.verify_password(password, hashed_password)
+
+# 会话令牌（见 tokens.py）：登录时签发，其余接口和WebSocket连接都要求有效的令牌
+token_signer = tokens.TokenSigner(tokens.load_secret(DATA_DIR))
+
+# 不需要令牌的接口
+PUBLIC_ENDPOINTS = {'api_login'}
+
+def issue_token(username):
+    """为用户签发会话令牌，返回 (令牌, 过期时间)"""
+    return token_signer.issue(username, user_directory.get_password(username))
+
+def authenticate_token(token):
+    """校验令牌，返回 (用户名, 过期时间)；无效时抛出 tokens.InvalidToken"""
+    if not token:
+        raise tokens.InvalidToken('缺少令牌')
+    return token_signer.verify(token, user_directory.get_password)
+
+@app.before_request
+def check_session_token():
+    """校验 Authorization: Bearer <令牌>，令牌中的用户保存在 g.auth_user 中，是各接口唯一使用的当前用户
+
+    请求仍可声明用户（X-User 或 ?u=），声明的用户与令牌中的用户不一致时拒绝请求。
+    """
+    if not request.path.startswith('/api/') and request.path != '/metrics':
+        return None
+    if request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
     try:
-        return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
-    except Exception:
-        return False
+        username, expires = authenticate_token(token.strip() if scheme.lower() == 'bearer' else '')
+    except tokens.TokenExpired:
+        return jsonify({'ok': False, 'msg': '登录已过期，请重新登录', 'expired': True}), 401
+    except tokens.InvalidToken as e:
+        logger.warning(f"请求 {request.path} 的令牌无效: {e}")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    claimed = request.headers.get('X-User') or request.args.get('u')
+    if claimed and claimed != username:
+        logger.warning(f"用户 {username} 的令牌被用于以 {claimed} 的身份请求 {request.path}")
+        return jsonify({'ok': False, 'msg': '令牌与当前用户不一致'}), 403
+    g.auth_user = username
+    g.auth_expires = expires
+    return None
+
+@app.after_request
+def renew_session_token(response):
+    """令牌剩余有效期不足一半时，在响应头 X-Auth-Token 中返回续期的新令牌"""
+    expires = g.pop('auth_expires', None)
+    if expires is not None and response.status_code < 400 and token_signer.needs_renewal(expires):
+        token, _ = issue_token(g.auth_user)
+        response.headers['X-Auth-Token'] = token
+    return response
+
+@app.errorhandler(passwords.PasswordBusy)
+def password_busy(e):
+    """bcrypt 任务排队已满（登录请求过多）"""
+    logger.warning(f"密码计算任务已满，拒绝请求: {request.path}")
+    response = jsonify({'ok': False, 'msg': '服务器繁忙，请稍后重试'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 def migrate_passwords_to_hash():
     """迁移现有明文密码到哈希密码"""
@@ -155,8 +204,8 @@ def migrate_passwords_to_hash():
     migrated = False
     
     for username, password in users.items():
-        # 检查密码是否已经是哈希格式（bcrypt哈希以$2b$开头）
-        if not password.startswith('$2b$'):
+        # 检查密码是否已经是哈希格式
+        if not passwords.is_hashed(password):
             users[username] = hash_password(password)
             migrated = True
             logger.info(f"已迁移用户 {username} 的密码到哈希格式")
@@ -167,82 +216,113 @@ def migrate_passwords_to_hash():
     
     return migrated
 
-def load_chat_history(user1, user2, limit=None, offset=0):
-    """加载两个用户之间的聊天记录，支持分页"""
+def load_chat_history(user1, user2, limit=None, offset=0, since_id=None):
+    """加载两个用户之间的聊天记录，支持分页和增量同步（since_id之后的新消息）"""
     # 首先尝试从数据库加载
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
         # 构建基础查询
         query = '''
-            SELECT id, sender, content, timestamp 
+            SELECT id, sender, type, content, attachment_id, timestamp 
             FROM messages 
-            WHERE (sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?)
-            ORDER BY timestamp ASC
+            WHERE ((sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?))
         '''
+        params = (user1, user2, user2, user1)
+        
+        # 增量模式：只返回比客户端已有的最后一条消息更新的记录
+        if since_id is not None:
+            query += ' AND id > ?'
+            params = params + (since_id,)
+        
+        # 消息ID自增，按ID排序即为发送顺序
+        query += ' ORDER BY id ASC'
         
         # 添加分页参数
-        params = (user1, user2, user2, user1)
         if limit is not None:
             query += ' LIMIT ? OFFSET ?'
             params = params + (limit, offset)
         
-        cursor.execute(query, params)
+        with db.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
         
         messages = []
-        for row in cursor.fetchall():
-            content = row[2]
-            # 处理不同类型的消息前缀
-            if content.startswith("Chat_"):
-                content = content[5:]  # 去掉"Chat_"前缀
-            # Pic_前缀保留，供前端识别处理
-                
+        for message_id, sender, message_type, content, attachment_id, timestamp in rows:
             messages.append({
-                "id": row[0],
-                "sender": row[1],
-                "content": content,
-                "timestamp": row[3]
+                "id": message_id,
+                "sender": sender,
+                # 返回给客户端的内容保持原来的格式（Pic_<ID>、File_<ID> 等）
+                "content": message_types.to_client_content(message_type, content, attachment_id),
+                "timestamp": timestamp
             })
         
-        conn.close()
         return messages
     except Exception as e:
         logger.error(f"加载聊天历史时出错: {e}")
         return []
 
+def get_conversation_version(user1, user2):
+    """获取会话的版本号（最新消息ID），会话没有消息时返回0
+
+    消息只会追加，清空记录后新消息ID仍会继续增长，因此最新消息ID可以唯一标识会话状态。
+    """
+    try:
+        with db.connection() as conn:
+            version = conn.execute('''
+                SELECT MAX(id)
+                FROM messages
+                WHERE (sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?)
+            ''', (user1, user2, user2, user1)).fetchone()[0]
+        return version or 0
+    except Exception as e:
+        logger.error(f"获取会话版本时出错: {e}")
+        return None
+
+# 消息写入队列（组提交），通过环境变量 CHAT_WRITE_QUEUE=1 开启
+message_write_queue = write_queue.WriteQueue() if write_queue.ENABLED else None
+
+def insert_chat_message(cursor, sender, recipient, message_type, content, attachment_id=None):
+    """在给定事务中写入一条消息并递增接收方未读计数，返回 (消息ID, 接收方未读计数)
+
+    message_type 见 message_types.py；图片/文件消息的 content 为空，ID 保存在 attachment_id。
+    """
+    cursor.execute('''
+        INSERT INTO messages (sender, recipient, type, content, attachment_id, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (sender, recipient, message_type, content, attachment_id, datetime.now().isoformat()))
+    message_id = cursor.lastrowid
+    
+    # 图片/文件消息在附件表中登记引用，用于附件的权限检查
+    if attachment_id is not None:
+        cursor.execute('''
+            INSERT OR IGNORE INTO message_attachments (message_id, kind, attachment_id)
+            VALUES (?, ?, ?)
+        ''', (message_id, message_type, attachment_id))
+    
+    # 在同一事务中递增接收方的未读计数
+    recipient_unread = None
+    if sender != recipient:
+        increment_unread_count(cursor, recipient, sender)
+        recipient_unread = get_unread_counts(cursor.connection, recipient)
+    return message_id, recipient_unread
+
 def save_chat_message(user1, user2, sender, content):
     """保存聊天消息"""
-    # 保存到数据库，添加消息类型前缀
+    # 客户端发来的内容带类型前缀（Pic_<ID>、File_<ID>、Music_<JSON>），解析为消息类型后保存
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        message_type, body, attachment_id = message_types.parse_client_content(content)
         
-        # 检查是否是图片消息 (Pic_前缀)
-        if content.startswith("Pic_"):
-            prefixed_content = content  # 已经带有前缀
+        if message_write_queue is not None:
+            # 交给写线程批量提交，等所在批次提交后再继续发送事件；超时按保存失败处理
+            future = message_write_queue.submit(
+                lambda cursor: insert_chat_message(cursor, sender, user2, message_type, body, attachment_id))
+            message_id, recipient_unread = wait_future(future, write_queue.WAIT_TIMEOUT)
         else:
-            prefixed_content = "Chat_" + content  # 文字消息添加Chat_前缀
-        
-        cursor.execute('''
-            INSERT INTO messages (sender, recipient, content, timestamp)
-            VALUES (?, ?, ?, ?)
-        ''', (sender, user2, prefixed_content, datetime.now().isoformat()))
+            with db.transaction() as cursor:
+                message_id, recipient_unread = insert_chat_message(cursor, sender, user2, message_type, body,
+                                                                   attachment_id)
         
-        message_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        # 通过WebSocket通知相关用户有新消息
+        # 通过WebSocket通知相关用户有新消息（内容格式与聊天记录接口一致）
         room = "_".join(sorted([user1, user2]))
-        # 去掉前缀发送实际内容
-        display_content = content
-        if content.startswith("Pic_"):
-            # 图片消息保留Pic_前缀以便前端识别
-            pass
-        elif content.startswith("Chat_"):
-            # 文字消息去掉Chat_前缀
-            display_content = content[5:]
+        display_content = message_types.to_client_content(message_type, body, attachment_id)
         
         socketio.emit('new_message', {
             'sender': sender,
@@ -251,11 +331,10 @@ def save_chat_message(user1, user2, sender, content):
             'timestamp': datetime.now().isoformat()
         }, room=room)
         
-        # 同时通知接收方首页更新未读消息数
-        socketio.emit('unread_update', {'recipient': user2}, room=user2)
-        
-        # 通知发送方首页更新未读消息数（对于其他会话）
-        socketio.emit('unread_update', {'recipient': sender}, room=sender)
+        # 同时把接收方最新的未读数推送到其首页，无需再请求 /api/unread-messages
+        # （发送方的未读数不会因发送消息而变化）
+        if recipient_unread is not None:
+            emit_unread_update(user2, recipient_unread)
         
         # 记录消息发送日志
         logger.info(f"用户 {sender} 向 {user2} 发送消息: {display_content[:50]}{'...' if len(display_content) > 50 else ''}")
@@ -265,26 +344,102 @@ def save_chat_message(user1, user2, sender, content):
         logger.error(f"保存到数据库时出错: {e}")
         return None
 
+# read_watermarks.peer 取该值时表示"全部会话已读"的全局水位
+ALL_CONVERSATIONS = ''
+
+def get_read_watermark(conn, user, peer):
+    """获取用户在与peer的会话中的已读水位（取会话水位和全局水位中较大的一个）"""
+    row = conn.execute('''
+        SELECT MAX(last_read_message_id)
+        FROM read_watermarks
+        WHERE user = ? AND peer IN (?, ?)
+    ''', (user, peer, ALL_CONVERSATIONS)).fetchone()
+    return row[0] or 0
+
+def set_read_watermark(cursor, user, peer, message_id):
+    """推进已读水位，水位只增不减"""
+    cursor.execute('''
+        INSERT INTO read_watermarks (user, peer, last_read_message_id, updated_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user, peer) DO UPDATE SET
+            last_read_message_id = MAX(last_read_message_id, excluded.last_read_message_id),
+            updated_at = excluded.updated_at
+    ''', (user, peer, message_id, datetime.now().isoformat()))
+
+def mark_conversation_read(cursor, user, peer):
+    """把用户与peer会话的已读水位推进到最新消息并清零未读计数，返回新标记为已读的消息数"""
+    row = cursor.execute(
+        'SELECT count FROM unread_counts WHERE user = ? AND peer = ?', (user, peer)
+    ).fetchone()
+    count = row[0] if row else 0
+    # (recipient, sender, id) 覆盖索引上的一次查找
+    latest = cursor.execute('''
+        SELECT MAX(id)
+        FROM messages
+        WHERE recipient = ? AND sender = ?
+    ''', (user, peer)).fetchone()[0]
+    if latest:
+        set_read_watermark(cursor, user, peer, latest)
+    if count:
+        reset_unread_count(cursor, user, peer)
+    return count
+
+def mark_all_conversations_read(cursor, user):
+    """把用户的全局已读水位推进到当前最大消息ID，并清零所有未读计数"""
+    latest = cursor.execute('SELECT MAX(id) FROM messages').fetchone()[0] or 0
+    set_read_watermark(cursor, user, ALL_CONVERSATIONS, latest)
+    cursor.execute('UPDATE unread_counts SET count = 0 WHERE user = ? AND count > 0', (user,))
+    return latest
+
+def increment_unread_count(cursor, user, peer, amount=1):
+    """user 收到来自 peer 的新消息时递增未读计数（需在写入消息的同一事务中调用）"""
+    cursor.execute('''
+        INSERT INTO unread_counts (user, peer, count)
+        VALUES (?, ?, ?)
+        ON CONFLICT (user, peer) DO UPDATE SET count = count + excluded.count
+    ''', (user, peer, amount))
+
+def reset_unread_count(cursor, user, peer):
+    """清零 user 来自 peer 的未读计数"""
+    cursor.execute(
+        'UPDATE unread_counts SET count = 0 WHERE user = ? AND peer = ?', (user, peer)
+    )
+
+def get_unread_counts(conn, user):
+    """读取用户的全部未读计数 {peer: count}"""
+    return dict(conn.execute(
+        'SELECT peer, count FROM unread_counts WHERE user = ?', (user,)
+    ).fetchall())
+
+def count_unread_messages(user, peers):
+    """统计用户来自各个peer的未读消息数 {peer: count}（读取物化计数）"""
+    with db.connection() as conn:
+        counts = get_unread_counts(conn, user)
+    return {peer: counts.get(peer, 0) for peer in peers if peer != user}
+
+def emit_unread_update(user, unread_counts):
+    """向用户房间推送未读数更新，事件中直接携带最新的未读计数"""
+    try:
+        socketio.emit('unread_update', {'recipient': user, 'unread_counts': unread_counts}, room=user)
+    except Exception as e:
+        logger.warning(f"发送未读消息更新通知失败 ({user}): {e}")
+
 def add_friendship_db(user1, user2):
     """在数据库中添加好友关系"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # 检查是否已经是好友
-        cursor.execute('''
-            SELECT COUNT(*) FROM friendships
-            WHERE (user1 = ? AND user2 = ?) OR (user1 = ? AND user2 = ?)
-        ''', (user1, user2, user2, user1))
-        
-        if cursor.fetchone()[0] == 0:
+        with db.transaction() as cursor:
+            # 检查是否已经是好友
             cursor.execute('''
-                INSERT INTO friendships (user1, user2, timestamp)
-                VALUES (?, ?, ?)
-            ''', (user1, user2, datetime.now().isoformat()))
-            conn.commit()
+                SELECT COUNT(*) FROM friendships
+                WHERE (user1 = ? AND user2 = ?) OR (user1 = ? AND user2 = ?)
+            ''', (user1, user2, user2, user1))
+            
+            if cursor.fetchone()[0] == 0:
+                cursor.execute('''
+                    INSERT INTO friendships (user1, user2, timestamp)
+                    VALUES (?, ?, ?)
+                ''', (user1, user2, datetime.now().isoformat()))
         
-        conn.close()
         return True
     except Exception as e:
         logger.error(f"添加好友关系到数据库时出错: {e}")
@@ -293,16 +448,12 @@ def add_friendship_db(user1, user2):
 def remove_friendship_db(user1, user2):
     """从数据库中删除好友关系"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            DELETE FROM friendships
-            WHERE (user1 = ? AND user2 = ?) OR (user1 = ? AND user2 = ?)
-        ''', (user1, user2, user2, user1))
+        with db.transaction() as cursor:
+            cursor.execute('''
+                DELETE FROM friendships
+                WHERE (user1 = ? AND user2 = ?) OR (user1 = ? AND user2 = ?)
+            ''', (user1, user2, user2, user1))
         
-        conn.commit()
-        conn.close()
         return True
     except Exception as e:
         logger.error(f"删除好友关系时出错: {e}")
@@ -311,17 +462,14 @@ def remove_friendship_db(user1, user2):
 def get_friends_db(user):
     """从数据库中获取用户的好友列表"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        with db.connection() as conn:
+            rows = conn.execute('''
+                SELECT CASE WHEN user1 = ? THEN user2 ELSE user1 END as friend
+                FROM friendships
+                WHERE user1 = ? OR user2 = ?
+            ''', (user, user, user)).fetchall()
         
-        cursor.execute('''
-            SELECT CASE WHEN user1 = ? THEN user2 ELSE user1 END as friend
-            FROM friendships
-            WHERE user1 = ? OR user2 = ?
-        ''', (user, user, user))
-        
-        friends = [row[0] for row in cursor.fetchall()]
-        conn.close()
+        friends = [row[0] for row in rows]
         return friends
     except Exception as e:
         logger.error(f"获取好友列表时出错: {e}")
@@ -349,34 +497,38 @@ def feedback():
 
 @app.route('/api/login', methods=['POST'])
 def api_login():
-    users = load_users()
     u = request.json.get('username', '').strip()
     p = request.json.get('password', '')
-    if u not in users:
+    stored_password = user_directory.get_password(u)
+    if stored_password is None:
         logger.warning(f"用户 {u} 登录失败：用户不存在")
         return jsonify({'ok': False}), 401
     
-    stored_password = users[u]
     # 检查密码是否已经是哈希格式
-    if stored_password.startswith('$2b$'):
+    if passwords.is_hashed(stored_password):
         if verify_password(p, stored_password):
             logger.info(f"用户 {u} 登录成功")
-            return jsonify({'ok': True, 'username': u})
+            return login_response(u)
         else:
             logger.warning(f"用户 {u} 登录失败：密码错误")
             return jsonify({'ok': False}), 401
     else:
         # 明文密码，用于向后兼容
-        if users.get(u) == p:
+        if hmac.compare_digest(stored_password.encode('utf-8'), p.encode('utf-8')):
             logger.info(f"用户 {u} 登录成功（明文密码）")
-            return jsonify({'ok': True, 'username': u})
+            return login_response(u)
         logger.warning(f"用户 {u} 登录失败")
         return jsonify({'ok': False}), 401
 
+def login_response(username):
+    """登录成功的响应，包含会话令牌"""
+    token, expires = issue_token(username)
+    return jsonify({'ok': True, 'username': username, 'token': token, 'expires': expires})
+
 @app.route('/api/friends')
 def api_friends():
-    u = request.args.get('u')
-    if not u: 
+    u = g.auth_user
+    if not user_exists(u):
         logger.warning("获取好友列表失败：用户未登录")
         return jsonify([]), 401
     
@@ -404,43 +556,46 @@ def api_friends():
 @app.route('/api/change-username', methods=['POST'])
 def api_change_username():
     users = load_users()
-    oldUsername = request.headers.get('X-User')
+    oldUsername = g.auth_user
     newUsername = request.json.get('newUsername', '').strip()
     if oldUsername in users and newUsername not in users:
         users[newUsername] = users.pop(oldUsername)
         save_users(users)
         logger.info(f"用户 {oldUsername} 更改用户名为 {newUsername}")
-        return jsonify({'ok': True})
+        # 旧令牌对应原用户名，已失效
+        token, expires = issue_token(newUsername)
+        return jsonify({'ok': True, 'token': token, 'expires': expires})
     logger.warning(f"用户 {oldUsername} 更改用户名失败")
     return jsonify({'ok': False}), 401
 
 @app.route('/api/change-password', methods=['POST'])
 def api_change_password():
     users = load_users()
-    username = request.headers.get('X-User')
+    username = g.auth_user
     newPassword = request.json.get('newPassword', '').strip()
     if username in users:
         # 使用哈希存储新密码
         users[username] = hash_password(newPassword)
         save_users(users)
         logger.info(f"用户 {username} 更改密码成功")
-        return jsonify({'ok': True})
+        # 令牌的签名包含密码哈希，修改密码后其他会话的令牌失效，当前会话使用新令牌
+        token, expires = issue_token(username)
+        return jsonify({'ok': True, 'token': token, 'expires': expires})
     logger.warning(f"用户 {username} 更改密码失败")
     return jsonify({'ok': False}), 401
 
 @app.route('/api/add-friend', methods=['POST'])
 def api_add_friend():
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     friend_name = request.json.get('friendName', '').strip()
 
     # 验证当前用户是否存在
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法添加好友")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
 
     # 验证好友是否存在
-    if friend_name not in users:
+    if not user_exists(friend_name):
         logger.warning(f"用户 {current_user} 尝试添加不存在的用户 {friend_name} 为好友")
         return jsonify({'ok': False, 'msg': '用户不存在'}), 404
 
@@ -466,17 +621,16 @@ def api_add_friend():
 @app.route('/api/remove-friend', methods=['POST'])
 def api_remove_friend():
     """删除好友"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     friend_name = request.json.get('friendName', '').strip()
 
     # 验证当前用户是否存在
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法删除好友")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
 
     # 验证好友是否存在
-    if friend_name not in users:
+    if not user_exists(friend_name):
         logger.warning(f"用户 {current_user} 尝试删除不存在的用户 {friend_name}")
         return jsonify({'ok': False, 'msg': '用户不存在'}), 404
 
@@ -491,17 +645,16 @@ def api_remove_friend():
 @app.route('/api/send-message', methods=['POST'])
 def api_send_message():
     """发送消息API"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     recipient = request.json.get('recipient', '').strip()
     content = request.json.get('content', '').strip()
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法发送消息")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
-    if recipient not in users:
+    if not user_exists(recipient):
         logger.warning(f"用户 {current_user} 尝试向不存在的用户 {recipient} 发送消息")
         return jsonify({'ok': False, 'msg': '接收用户不存在'}), 404
     
@@ -513,9 +666,7 @@ def api_send_message():
     message_id = save_chat_message(current_user, recipient, current_user, content)
     
     if message_id:
-        # 立即触发一次额外的未读消息检查，确保快速更新
-        socketio.emit('unread_update', {'recipient': recipient}, room=recipient)
-        socketio.emit('unread_update', {'recipient': current_user}, room=current_user)
+        # 未读数更新已经在 save_chat_message 中随事件推送
         return jsonify({'ok': True, 'msg': '消息发送成功', 'message_id': message_id})
     else:
         logger.error(f"用户 {current_user} 发送消息失败")
@@ -524,90 +675,173 @@ def api_send_message():
 @app.route('/api/chat-history')
 def api_chat_history():
     """获取聊天历史API，支持分页"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     friend = request.args.get('friend', '').strip()
     
     # 获取分页参数
     limit = request.args.get('limit', type=int)
     offset = request.args.get('offset', 0, type=int)
+    # 增量同步参数：客户端已有的最后一条消息ID
+    since_id = request.args.get('since_id', type=int)
+    # include=music：为音乐分享消息附加歌曲信息（music 字段）
+    include_music = 'music' in request.args.get('include', '').split(',')
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法获取聊天历史")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
-    if friend not in users:
+    if not user_exists(friend):
         logger.warning(f"用户 {current_user} 尝试获取与不存在的用户 {friend} 的聊天历史")
         return jsonify({'ok': False, 'msg': '用户不存在'}), 404
     
+    # 根据会话版本生成ETag，会话没有变化时直接返回304
+    version = get_conversation_version(current_user, friend)
+    etag = None
+    if version is not None:
+        room = "_".join(sorted([current_user, friend]))
+        etag = hashlib.md5(f"{room}|{version}|{since_id}|{limit}|{offset}|{include_music}".encode('utf-8')).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            response.vary.add('Authorization')
+            return response
+    
     # 获取聊天历史
-    history = load_chat_history(current_user, friend, limit=limit, offset=offset)
-    logger.info(f"用户 {current_user} 获取与 {friend} 的聊天历史，共 {len(history)} 条消息")
-    return jsonify({'ok': True, 'history': history})
+    history = load_chat_history(current_user, friend, limit=limit, offset=offset, since_id=since_id)
+    if include_music:
+        attach_music_details(history)
+    if since_id is not None:
+        logger.debug(f"用户 {current_user} 增量获取与 {friend} 的聊天历史，共 {len(history)} 条新消息")
+    else:
+        logger.info(f"用户 {current_user} 获取与 {friend} 的聊天历史，共 {len(history)} 条消息")
+    response = jsonify({'ok': True, 'history': history})
+    if etag:
+        response.set_etag(etag)
+        # 要求浏览器每次都带上If-None-Match重新验证
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Authorization')
+    return response
+
+@app.route('/api/search-messages')
+def api_search_messages():
+    """在自己参与的会话（一对一会话和所在的群聊）中全文搜索消息，支持分页和按好友或群聊筛选"""
+    current_user = g.auth_user
+    query = request.args.get('q', '').strip()
+    friend = request.args.get('friend', '').strip()
+    conversation_id = request.args.get('group', type=int)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    
+    # 验证用户
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法搜索消息")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    if friend and not user_exists(friend):
+        logger.warning(f"用户 {current_user} 尝试搜索与不存在的用户 {friend} 的消息")
+        return jsonify({'ok': False, 'msg': '用户不存在'}), 404
+    
+    if friend and conversation_id is not None:
+        return jsonify({'ok': False, 'msg': '不能同时指定好友和群聊'}), 400
+    
+    if conversation_id is not None and not groups.is_member(conversation_id, current_user):
+        logger.warning(f"用户 {current_user} 尝试搜索不属于自己的群聊 {conversation_id}")
+        return jsonify({'ok': False, 'msg': '您不是该群聊的成员'}), 403
+    
+    if not query:
+        return jsonify({'ok': False, 'msg': '搜索内容不能为空'}), 400
+    
+    try:
+        with db.connection() as conn:
+            results, has_more = search.search_messages(conn, current_user, query, peer=friend or None,
+                                                       conversation_id=conversation_id,
+                                                       limit=limit, offset=offset)
+    except Exception as e:
+        logger.error(f"搜索消息时出错: {e}", exc_info=True)
+        return jsonify({'ok': False, 'msg': '搜索消息失败'}), 500
+    
+    logger.info(f"用户 {current_user} 搜索消息，返回 {len(results)} 条结果")
+    return jsonify({'ok': True, 'results': results, 'has_more': has_more,
+                    'next_offset': offset + len(results) if has_more else None})
 
 @app.route('/api/clear-chat-history', methods=['POST'])
 def api_clear_chat_history():
     """清空聊天记录"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     friend_name = request.json.get('friendName', '').strip()
 
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法清空聊天记录")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
 
-    if friend_name not in users:
+    if not user_exists(friend_name):
         logger.warning(f"用户 {current_user} 尝试清空与不存在的用户 {friend_name} 的聊天记录")
         return jsonify({'ok': False, 'msg': '用户不存在'}), 404
 
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # 先查找将要删除的图片消息，以便后续删除文件
-        cursor.execute('''
-            SELECT i.filename 
-            FROM messages m
-            JOIN images i ON i.id = CAST(SUBSTR(m.content, 5) AS INTEGER)
-            WHERE ((m.sender = ? AND m.recipient = ?) OR (m.sender = ? AND m.recipient = ?))
-            AND m.content LIKE 'Pic_%'
-        ''', (current_user, friend_name, friend_name, current_user))
+        with db.transaction() as cursor:
+            # 先查找会话中的图片消息引用的图片
+            cursor.execute('''
+                SELECT DISTINCT a.attachment_id
+                FROM messages m
+                JOIN message_attachments a ON a.message_id = m.id AND a.kind = 'image'
+                WHERE (m.sender = ? AND m.recipient = ?) OR (m.sender = ? AND m.recipient = ?)
+            ''', (current_user, friend_name, friend_name, current_user))
+            
+            image_ids = [row[0] for row in cursor.fetchall()]
+            
+            # 删除两个用户之间的所有消息记录（附件引用由触发器一起删除）
+            cursor.execute('''
+                DELETE FROM messages 
+                WHERE (sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?)
+            ''', (current_user, friend_name, friend_name, current_user))
+            
+            # 删除这些图片中不再被任何消息引用的图片记录（转发到其他会话的图片保留）
+            legacy_files = []
+            for image_id in image_ids:
+                if cursor.execute('''
+                    SELECT 1 FROM message_attachments WHERE kind = 'image' AND attachment_id = ? LIMIT 1
+                ''', (image_id,)).fetchone():
+                    continue
+                row = cursor.execute('SELECT filename, sha256 FROM images WHERE id = ?', (image_id,)).fetchone()
+                if row is None:
+                    continue
+                if row[1] is None:
+                    legacy_files.append(row[0])  # 尚未迁移的旧上传，按文件名删除
+                cursor.execute('DELETE FROM images WHERE id = ?', (image_id,))
+            
+            # 引用计数归零的文件在事务提交后删除
+            released = blob_store.release_unreferenced(cursor)
+            
+            # 消息已删除，双方在该会话中的未读计数清零
+            reset_unread_count(cursor, current_user, friend_name)
+            reset_unread_count(cursor, friend_name, current_user)
+            unread_by_user = {
+                user: get_unread_counts(cursor.connection, user)
+                for user in (current_user, friend_name)
+            }
         
-        image_files = cursor.fetchall()
+        for user, unread_counts in unread_by_user.items():
+            emit_unread_update(user, unread_counts)
         
-        # 删除图片文件
-        for (filename,) in image_files:
+        # 事务提交后再删除图片文件，避免回滚时文件已丢失
+        try:
+            blob_store.purge(released)
+        except Exception as e:
+            logger.error(f"删除不再被引用的上传文件失败: {e}")
+        for filename in legacy_files:
             file_path = UPLOAD_FOLDER / filename
             if os.path.exists(file_path):
                 try:
                     os.remove(file_path)
+                    thumbnails.remove_variants(file_path)
                     logger.info(f"删除图片文件: {file_path}")
                 except Exception as e:
                     logger.error(f"删除图片文件失败 {file_path}: {e}")
         
-        # 删除两个用户之间的所有消息记录
-        cursor.execute('''
-            DELETE FROM messages 
-            WHERE (sender = ? AND recipient = ?) OR (sender = ? AND recipient = ?)
-        ''', (current_user, friend_name, friend_name, current_user))
-        
-        # 删除与这些消息相关的已读标记
-        cursor.execute('''
-            DELETE FROM read_messages 
-            WHERE message_id NOT IN (SELECT id FROM messages WHERE id IS NOT NULL)
-        ''')
-        
-        # 删除与这些消息相关的图片记录
-        cursor.execute('''
-            DELETE FROM images 
-            WHERE id NOT IN (SELECT CAST(SUBSTR(content, 5) AS INTEGER) FROM messages WHERE content LIKE 'Pic_%' AND id IS NOT NULL)
-        ''')
-        
-        conn.commit()
-        conn.close()
-        
         logger.info(f"用户 {current_user} 清空与 {friend_name} 的聊天记录")
         return jsonify({'ok': True, 'msg': '聊天记录已清空'})
     except Exception as e:
@@ -616,55 +850,24 @@ def api_clear_chat_history():
 
 @app.route('/api/unread-messages')
 def api_unread_messages():
-    """获取未读消息数量，使用单条SQL查询优化性能"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    """获取未读消息数量（读取物化的未读计数表）"""
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法获取未读消息")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
     unread_counts = {}
+    friends_list = []
     
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
         # 获取用户好友列表
-        friend_file = FRIENDS_DIR / f"{current_user}.friends.json"
-        if friend_file.exists():
-            friends_list = json.loads(friend_file.read_text())
-        else:
-            friends_list = [current_user]
+        friends_list = get_friends_db(current_user)
         
-        # 使用单条SQL查询所有好友的未读消息数
-        if friends_list:
-            # 构建好友列表占位符
-            placeholders = ','.join(['?' for _ in friends_list])
-            
-            # 查询来自所有好友且用户未读的消息数量
-            cursor.execute(f'''
-                SELECT m.sender, COUNT(*) as unread_count
-                FROM messages m
-                LEFT JOIN read_messages r ON m.id = r.message_id AND r.user = ?
-                WHERE m.sender IN ({placeholders}) 
-                  AND m.recipient = ? 
-                  AND r.message_id IS NULL
-                GROUP BY m.sender
-            ''', [current_user] + friends_list + [current_user])
-            
-            # 将查询结果转换为字典
-            for sender, count in cursor.fetchall():
-                if sender != current_user:  # 不统计自己
-                    unread_counts[sender] = count
-            
-            # 确保所有好友都有未读数（即使为0）
-            for friend in friends_list:
-                if friend != current_user and friend not in unread_counts:
-                    unread_counts[friend] = 0
+        # 读取物化的未读计数
+        unread_counts = count_unread_messages(current_user, friends_list)
         
-        conn.close()
         logger.info(f"用户 {current_user} 获取未读消息统计")
     except Exception as e:
         logger.error(f"检查未读消息时出错: {e}")
@@ -678,70 +881,28 @@ def api_unread_messages():
 @app.route('/api/mark-messages-as-read', methods=['POST'])
 def api_mark_messages_as_read():
     """标记消息为已读"""
-    users = load_users()
     
-    # 优先从请求头获取用户信息
-    current_user = request.headers.get('X-User')
-    
-    # 如果请求头中没有，尝试从请求体中获取（用于sendBeacon请求）
-    if not current_user:
-        try:
-            current_user = request.json.get('user', '').strip()
-        except:
-            pass
+    current_user = g.auth_user
     
     friend = request.json.get('friend', '').strip()
     
     # 验证用户
-    if not current_user or current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法标记消息为已读")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
-    if not friend or friend not in users:
+    if not user_exists(friend):
         logger.warning(f"用户 {current_user} 尝试标记与不存在的用户 {friend} 的消息为已读")
         return jsonify({'ok': False, 'msg': '用户不存在'}), 404
     
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # 获取与好友之间的未读消息
-        cursor.execute('''
-            SELECT m.id
-            FROM messages m
-            LEFT JOIN read_messages r ON m.id = r.message_id AND r.user = ?
-            WHERE m.sender = ? AND m.recipient = ? AND r.message_id IS NULL
-        ''', (current_user, friend, current_user))
-        
-        unread_message_ids = cursor.fetchall()
-        
-        # 将未读消息标记为已读
-        timestamp = datetime.now().isoformat()
-        marked_count = 0
-        for (message_id,) in unread_message_ids:
-            try:
-                cursor.execute('''
-                    INSERT INTO read_messages (user, message_id, timestamp)
-                    VALUES (?, ?, ?)
-                ''', (current_user, message_id, timestamp))
-                marked_count += 1
-            except sqlite3.IntegrityError:
-                # 消息已经被标记为已读，跳过
-                pass
-        
-        conn.commit()
-        conn.close()
-        
-        # 通知所有相关会话更新未读消息数（仅在房间有成员时发送）
-        try:
-            socketio.emit('unread_update', {'recipient': current_user}, room=current_user)
-        except Exception as e:
-            logger.warning(f"发送未读消息更新通知失败 (current_user): {e}")
+        # 推进已读水位并清零未读计数
+        with db.transaction() as cursor:
+            marked_count = mark_conversation_read(cursor, current_user, friend)
+            unread_counts = get_unread_counts(cursor.connection, current_user)
         
-        try:
-            socketio.emit('unread_update', {'recipient': friend}, room=friend)
-        except Exception as e:
-            logger.warning(f"发送未读消息更新通知失败 (friend): {e}")
+        # 把清零后的未读数推送给当前用户的其他页面（好友的未读数不受影响）
+        emit_unread_update(current_user, unread_counts)
         
         logger.info(f"用户 {current_user} 标记与 {friend} 的 {marked_count} 条消息为已读")
         return jsonify({'ok': True, 'marked_count': marked_count})
@@ -749,17 +910,244 @@ def api_mark_messages_as_read():
         logger.error(f"标记消息为已读时出错: {e}", exc_info=True)
         return jsonify({'ok': False, 'msg': '标记消息为已读失败'}), 500
 
+@app.route('/api/mark-all-messages-as-read', methods=['POST'])
+def api_mark_all_messages_as_read():
+    """标记所有会话的消息为已读"""
+    current_user = g.auth_user
+    
+    # 验证用户
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法标记全部消息为已读")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    try:
+        # 推进一行全局水位，并清零该用户的未读计数
+        with db.transaction() as cursor:
+            mark_all_conversations_read(cursor, current_user)
+            unread_counts = get_unread_counts(cursor.connection, current_user)
+        
+        emit_unread_update(current_user, unread_counts)
+        
+        logger.info(f"用户 {current_user} 标记全部消息为已读")
+        return jsonify({'ok': True})
+    except Exception as e:
+        logger.error(f"标记全部消息为已读时出错: {e}", exc_info=True)
+        return jsonify({'ok': False, 'msg': '标记全部消息为已读失败'}), 500
+
+# 上传的文件按内容寻址保存（ab/cd/<sha256>），相同内容只保存一份，见 blobs.py
+blob_store = BlobStore(UPLOAD_FOLDER)
+
+def store_upload(kind, temp_path, digest, file_size, original_name, uploader):
+    """保存已写入临时文件的上传内容并登记到 images/files 表，返回图片/文件ID"""
+    with db.transaction() as cursor:
+        filename = blob_store.store(cursor, temp_path, digest, file_size)
+        return register_upload(cursor, kind, filename, digest, original_name, file_size, uploader)
+
+def register_upload(cursor, kind, filename, sha256, original_name, file_size, uploader):
+    """在 images/files 表中登记已保存到上传目录的文件，返回图片/文件ID"""
+    if kind == 'image':
+        cursor.execute('''
+            INSERT INTO images (filename, sha256, original_name, uploader, upload_time)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (filename, sha256, original_name, uploader, datetime.now().isoformat()))
+    else:
+        # 磁盘上的文件名不带扩展名，文件类型取原文件名的扩展名
+        ext = os.path.splitext(original_name)[1] or '.bin'  # 默认扩展名
+        cursor.execute('''
+            INSERT INTO files (filename, sha256, original_name, file_size, file_type, uploader, upload_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (filename, sha256, original_name, file_size, ext.lower()[1:], uploader, datetime.now().isoformat()))
+    return cursor.lastrowid
+
+def upload_mimetype(original_name):
+    """按原文件名推断响应的 Content-Type"""
+    return mimetypes.guess_type(original_name)[0] or 'application/octet-stream'
+
+# 上传后内容不再改变，允许浏览器长期缓存；附件需要登录才能访问，只允许浏览器缓存（private），
+# 并按 Authorization 区分，同一浏览器切换用户后不会直接使用其他用户的缓存
+ATTACHMENT_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+def send_upload(relative_path, mimetype, etag):
+    """发送上传目录中的文件，调用前必须已经完成权限检查
+
+    etag 为内容的 SHA-256（旧的未迁移文件使用记录ID），支持 If-None-Match / If-Modified-Since 返回304，
+    以及 Range 请求返回206（交给代理发送时由代理处理 Range）。
+    """
+    if SENDFILE_MODE == 'x-accel':
+        file_path = UPLOAD_FOLDER / relative_path
+        response = make_response('')
+        response.mimetype = mimetype
+        response.headers['X-Accel-Redirect'] = f"{SENDFILE_PREFIX}/{urllib.parse.quote(relative_path)}"
+        response.set_etag(etag)
+        response.last_modified = int(os.path.getmtime(file_path))
+        response = response.make_conditional(request, accept_ranges=False)
+    else:
+        try:
+            response = send_from_directory(UPLOAD_FOLDER, relative_path, mimetype=mimetype, etag=etag,
+                                           max_age=0, conditional=True)
+        except RequestedRangeNotSatisfiable as e:
+            response = jsonify({'ok': False, 'msg': '请求的范围无效'})
+            response.status_code = 416
+            if e.length is not None:
+                response.headers['Content-Range'] = f'bytes */{e.length}'
+            return response
+    response.headers['Cache-Control'] = ATTACHMENT_CACHE_CONTROL
+    response.headers.pop('Expires', None)
+    response.vary.add('Authorization')
+    return response
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    """请求体超过 MAX_CONTENT_LENGTH"""
+    logger.warning(f"请求体过大: {request.path}")
+    return jsonify({'ok': False, 'msg': '上传内容超过大小限制'}), 413
+
+# 分块上传（断点续传），见 uploads.py
+chunked_uploads = uploads.ChunkedUploads(UPLOAD_FOLDER)
+chunked_uploads.start_reaper()
+
+def upload_error_response(e):
+    return jsonify({'ok': False, 'msg': e.msg, **e.extra}), e.status
+
+@app.route('/api/upload/init', methods=['POST'])
+def api_upload_init():
+    """创建分块上传会话"""
+    current_user = g.auth_user
+    
+    # 验证用户
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法上传")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    data = request.json or {}
+    kind = data.get('kind', 'file')
+    filename = str(data.get('filename', '')).strip()
+    try:
+        session = chunked_uploads.create(kind, current_user, filename, data.get('size'), data.get('sha256'))
+    except uploads.UploadError as e:
+        logger.warning(f"用户 {current_user} 创建上传失败: {e.msg}")
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"创建上传会话时出错: {e}", exc_info=True)
+        return jsonify({'ok': False, 'msg': '创建上传失败'}), 500
+    
+    logger.info(f"用户 {current_user} 开始分块上传{kind}: {filename} ({data.get('size')} bytes)")
+    return jsonify({'ok': True, **session})
+
+@app.route('/api/upload/<upload_id>', methods=['GET'])
+def api_upload_status(upload_id):
+    """查询分块上传已接收的字节数（断点续传）"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    try:
+        session = chunked_uploads.get(upload_id, current_user)
+    except uploads.UploadError as e:
+        return upload_error_response(e)
+    
+    return jsonify({'ok': True, 'upload_id': upload_id, 'received': session['received'],
+                    'size': session['size'], 'chunk_size': uploads.CHUNK_SIZE})
+
+@app.route('/api/upload/<upload_id>', methods=['PUT'])
+def api_upload_chunk(upload_id):
+    """写入一个分块，请求体为原始字节，offset 为该分块在文件中的起始位置"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    offset = request.args.get('offset', type=int)
+    if offset is None or offset < 0:
+        return jsonify({'ok': False, 'msg': '缺少分块偏移'}), 400
+    
+    try:
+        # 直接读取请求流，分块不会整体读入内存
+        received = chunked_uploads.write_chunk(upload_id, current_user, offset,
+                                               request.stream, request.content_length)
+    except uploads.UploadError as e:
+        logger.warning(f"用户 {current_user} 上传分块失败: {e.msg}")
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"写入上传分块时出错: {e}", exc_info=True)
+        return jsonify({'ok': False, 'msg': '写入分块失败'}), 500
+    
+    return jsonify({'ok': True, 'received': received})
+
+@app.route('/api/upload/<upload_id>/complete', methods=['POST'])
+def api_upload_complete(upload_id):
+    """完成分块上传：校验文件并登记到 images/files 表"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    try:
+        session, partial_path, digest = chunked_uploads.finish(upload_id, current_user)
+    except uploads.UploadError as e:
+        logger.warning(f"用户 {current_user} 完成上传失败: {e.msg}")
+        return upload_error_response(e)
+    
+    kind = session['kind']
+    try:
+        # 临时文件直接移动为内容寻址的文件（已有相同内容时不再写入）
+        with db.transaction() as cursor:
+            # 先认领会话：同一上传并发的 complete 请求只有一个会继续登记附件
+            chunked_uploads.claim(cursor, upload_id)
+            filename = blob_store.store(cursor, partial_path, digest, session['size'])
+            attachment_id = register_upload(cursor, kind, filename, digest, session['original_name'],
+                                            session['size'], current_user)
+            chunked_uploads.discard(upload_id, cursor)
+        if kind == 'image':
+            thumbnails.generate_async(blob_store.path(digest))
+    except uploads.UploadError as e:
+        logger.warning(f"用户 {current_user} 完成上传失败: {e.msg}")
+        return upload_error_response(e)
+    except Exception as e:
+        logger.error(f"完成上传时出错: {e}", exc_info=True)
+        return jsonify({'ok': False, 'msg': f'上传失败: {str(e)}'}), 500
+    
+    logger.info(f"用户 {current_user} 分块上传{kind}成功: {session['original_name']} ({session['size']} bytes)")
+    id_key = 'image_id' if kind == 'image' else 'file_id'
+    return jsonify({'ok': True, id_key: attachment_id, 'sha256': digest, 'msg': '上传成功'})
+
+@app.route('/api/upload/<upload_id>', methods=['DELETE'])
+def api_upload_abort(upload_id):
+    """放弃分块上传"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    try:
+        chunked_uploads.get(upload_id, current_user)
+        chunked_uploads.discard(upload_id)
+    except uploads.UploadError as e:
+        return upload_error_response(e)
+    
+    logger.info(f"用户 {current_user} 放弃上传 {upload_id}")
+    return jsonify({'ok': True})
+
+def upload_too_large(kind):
+    """旧版上传接口（/api/upload-image、/api/upload-file）的内容超过与分块上传相同的大小限制"""
+    return jsonify({'ok': False, 'msg': f'文件大小超过限制（最大 {uploads.KINDS[kind] // 1024 // 1024} MB）'}), 413
+
 @app.route('/api/upload-image', methods=['POST'])
 def upload_image():
     """上传图片API"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法上传图片")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
+    # 请求体明显超过图片大小上限（另加1MB表单开销）时不再解析表单
+    if (request.content_length or 0) > uploads.MAX_IMAGE_SIZE + 1024 * 1024:
+        logger.warning(f"用户 {current_user} 上传图片失败：请求体过大 ({request.content_length} bytes)")
+        return upload_too_large('image')
+    
     if 'image' not in request.files:
         logger.warning(f"用户 {current_user} 上传图片失败：没有上传文件")
         return jsonify({'ok': False, 'msg': '没有上传文件'}), 400
@@ -771,35 +1159,22 @@ def upload_image():
     
     if image_file:
         try:
-            # 生成唯一文件名
-            ext = os.path.splitext(image_file.filename)[1]
-            if not ext:
-                ext = '.png'  # 默认扩展名
-            unique_filename = str(uuid.uuid4()) + ext
-            file_path = UPLOAD_FOLDER / unique_filename
-            
-            # 保存文件
-            image_file.save(file_path)
+            # 写入临时文件并计算摘要
+            temp_path, digest, file_size = blob_store.write_temp(image_file.stream, uploads.MAX_IMAGE_SIZE)
             
-            # 保存图片信息到数据库
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO images (filename, original_name, uploader, upload_time)
-                VALUES (?, ?, ?, ?)
-            ''', (unique_filename, image_file.filename, current_user, datetime.now().isoformat()))
-            
-            image_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            # 保存文件并把图片信息保存到数据库
+            image_id = store_upload('image', temp_path, digest, file_size, image_file.filename, current_user)
+            thumbnails.generate_async(blob_store.path(digest))
             
             logger.info(f"用户 {current_user} 上传图片成功: {image_file.filename}")
             return jsonify({'ok': True, 'image_id': image_id, 'msg': '图片上传成功'})
+        except BlobTooLarge:
+            logger.warning(f"用户 {current_user} 上传图片失败：超过大小限制: {image_file.filename}")
+            return upload_too_large('image')
         except Exception as e:
-            # 如果保存数据库失败，删除已上传的文件
-            if 'file_path' in locals() and os.path.exists(file_path):
-                os.remove(file_path)
+            # 如果保存数据库失败，删除临时文件
+            if 'temp_path' in locals() and os.path.exists(temp_path):
+                os.remove(temp_path)
             logger.error(f"保存图片信息到数据库时出错: {e}")
             return jsonify({'ok': False, 'msg': f'上传失败: {str(e)}'}), 500
     
@@ -809,11 +1184,10 @@ def upload_image():
 @app.route('/api/upload-file', methods=['POST'])
 def upload_file():
     """上传文件API"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法上传文件")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
@@ -828,78 +1202,98 @@ def upload_file():
     
     if file:
         try:
-            # 生成唯一文件名
-            ext = os.path.splitext(file.filename)[1]
-            if not ext:
-                ext = '.bin'  # 默认扩展名
-            unique_filename = str(uuid.uuid4()) + ext
-            file_path = UPLOAD_FOLDER / unique_filename
-            
-            # 保存文件
-            file.save(file_path)
+            # 写入临时文件并计算摘要
+            temp_path, digest, file_size = blob_store.write_temp(file.stream, uploads.MAX_FILE_SIZE)
             
-            # 获取文件大小
-            file_size = os.path.getsize(file_path)
-            
-            # 保存文件信息到数据库
-            conn = sqlite3.connect(DB_FILE)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT INTO files (filename, original_name, file_size, file_type, uploader, upload_time)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (unique_filename, file.filename, file_size, ext.lower()[1:], current_user, datetime.now().isoformat()))
-            
-            file_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            # 保存文件并把文件信息保存到数据库
+            file_id = store_upload('file', temp_path, digest, file_size, file.filename, current_user)
             
             logger.info(f"用户 {current_user} 上传文件成功: {file.filename} ({file_size} bytes)")
             return jsonify({'ok': True, 'file_id': file_id, 'msg': '文件上传成功'})
+        except BlobTooLarge:
+            logger.warning(f"用户 {current_user} 上传文件失败：超过大小限制: {file.filename}")
+            return upload_too_large('file')
         except Exception as e:
-            # 如果保存数据库失败，删除已上传的文件
-            if 'file_path' in locals() and os.path.exists(file_path):
-                os.remove(file_path)
+            # 如果保存数据库失败，删除临时文件
+            if 'temp_path' in locals() and os.path.exists(temp_path):
+                os.remove(temp_path)
             logger.error(f"保存文件信息到数据库时出错: {e}")
             return jsonify({'ok': False, 'msg': f'上传失败: {str(e)}'}), 500
     
     logger.warning(f"用户 {current_user} 上传文件失败")
     return jsonify({'ok': False, 'msg': '上传失败'}), 500
 
+def is_user_involved_in_attachment_chat(current_user, kind, attachment_id):
+    """检查用户是否参与了引用该附件的任意一条消息所在的聊天（一对一聊天，或用户所在的群聊）"""
+    with db.connection() as conn:
+        row = conn.execute('''
+            SELECT 1
+            FROM message_attachments a
+            JOIN messages m ON m.id = a.message_id
+            WHERE a.kind = ? AND a.attachment_id = ? AND (
+                m.sender = ? OR m.recipient = ? OR EXISTS (
+                    SELECT 1 FROM conversation_members c
+                    WHERE c.conversation_id = m.conversation_id AND c.user = ?))
+            LIMIT 1
+        ''', (kind, attachment_id, current_user, current_user, current_user)).fetchone()
+    return row is not None
+
+def is_user_involved_in_image_chat(current_user, image_id):
+    """检查用户是否参与了包含该图片的聊天"""
+    try:
+        return is_user_involved_in_attachment_chat(current_user, 'image', image_id)
+    except Exception as e:
+        logger.error(f"检查用户聊天权限时出错: {e}")
+        return False
+
+def is_user_involved_in_file_chat(current_user, file_id):
+    """检查用户是否参与了包含该文件的聊天"""
+    try:
+        return is_user_involved_in_attachment_chat(current_user, 'file', file_id)
+    except Exception as e:
+        logger.error(f"检查用户文件聊天权限时出错: {e}")
+        return False
+
 @app.route('/api/get-image/<int:image_id>')
 def get_image(image_id):
-    """获取图片"""
+    """获取图片，size=thumb|medium 返回缩小的版本（默认 orig 为原图）"""
     try:
-        # 验证用户是否已登录（仅使用HTTP Header验证）
-        users = load_users()
-        current_user = request.headers.get('X-User')
-        if not current_user or current_user not in users:
+        # 当前用户为令牌中的用户
+        current_user = g.auth_user
+        if not user_exists(current_user):
             logger.warning(f"用户未登录，无法获取图片 {image_id}")
             return jsonify({'ok': False, 'msg': '用户未登录'}), 401
-            
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
         
+        size = request.args.get('size', 'orig')
+        if size != 'orig' and size not in thumbnails.SIZES:
+            return jsonify({'ok': False, 'msg': '不支持的图片规格'}), 400
+            
         # 获取图片信息，包括上传者
-        cursor.execute('SELECT filename, uploader FROM images WHERE id = ?', (image_id,))
-        result = cursor.fetchone()
+        with db.connection() as conn:
+            result = conn.execute('SELECT filename, sha256, original_name, uploader FROM images WHERE id = ?',
+                                  (image_id,)).fetchone()
         
         if result:
-            filename, uploader = result
+            filename, sha256, original_name, uploader = result
+            etag = sha256 or f'image-{image_id}'
             # 检查当前用户是否有权限访问这张图片
             # 用户可以访问自己上传的图片，或者与自己有聊天记录的图片
             if current_user == uploader or is_user_involved_in_image_chat(current_user, image_id):
                 file_path = UPLOAD_FOLDER / filename
                 if os.path.exists(file_path):
-                    conn.close()
-                    logger.info(f"用户 {current_user} 获取图片 {image_id}")
-                    return send_from_directory(UPLOAD_FOLDER, filename)
+                    logger.info(f"用户 {current_user} 获取图片 {image_id} ({size})")
+                    if size != 'orig':
+                        # 缩略图尚未生成时当场生成，无法生成时返回原图
+                        variant_path = thumbnails.ensure_variant(str(file_path), size)
+                        if variant_path != str(file_path):
+                            return send_upload(os.path.relpath(variant_path, UPLOAD_FOLDER),
+                                               thumbnails.MIMETYPE, f'{etag}-{size}')
+                    # 按内容寻址的文件没有扩展名，Content-Type 按原文件名推断
+                    return send_upload(filename, upload_mimetype(original_name), etag)
             
-            conn.close()
             logger.warning(f"用户 {current_user} 无权限查看图片 {image_id}")
             return jsonify({'ok': False, 'msg': '您没有权限查看此图片'}), 403
         
-        conn.close()
         logger.warning(f"用户 {current_user} 尝试获取不存在的图片 {image_id}")
         return jsonify({'ok': False, 'msg': '图片不存在'}), 404
     except Exception as e:
@@ -910,36 +1304,31 @@ def get_image(image_id):
 def get_file(file_id):
     """获取文件"""
     try:
-        # 验证用户是否已登录（仅使用HTTP Header验证）
-        users = load_users()
-        current_user = request.headers.get('X-User')
-        if not current_user or current_user not in users:
+        # 当前用户为令牌中的用户
+        current_user = g.auth_user
+        if not user_exists(current_user):
             logger.warning(f"用户未登录，无法获取文件 {file_id}")
             return jsonify({'ok': False, 'msg': '用户未登录'}), 401
             
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
         # 获取文件信息，包括上传者
-        cursor.execute('SELECT filename, uploader FROM files WHERE id = ?', (file_id,))
-        result = cursor.fetchone()
+        with db.connection() as conn:
+            result = conn.execute('SELECT filename, sha256, original_name, uploader FROM files WHERE id = ?',
+                                  (file_id,)).fetchone()
         
         if result:
-            filename, uploader = result
+            filename, sha256, original_name, uploader = result
             # 检查当前用户是否有权限访问这个文件
             # 用户可以访问自己上传的文件，或者与自己有聊天记录的文件
             if current_user == uploader or is_user_involved_in_file_chat(current_user, file_id):
                 file_path = UPLOAD_FOLDER / filename
                 if os.path.exists(file_path):
-                    conn.close()
                     logger.info(f"用户 {current_user} 获取文件 {file_id}")
-                    return send_from_directory(UPLOAD_FOLDER, filename)
+                    # 按内容寻址的文件没有扩展名，Content-Type 按原文件名推断
+                    return send_upload(filename, upload_mimetype(original_name), sha256 or f'file-{file_id}')
             
-            conn.close()
             logger.warning(f"用户 {current_user} 无权限查看文件 {file_id}")
             return jsonify({'ok': False, 'msg': '您没有权限查看此文件'}), 403
         
-        conn.close()
         logger.warning(f"用户 {current_user} 尝试获取不存在的文件 {file_id}")
         return jsonify({'ok': False, 'msg': '文件不存在'}), 404
     except Exception as e:
@@ -950,19 +1339,15 @@ def get_file(file_id):
 def get_file_info(file_id):
     """获取文件信息"""
     try:
-        # 验证用户是否已登录（仅使用HTTP Header验证）
-        users = load_users()
-        current_user = request.headers.get('X-User')
-        if not current_user or current_user not in users:
+        # 当前用户为令牌中的用户
+        current_user = g.auth_user
+        if not user_exists(current_user):
             logger.warning(f"用户未登录，无法获取文件信息 {file_id}")
             return jsonify({'ok': False, 'msg': '用户未登录'}), 401
             
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
         # 获取文件信息
-        cursor.execute('SELECT filename, original_name, file_size, file_type, uploader, upload_time FROM files WHERE id = ?', (file_id,))
-        result = cursor.fetchone()
+        with db.connection() as conn:
+            result = conn.execute('SELECT filename, original_name, file_size, file_type, uploader, upload_time FROM files WHERE id = ?', (file_id,)).fetchone()
         
         if result:
             filename, original_name, file_size, file_type, uploader, upload_time = result
@@ -970,8 +1355,6 @@ def get_file_info(file_id):
             # 检查当前用户是否有权限访问这个文件
             # 用户可以访问自己上传的文件，或者与自己有聊天记录的文件
             if current_user == uploader or is_user_involved_in_file_chat(current_user, file_id):
-                conn.close()
-                
                 file_info = {
                     'id': file_id,
                     'filename': filename,
@@ -985,81 +1368,40 @@ def get_file_info(file_id):
                 logger.info(f"用户 {current_user} 获取文件信息 {file_id}")
                 return jsonify({'ok': True, 'file': file_info})
             
-            conn.close()
             logger.warning(f"用户 {current_user} 无权限查看文件信息 {file_id}")
             return jsonify({'ok': False, 'msg': '您没有权限查看此文件信息'}), 403
         
-        conn.close()
         logger.warning(f"用户 {current_user} 尝试获取不存在的文件信息 {file_id}")
         return jsonify({'ok': False, 'msg': '文件不存在'}), 404
     except Exception as e:
         logger.error(f"获取文件信息时出错: {e}")
         return jsonify({'ok': False, 'msg': '获取文件信息失败'}), 500
 
+# 网易云音乐接口（连接池、缓存、合并并发查询，见 music.py）
+music_client = music.MusicClient()
+# /api/music/details 一次最多查询的歌曲数
+MAX_MUSIC_DETAIL_IDS = 200
+
 @app.route('/api/music/search')
 def music_search():
     """搜索音乐"""
-    keyword = request.args.get('keyword', '')
+    keyword = request.args.get('keyword', '').strip()
     limit = request.args.get('limit', '30')
     
     if not keyword:
         logger.warning("音乐搜索失败：关键词为空")
         return jsonify({'ok': False, 'msg': '搜索关键词不能为空'}), 400
+    if not limit.isdigit():
+        return jsonify({'ok': False, 'msg': '参数无效'}), 400
     
     try:
-        # 使用网易云音乐API搜索音乐
-        url = 'https://music.163.com/api/cloudsearch/pc'
-        params = {
-            's': keyword,
-            'type': '1',  # 1: 单曲
-            'limit': limit,
-            'offset': '0'
-        }
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Referer': 'https://music.163.com'
-        }
-        
-        response = requests.post(url, data=params, headers=headers)
-        data = response.json()
-        
-        if data.get('code') == 200:
-            songs = []
-            for song in data.get('result', {}).get('songs', []):
-                # 处理歌手信息
-                artists = []
-                for artist in song.get('ar', []):
-                    artists.append(artist.get('name', ''))
-                
-                # 检查是否为VIP歌曲
-                is_vip = False
-                if 'privilege' in song:
-                    # 如果有privilege字段，检查fee和payed字段
-                    privilege = song['privilege']
-                    fee = privilege.get('fee', 0)
-                    payed = privilege.get('payed', 0)
-                    # fee=1表示付费歌曲，payed=0表示未付费
-                    if fee == 1 and payed == 0:
-                        is_vip = True
-                
-                songs.append({
-                    'id': song.get('id'),
-                    'name': song.get('name'),
-                    'artists': artists,
-                    'album': song.get('al', {}).get('name', ''),
-                    'picUrl': song.get('al', {}).get('picUrl', ''),
-                    'isVip': is_vip  # 添加VIP标识
-                })
-            
-            logger.info(f"音乐搜索成功：关键词 '{keyword}'，返回 {len(songs)} 首歌曲")
-            return jsonify({'ok': True, 'songs': songs})
-        else:
-            logger.error(f"音乐搜索失败：API返回错误码 {data.get('code')}")
-            return jsonify({'ok': False, 'msg': '搜索失败'}), 500
-    except Exception as e:
-        logger.error(f"音乐搜索出错: {e}")
-        return jsonify({'ok': False, 'msg': f'搜索出错: {str(e)}'}), 500
+        songs = music_client.search(keyword, int(limit))
+    except music.MusicError as e:
+        logger.error(f"音乐搜索失败：关键词 '{keyword}'，{e.msg}")
+        return jsonify({'ok': False, 'msg': e.msg}), e.status
+    
+    logger.info(f"音乐搜索成功：关键词 '{keyword}'，返回 {len(songs)} 首歌曲")
+    return jsonify({'ok': True, 'songs': songs})
 
 @app.route('/api/music/detail')
 def music_detail():
@@ -1069,46 +1411,63 @@ def music_detail():
     if not music_id:
         logger.warning("获取音乐详情失败：音乐ID为空")
         return jsonify({'ok': False, 'msg': '音乐ID不能为空'}), 400
+    if not music_id.isdigit():
+        return jsonify({'ok': False, 'msg': '音乐ID无效'}), 400
     
     try:
-        # 使用网易云音乐API获取音乐详情
-        url = f'https://music.163.com/api/song/detail'
-        params = {
-            'ids': f'[{music_id}]'
-        }
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Referer': 'https://music.163.com'
-        }
-        
-        response = requests.get(url, params=params, headers=headers)
-        data = response.json()
-        
-        if data.get('code') == 200 and data.get('songs'):
-            song = data['songs'][0]
-            # 处理歌手信息
-            artists = []
-            for artist in song.get('artists', []):
-                artists.append(artist.get('name', ''))
-            
-            music_info = {
-                'id': song.get('id'),
-                'name': song.get('name'),
-                'artists': artists,
-                'album': song.get('album', {}).get('name', ''),
-                'picUrl': song.get('album', {}).get('picUrl', ''),
-                'duration': song.get('duration', 0)
-            }
-            
-            logger.info(f"获取音乐详情成功：音乐ID {music_id}")
-            return jsonify({'ok': True, 'music': music_info})
-        else:
-            logger.error(f"获取音乐详情失败：API返回错误码 {data.get('code')}")
-            return jsonify({'ok': False, 'msg': '获取音乐详情失败'}), 500
-    except Exception as e:
-        logger.error(f"获取音乐详情出错: {e}")
-        return jsonify({'ok': False, 'msg': f'获取详情出错: {str(e)}'}), 500
+        music_info = music_client.detail(music_id)
+    except music.MusicError as e:
+        logger.error(f"获取音乐详情失败：音乐ID {music_id}，{e.msg}")
+        return jsonify({'ok': False, 'msg': e.msg}), e.status
+    
+    logger.info(f"获取音乐详情成功：音乐ID {music_id}")
+    return jsonify({'ok': True, 'music': music_info})
+
+@app.route('/api/music/details')
+def music_details():
+    """批量获取音乐详情：ids=1,2,3，按请求的顺序返回（重复的ID只返回一次），不存在的ID列在 missing 中"""
+    ids_param = request.args.get('ids', '')
+    parts = [part.strip() for part in ids_param.split(',') if part.strip()]
+    
+    if not parts:
+        logger.warning("批量获取音乐详情失败：音乐ID为空")
+        return jsonify({'ok': False, 'msg': '音乐ID不能为空'}), 400
+    if not all(part.isascii() and part.isdigit() for part in parts):
+        return jsonify({'ok': False, 'msg': '音乐ID无效'}), 400
+    music_ids = list(dict.fromkeys(int(part) for part in parts))
+    if len(music_ids) > MAX_MUSIC_DETAIL_IDS:
+        return jsonify({'ok': False, 'msg': f'一次最多获取 {MAX_MUSIC_DETAIL_IDS} 首歌曲'}), 400
+    
+    try:
+        found = music_client.details(music_ids)
+    except music.MusicError as e:
+        logger.error(f"批量获取音乐详情失败：{len(music_ids)} 首，{e.msg}")
+        return jsonify({'ok': False, 'msg': e.msg}), e.status
+    
+    logger.info(f"批量获取音乐详情成功：{len(found)}/{len(music_ids)} 首")
+    return jsonify({
+        'ok': True,
+        'songs': [found[music_id] for music_id in music_ids if music_id in found],
+        'missing': [music_id for music_id in music_ids if music_id not in found],
+    })
+
+def attach_music_details(messages):
+    """为音乐分享消息附加歌曲的最新信息（music 字段）；上游出错时不附加，客户端使用消息中保存的信息"""
+    shared = []
+    for message in messages:
+        song_id = message_types.music_song_id(message['content'])
+        if song_id is not None:
+            shared.append((message, song_id))
+    if not shared:
+        return
+    try:
+        found = music_client.details(song_id for _, song_id in shared)
+    except music.MusicError as e:
+        logger.warning(f"获取聊天记录中的音乐详情失败: {e.msg}")
+        return
+    for message, song_id in shared:
+        if song_id in found:
+            message['music'] = found[song_id]
 
 @app.route('/api/music/url')
 def music_url():
@@ -1136,97 +1495,36 @@ def music_lyric():
     if not music_id:
         logger.warning("获取音乐歌词失败：音乐ID为空")
         return jsonify({'ok': False, 'msg': '音乐ID不能为空'}), 400
+    if not music_id.isdigit():
+        return jsonify({'ok': False, 'msg': '音乐ID无效'}), 400
     
     try:
-        # 使用网易云音乐API获取歌词
-        url = f'https://music.163.com/api/song/lyric'
-        params = {
-            'id': music_id,
-            'lv': -1,
-            'kv': -1,
-            'tv': -1
-        }
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Referer': 'https://music.163.com'
-        }
-        
-        response = requests.get(url, params=params, headers=headers)
-        data = response.json()
-        
-        if data.get('code') == 200:
-            lyric = data.get('lrc', {}).get('lyric', '')
-            logger.info(f"获取音乐歌词成功：音乐ID {music_id}")
-            return jsonify({'ok': True, 'lyric': lyric})
-        else:
-            logger.error(f"获取歌词失败：API返回错误码 {data.get('code')}")
-            return jsonify({'ok': False, 'msg': '获取歌词失败'}), 500
-    except Exception as e:
-        logger.error(f"获取歌词出错: {e}")
-        return jsonify({'ok': False, 'msg': f'获取歌词出错: {str(e)}'}), 500
+        lyric = music_client.lyric(music_id)
+    except music.MusicError as e:
+        logger.error(f"获取歌词失败：音乐ID {music_id}，{e.msg}")
+        return jsonify({'ok': False, 'msg': e.msg}), e.status
+    
+    logger.info(f"获取音乐歌词成功：音乐ID {music_id}")
+    return jsonify({'ok': True, 'lyric': lyric})
 
-# 反馈系统相关接口
-FEEDBACK_FILE = ROOT / 'data' / 'feedback.json'
-OPS_FILE = ROOT / 'data' / 'ops.json'
+# 反馈系统相关接口（反馈保存在数据库中，见 feedback.py）
+FEEDBACK_FILE = DATA_DIR / 'feedback.json'
+OPS_FILE = DATA_DIR / 'ops.json'
 
-def load_feedback():
-    """加载反馈数据"""
-    try:
-        with open(FEEDBACK_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {"feedback": []}
-
-def save_feedback(data):
-    """保存反馈数据"""
-    with open(FEEDBACK_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-
-def load_ops():
-    """加载管理员列表"""
-    try:
-        with open(OPS_FILE, 'r', encoding='utf-8') as f:
-            return set(json.load(f))
-    except FileNotFoundError:
-        return set()
+# 管理员列表缓存：ops.json 只在文件变化时重新加载
+ops_list = OpsList(OPS_FILE)
 
 def is_op(user):
-    """检查用户是否为管理员"""
-    ops = load_ops()
-    return user in ops
-
-def generate_feedback_id(feedback_type, location, time_str):
-    """生成反馈ID"""
-    type_codes = {
-        "bug": "CB",
-        "suggestion": "CA",
-        "plan": "CP"
-    }
-    
-    type_code = type_codes.get(feedback_type, "CX")
-    
-    # 获取当前同位置的反馈数量，用于生成序号（不区分类型）
-    feedback_data = load_feedback()
-    count = 1
-    for item in feedback_data["feedback"]:
-        # 不再检查类型，只检查位置和日期
-        if item["location"] == location and item["time"].startswith(time_str[:8]):
-            count += 1
-    
-    # 格式化序号为4位数字
-    serial_number = f"{count:04d}"
-    
-    return f"{type_code}-{location}-{time_str}-{serial_number}"
+    """检查用户是否为管理员（查内存缓存）"""
+    return ops_list.contains(user)
 
 @app.route('/api/feedback/submit', methods=['POST'])
 def submit_feedback():
     """提交反馈"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法提交反馈")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
@@ -1258,29 +1556,8 @@ def submit_feedback():
         logger.warning(f"用户 {current_user} 无权限提交计划类型反馈")
         return jsonify({'ok': False, 'msg': '只有管理员可以提交计划类型的反馈'}), 403
     
-    # 生成时间戳
-    now = datetime.now()
-    time_str = now.strftime("%Y%m%d%H%M%S")
-    
-    # 生成反馈ID
-    feedback_id = generate_feedback_id(feedback_type, location, time_str)
-    
-    # 创建反馈项
-    feedback_item = {
-        "id": feedback_id,
-        "type": feedback_type,
-        "location": location,
-        "time": time_str,
-        "content": content,
-        "author": current_user,
-        "upvotes": 0,
-        "upvoted_by": []  # 点赞用户列表
-    }
-    
-    # 保存反馈
-    feedback_data = load_feedback()
-    feedback_data["feedback"].append(feedback_item)
-    save_feedback(feedback_data)
+    # 保存反馈（ID中的序号由数据库原子地分配）
+    feedback_board.create(feedback_type, location, content, current_user)
     
     logger.info(f"用户 {current_user} 提交反馈成功：类型 {feedback_type}，位置 {location}")
     return jsonify({'ok': True, 'msg': '反馈提交成功'})
@@ -1288,34 +1565,48 @@ def submit_feedback():
 @app.route('/api/feedback/list')
 def list_feedback():
     """获取反馈列表"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法获取反馈列表")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
-    # 加载反馈数据
-    feedback_data = load_feedback()
-    feedback_list = feedback_data["feedback"]
-    
-    # 为每个反馈项添加用户是否已点赞的标记和OP标记
-    for feedback in feedback_list:
-        feedback["userUpvoted"] = current_user in feedback["upvoted_by"]
-        feedback["isOP"] = is_op(current_user)
+    # 筛选条件（all 或不指定表示不筛选）、排序方式和分页参数
+    filters = {}
+    for name in ('type', 'location', 'status'):
+        value = request.args.get(name, '')
+        filters[name] = '' if value == 'all' else value
+    if filters['status'] and filters['status'] not in feedback_board.VALID_STATUSES + (feedback_board.STATUS_UNSET,):
+        logger.warning(f"用户 {current_user} 获取反馈列表失败：无效的状态值")
+        return jsonify({'ok': False, 'msg': '无效的状态值'}), 400
+    sort = request.args.get('sort', 'upvotes')
+    if sort not in feedback_board.SORTS:
+        logger.warning(f"用户 {current_user} 获取反馈列表失败：无效的排序方式 {sort}")
+        return jsonify({'ok': False, 'msg': '无效的排序方式'}), 400
+    limit = min(max(request.args.get('limit', feedback_board.DEFAULT_PAGE_SIZE, type=int), 1),
+                feedback_board.MAX_PAGE_SIZE)
+    
+    # 在数据库中筛选、排序并取一页
+    try:
+        feedback_list, next_cursor = feedback_board.list_page(
+            current_user, feedback_type=filters['type'], location=filters['location'], status=filters['status'],
+            sort=sort, limit=limit, cursor=request.args.get('cursor'))
+    except ValueError:
+        logger.warning(f"用户 {current_user} 获取反馈列表失败：无效的分页游标")
+        return jsonify({'ok': False, 'msg': '无效的分页游标'}), 400
     
-    logger.info(f"用户 {current_user} 获取反馈列表，共 {len(feedback_list)} 条反馈")
-    return jsonify({'ok': True, 'feedback': feedback_list})
+    logger.info(f"用户 {current_user} 获取反馈列表，本页 {len(feedback_list)} 条反馈")
+    return jsonify({'ok': True, 'feedback': feedback_list, 'nextCursor': next_cursor,
+                    'isOP': is_op(current_user)})
 
 @app.route('/api/feedback/set-status', methods=['POST'])
 def set_feedback_status():
     """设置反馈状态"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法设置反馈状态")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
@@ -1334,31 +1625,15 @@ def set_feedback_status():
         return jsonify({'ok': False, 'msg': '反馈ID不能为空'}), 400
     
     # 验证状态值
-    valid_statuses = ['', 'completed', 'partial', 'alternative', 'impossible', 'failed']
-    if status not in valid_statuses:
+    if status not in feedback_board.VALID_STATUSES:
         logger.warning(f"用户 {current_user} 设置反馈状态失败：无效的状态值")
         return jsonify({'ok': False, 'msg': '无效的状态值'}), 400
     
-    # 查找反馈项
-    feedback_data = load_feedback()
-    feedback_item = None
-    
-    for item in feedback_data["feedback"]:
-        if item["id"] == feedback_id:
-            feedback_item = item
-            break
-    
-    if not feedback_item:
+    # 更新状态和说明
+    if not feedback_board.set_status(feedback_id, status, note):
         logger.warning(f"用户 {current_user} 设置反馈状态失败：反馈不存在")
         return jsonify({'ok': False, 'msg': '反馈不存在'}), 404
     
-    # 更新状态和说明
-    feedback_item["status"] = status
-    feedback_item["statusNote"] = note
-    
-    # 保存数据
-    save_feedback(feedback_data)
-    
     logger.info(f"用户 {current_user} 设置反馈 {feedback_id} 状态为 {status}")
     return jsonify({'ok': True, 'msg': '状态更新成功'})
 
@@ -1379,11 +1654,10 @@ def check_op_status():
 @app.route('/api/feedback/upvote', methods=['POST'])
 def upvote_feedback():
     """点赞反馈"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法点赞反馈")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
@@ -1394,41 +1668,27 @@ def upvote_feedback():
         logger.warning(f"用户 {current_user} 点赞反馈失败：反馈ID为空")
         return jsonify({'ok': False, 'msg': '反馈ID不能为空'}), 400
     
-    # 查找反馈项
-    feedback_data = load_feedback()
-    feedback_item = None
-    for item in feedback_data["feedback"]:
-        if item["id"] == feedback_id:
-            feedback_item = item
-            break
-    
-    if not feedback_item:
-        logger.warning(f"用户 {current_user} 点赞反馈失败：反馈不存在")
-        return jsonify({'ok': False, 'msg': '反馈不存在'}), 404
-    
-    # 检查用户是否已经点赞
-    if current_user in feedback_item["upvoted_by"]:
+    # 添加点赞（重复点赞由唯一约束拒绝，点赞数由触发器更新）
+    try:
+        upvotes = feedback_board.upvote(feedback_id, current_user)
+    except feedback_board.AlreadyUpvoted:
         logger.warning(f"用户 {current_user} 已经点赞过反馈 {feedback_id}")
         return jsonify({'ok': False, 'msg': '您已经点赞过该反馈'}), 400
     
-    # 添加点赞
-    feedback_item["upvoted_by"].append(current_user)
-    feedback_item["upvotes"] = len(feedback_item["upvoted_by"])
-    
-    # 保存数据
-    save_feedback(feedback_data)
+    if upvotes is None:
+        logger.warning(f"用户 {current_user} 点赞反馈失败：反馈不存在")
+        return jsonify({'ok': False, 'msg': '反馈不存在'}), 404
     
     logger.info(f"用户 {current_user} 点赞反馈 {feedback_id}")
-    return jsonify({'ok': True, 'upvotes': feedback_item["upvotes"]})
+    return jsonify({'ok': True, 'upvotes': upvotes})
 
 @app.route('/api/feedback/cancel-upvote', methods=['POST'])
 def cancel_upvote_feedback():
     """取消点赞反馈"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法取消点赞反馈")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
@@ -1439,41 +1699,27 @@ def cancel_upvote_feedback():
         logger.warning(f"用户 {current_user} 取消点赞反馈失败：反馈ID为空")
         return jsonify({'ok': False, 'msg': '反馈ID不能为空'}), 400
     
-    # 查找反馈项
-    feedback_data = load_feedback()
-    feedback_item = None
-    for item in feedback_data["feedback"]:
-        if item["id"] == feedback_id:
-            feedback_item = item
-            break
-    
-    if not feedback_item:
-        logger.warning(f"用户 {current_user} 取消点赞反馈失败：反馈不存在")
-        return jsonify({'ok': False, 'msg': '反馈不存在'}), 404
-    
-    # 检查用户是否已经点赞
-    if current_user not in feedback_item["upvoted_by"]:
+    # 取消点赞
+    try:
+        upvotes = feedback_board.cancel_upvote(feedback_id, current_user)
+    except feedback_board.NotUpvoted:
         logger.warning(f"用户 {current_user} 尚未点赞反馈 {feedback_id}")
         return jsonify({'ok': False, 'msg': '您还没有点赞该反馈'}), 400
     
-    # 取消点赞
-    feedback_item["upvoted_by"].remove(current_user)
-    feedback_item["upvotes"] = len(feedback_item["upvoted_by"])
-    
-    # 保存数据
-    save_feedback(feedback_data)
+    if upvotes is None:
+        logger.warning(f"用户 {current_user} 取消点赞反馈失败：反馈不存在")
+        return jsonify({'ok': False, 'msg': '反馈不存在'}), 404
     
     logger.info(f"用户 {current_user} 取消点赞反馈 {feedback_id}")
-    return jsonify({'ok': True, 'upvotes': feedback_item["upvotes"]})
+    return jsonify({'ok': True, 'upvotes': upvotes})
 
 @app.route('/api/feedback/delete', methods=['POST'])
 def delete_feedback():
     """删除反馈"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法删除反馈")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
@@ -1485,47 +1731,338 @@ def delete_feedback():
         return jsonify({'ok': False, 'msg': '反馈ID不能为空'}), 400
     
     # 查找反馈项
-    feedback_data = load_feedback()
-    feedback_item = None
-    feedback_index = -1
+    author = feedback_board.get_author(feedback_id)
     
-    for i, item in enumerate(feedback_data["feedback"]):
-        if item["id"] == feedback_id:
-            feedback_item = item
-            feedback_index = i
-            break
-    
-    if not feedback_item:
+    if author is None:
         logger.warning(f"用户 {current_user} 删除反馈失败：反馈不存在")
         return jsonify({'ok': False, 'msg': '反馈不存在'}), 404
     
     # 检查权限：只有反馈发送者或OP可以删除反馈
-    if feedback_item["author"] != current_user and not is_op(current_user):
+    if author != current_user and not is_op(current_user):
         logger.warning(f"用户 {current_user} 无权限删除反馈 {feedback_id}")
         return jsonify({'ok': False, 'msg': '您没有权限删除该反馈'}), 403
     
-    # 删除反馈
-    del feedback_data["feedback"][feedback_index]
-    
-    # 保存数据
-    save_feedback(feedback_data)
+    # 删除反馈（点赞记录由触发器一并删除）
+    if not feedback_board.delete(feedback_id):
+        logger.warning(f"用户 {current_user} 删除反馈失败：反馈不存在")
+        return jsonify({'ok': False, 'msg': '反馈不存在'}), 404
     
     logger.info(f"用户 {current_user} 删除反馈 {feedback_id}")
     return jsonify({'ok': True, 'msg': '反馈删除成功'})
 
+# 管理员公告（见 announcements.py）
+@app.route('/api/announcements', methods=['POST'])
+def api_send_announcement():
+    """发送公告（仅管理员）：不指定 recipients 时发给所有用户，否则只发给列表中的用户"""
+    current_user = g.auth_user
+    
+    # 验证用户
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法发送公告")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    # 检查权限：只有OP可以发送公告
+    if not is_op(current_user):
+        logger.warning(f"用户 {current_user} 无权限发送公告")
+        return jsonify({'ok': False, 'msg': '只有管理员可以发送公告'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    content = data.get('content', '')
+    recipients = data.get('recipients')
+    if not isinstance(content, str) or not content.strip():
+        logger.warning(f"用户 {current_user} 发送公告失败：公告内容为空")
+        return jsonify({'ok': False, 'msg': '公告内容不能为空'}), 400
+    content = content.strip()
+    if len(content) > announcements.MAX_CONTENT_LENGTH:
+        logger.warning(f"用户 {current_user} 发送公告失败：公告内容过长")
+        return jsonify({'ok': False, 'msg': f'公告内容不能超过 {announcements.MAX_CONTENT_LENGTH} 个字符'}), 400
+    
+    if recipients is not None:
+        if not isinstance(recipients, list) or not recipients or not all(isinstance(r, str) for r in recipients):
+            logger.warning(f"用户 {current_user} 发送公告失败：接收者列表无效")
+            return jsonify({'ok': False, 'msg': '接收者必须是非空的用户名列表'}), 400
+        recipients = list(dict.fromkeys(recipients))
+        if len(recipients) > announcements.MAX_RECIPIENTS:
+            logger.warning(f"用户 {current_user} 发送公告失败：接收者过多（{len(recipients)}）")
+            return jsonify({'ok': False, 'msg': f'接收者不能超过 {announcements.MAX_RECIPIENTS} 个'}), 400
+        unknown = [r for r in recipients if not user_exists(r)]
+        if unknown:
+            logger.warning(f"用户 {current_user} 发送公告失败：{len(unknown)} 个接收者不存在")
+            return jsonify({'ok': False, 'msg': '接收者不存在', 'unknown': unknown[:20]}), 400
+    
+    # 一个事务写入公告（多播时同时批量写入接收者）
+    announcement = announcements.create(current_user, content, recipients)
+    
+    # 广播时向所有连接所在的公告房间发送一次；多播时以接收者各自的房间列表发送一次
+    # （多进程部署时也只向消息队列发布一条消息）
+    socketio.emit('announcement', announcement, room=announcements.ROOM if recipients is None else recipients)
+    
+    audience = '所有用户' if recipients is None else f'{len(recipients)} 个用户'
+    logger.info(f"管理员 {current_user} 向{audience}发送公告 {announcement['id']}")
+    return jsonify({'ok': True, 'announcement': announcement,
+                    'recipients': None if recipients is None else len(recipients)})
+
+@app.route('/api/announcements')
+def api_list_announcements():
+    """获取当前用户可见的公告（从新到旧分页）和未读数"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法获取公告")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    limit = min(max(request.args.get('limit', announcements.DEFAULT_PAGE_SIZE, type=int), 1),
+                announcements.MAX_PAGE_SIZE)
+    before = request.args.get('before', type=int)
+    items, next_cursor, unread = announcements.list_for(current_user, before=before, limit=limit)
+    return jsonify({'ok': True, 'announcements': items, 'nextCursor': next_cursor, 'unread': unread})
+
+@app.route('/api/announcements/read', methods=['POST'])
+def api_mark_announcements_read():
+    """把公告标记为已读（ID不大于 id 的公告全部已读）"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法标记公告已读")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    announcement_id = data.get('id')
+    if not isinstance(announcement_id, int) or isinstance(announcement_id, bool) or announcement_id < 1:
+        logger.warning(f"用户 {current_user} 标记公告已读失败：公告ID无效")
+        return jsonify({'ok': False, 'msg': '公告ID无效'}), 400
+    
+    unread = announcements.mark_read(current_user, announcement_id)
+    return jsonify({'ok': True, 'unread': unread})
+
+# 群聊（见 groups.py）
+def user_connections(user):
+    """当前进程中该用户的 WebSocket 连接（连接时都加入了以用户名命名的房间）"""
+    return [sid for sid, _ in socketio.server.manager.get_participants('/', user)]
+
+def leave_group_room(user, conversation_id):
+    """让用户在当前进程中的连接离开群聊房间；其他进程上的连接收到 group_left 后自行离开"""
+    for sid in user_connections(user):
+        socketio.server.leave_room(sid, groups.room(conversation_id), namespace='/')
+    socketio.emit('group_left', {'id': conversation_id}, room=user)
+
+def parse_group_members(data):
+    """解析请求中的成员列表，返回 (去重后的成员, 错误信息)"""
+    members = data.get('members', [])
+    if not isinstance(members, list) or not all(isinstance(m, str) for m in members):
+        return None, '成员必须是用户名列表'
+    members = list(dict.fromkeys(m.strip() for m in members if m.strip()))
+    unknown = [m for m in members if not user_exists(m)]
+    if unknown:
+        return None, f"用户不存在: {', '.join(unknown[:10])}"
+    return members, None
+
+@app.route('/api/groups', methods=['POST'])
+def api_create_group():
+    """创建群聊：{name, members}，创建者自动加入"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法创建群聊")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    name = data.get('name', '')
+    if not isinstance(name, str) or not name.strip():
+        return jsonify({'ok': False, 'msg': '群聊名称不能为空'}), 400
+    name = name.strip()
+    if len(name) > groups.MAX_NAME_LENGTH:
+        return jsonify({'ok': False, 'msg': f'群聊名称不能超过 {groups.MAX_NAME_LENGTH} 个字符'}), 400
+    members, error = parse_group_members(data)
+    if error:
+        logger.warning(f"用户 {current_user} 创建群聊失败：{error}")
+        return jsonify({'ok': False, 'msg': error}), 400
+    
+    try:
+        group = groups.create(current_user, name, members)
+    except groups.TooManyMembers:
+        return jsonify({'ok': False, 'msg': f'群聊人数不能超过 {groups.MAX_MEMBERS}'}), 400
+    
+    # 通知所有成员（包括创建者），其连接收到后发送 join_group 加入群聊房间
+    for member in dict.fromkeys([current_user, *members]):
+        socketio.emit('group_added', group, room=member)
+    
+    logger.info(f"用户 {current_user} 创建群聊 {group['id']}（{group['memberCount']} 人）")
+    return jsonify({'ok': True, 'group': group})
+
+@app.route('/api/groups')
+def api_list_groups():
+    """获取用户加入的群聊和各群聊的未读数"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法获取群聊列表")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    return jsonify({'ok': True, 'groups': groups.list_for(current_user)})
+
+@app.route('/api/groups/<int:conversation_id>/members')
+def api_group_members(conversation_id):
+    """获取群聊成员（仅成员可查看）"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法获取群聊成员")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    if not groups.is_member(conversation_id, current_user):
+        return jsonify({'ok': False, 'msg': '您不是该群聊的成员'}), 403
+    
+    return jsonify({'ok': True, 'members': groups.members(conversation_id)})
+
+@app.route('/api/groups/<int:conversation_id>/members', methods=['POST'])
+def api_add_group_members(conversation_id):
+    """添加群聊成员（仅创建者）"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法添加群聊成员")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    group = groups.get(conversation_id)
+    if group is None:
+        return jsonify({'ok': False, 'msg': '群聊不存在'}), 404
+    if group['creator'] != current_user:
+        logger.warning(f"用户 {current_user} 无权限向群聊 {conversation_id} 添加成员")
+        return jsonify({'ok': False, 'msg': '只有群聊创建者可以添加成员'}), 403
+    
+    members, error = parse_group_members(request.get_json(silent=True) or {})
+    if error:
+        return jsonify({'ok': False, 'msg': error}), 400
+    
+    try:
+        # 创建者退出群聊后不能再添加成员（与加入成员在同一事务中检查）
+        added = groups.add_members(conversation_id, current_user, members)
+    except groups.TooManyMembers:
+        return jsonify({'ok': False, 'msg': f'群聊人数不能超过 {groups.MAX_MEMBERS}'}), 400
+    if added is None:
+        logger.warning(f"用户 {current_user} 已退出群聊 {conversation_id}，无法添加成员")
+        return jsonify({'ok': False, 'msg': '您不是该群聊的成员'}), 403
+    
+    group = groups.get(conversation_id)
+    for member in added:
+        socketio.emit('group_added', group, room=member)
+    
+    logger.info(f"用户 {current_user} 向群聊 {conversation_id} 添加了 {len(added)} 个成员")
+    return jsonify({'ok': True, 'added': added, 'memberCount': group['memberCount']})
+
+@app.route('/api/groups/<int:conversation_id>/leave', methods=['POST'])
+def api_leave_group(conversation_id):
+    """退出群聊"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法退出群聊")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    if not groups.remove_member(conversation_id, current_user):
+        return jsonify({'ok': False, 'msg': '您不是该群聊的成员'}), 404
+    
+    leave_group_room(current_user, conversation_id)
+    logger.info(f"用户 {current_user} 退出群聊 {conversation_id}")
+    return jsonify({'ok': True, 'msg': '已退出群聊'})
+
+@app.route('/api/groups/<int:conversation_id>/messages', methods=['POST'])
+def api_send_group_message(conversation_id):
+    """发送群聊消息：消息只保存一份，只向群聊房间推送一次"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法发送群聊消息")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    content = data.get('content', '')
+    if not isinstance(content, str) or not content.strip():
+        return jsonify({'ok': False, 'msg': '消息内容不能为空'}), 400
+    
+    # 内容格式与一对一消息相同（Pic_<ID>、File_<ID>、Music_<JSON>，文字消息没有前缀）
+    message_type, body, attachment_id = message_types.parse_client_content(content.strip())
+    result = groups.send(conversation_id, current_user, message_type, body, attachment_id)
+    if result is None:
+        logger.warning(f"用户 {current_user} 不是群聊 {conversation_id} 的成员，无法发送消息")
+        return jsonify({'ok': False, 'msg': '您不是该群聊的成员'}), 403
+    message_id, seq, timestamp = result
+    
+    # seq 为发送后群聊的消息数，客户端据此计算未读数（未读数 = seq - 自己的已读位置）
+    socketio.emit('group_message', {
+        'conversationId': conversation_id,
+        'id': message_id,
+        'seq': seq,
+        'sender': current_user,
+        'content': message_types.to_client_content(message_type, body, attachment_id),
+        'timestamp': timestamp
+    }, room=groups.room(conversation_id))
+    
+    return jsonify({'ok': True, 'message_id': message_id, 'seq': seq})
+
+@app.route('/api/groups/<int:conversation_id>/messages')
+def api_group_history(conversation_id):
+    """获取群聊消息（从新到旧，before 游标分页，仅成员可查看）"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法获取群聊消息")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    if not groups.is_member(conversation_id, current_user):
+        return jsonify({'ok': False, 'msg': '您不是该群聊的成员'}), 403
+    
+    limit = min(max(request.args.get('limit', groups.DEFAULT_PAGE_SIZE, type=int), 1), groups.MAX_PAGE_SIZE)
+    rows, next_cursor = groups.history(conversation_id, before=request.args.get('before', type=int), limit=limit)
+    messages = [{
+        'id': message_id,
+        'sender': sender,
+        'content': message_types.to_client_content(message_type, body, attachment_id),
+        'timestamp': timestamp
+    } for message_id, sender, message_type, body, attachment_id, timestamp in rows]
+    return jsonify({'ok': True, 'messages': messages, 'nextCursor': next_cursor})
+
+@app.route('/api/groups/<int:conversation_id>/read', methods=['POST'])
+def api_mark_group_read(conversation_id):
+    """把群聊标记为已读"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法标记群聊已读")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    if not groups.mark_read(conversation_id, current_user):
+        return jsonify({'ok': False, 'msg': '您不是该群聊的成员'}), 404
+    return jsonify({'ok': True, 'unread': 0})
+
 @app.route('/flowStatistics')
 def flow_statistics():
     """处理对/flowStatistics的请求，避免404日志"""
     return '', 204  # 返回204 No Content状态码
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus格式的运行指标（仅管理员可访问）"""
+    current_user = g.auth_user
+    
+    if not user_exists(current_user):
+        logger.warning(f"用户 {current_user} 未登录，无法获取运行指标")
+        return jsonify({'ok': False, 'msg': '用户未登录'}), 401
+    
+    if not is_op(current_user):
+        logger.warning(f"用户 {current_user} 无权限获取运行指标")
+        return jsonify({'ok': False, 'msg': '只有管理员可以查看运行指标'}), 403
+    
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 @app.route('/api/admin/migrate-passwords', methods=['POST'])
 def api_migrate_passwords():
     """迁移所有明文密码到哈希格式（仅用于开发/测试）"""
-    users = load_users()
-    current_user = request.headers.get('X-User')
+    current_user = g.auth_user
     
     # 验证用户
-    if current_user not in users:
+    if not user_exists(current_user):
         logger.warning(f"用户 {current_user} 未登录，无法执行密码迁移")
         return jsonify({'ok': False, 'msg': '用户未登录'}), 401
     
@@ -1545,11 +2082,43 @@ def api_migrate_passwords():
         return jsonify({'ok': True, 'msg': '所有密码已经是哈希格式，无需迁移'})
 
 # WebSocket事件处理
+@socketio.on('connect')
+def on_connect(auth=None):
+    """客户端连接：校验连接时提供的令牌（io({auth: {token}})），连接期间的事件只能以该用户身份发送"""
+    token = auth.get('token') if isinstance(auth, dict) else None
+    try:
+        username, _ = authenticate_token(token)
+    except tokens.InvalidToken as e:
+        logger.warning(f"WebSocket连接的令牌无效: {e}")
+        return False
+    session['user'] = username
+    # 所有连接都加入公告房间，广播公告只需发送一次
+    join_room(announcements.ROOM)
+    # 加入自己的房间和所在的群聊房间，每条群聊消息只需向群聊房间发送一次
+    join_room(username)
+    for conversation_id in groups.conversation_ids(username):
+        join_room(groups.room(conversation_id))
+    metrics.SOCKET_CONNECTIONS.inc()
+
+def socket_user_matches(username):
+    """WebSocket事件中声明的用户是否为连接时令牌中的用户"""
+    if username != session.get('user'):
+        logger.warning(f"WebSocket连接 {session.get('user')} 尝试以 {username} 的身份发送事件")
+        return False
+    return True
+
+@socketio.on('disconnect')
+def on_disconnect(reason=None):
+    """客户端断开连接"""
+    metrics.SOCKET_CONNECTIONS.dec()
+
 @socketio.on('join')
 def on_join(data):
     """用户加入房间"""
     username = data['username']
     friend = data['friend']
+    if not socket_user_matches(username):
+        return
     room = "_".join(sorted([username, friend]))
     join_room(room)
     # 同时加入自己的房间，用于接收未读消息更新
@@ -1557,6 +2126,30 @@ def on_join(data):
     logger.info(f"用户 {username} 加入与 {friend} 的聊天室")
     emit('status', {'msg': f'{username}加入了聊天室'})
 
+@socketio.on('join_user')
+def on_join_user(data):
+    """用户只加入自己的房间（首页用于接收未读消息更新）"""
+    username = data['username']
+    if not socket_user_matches(username):
+        return
+    join_room(username)
+    logger.info(f"用户 {username} 订阅未读消息更新")
+
+@socketio.on('join_group')
+def on_join_group(data):
+    """加入群聊房间（创建群聊或被添加为成员后，收到 group_added 时发送）"""
+    conversation_id = data.get('id') if isinstance(data, dict) else None
+    if not isinstance(conversation_id, int) or not groups.is_member(conversation_id, session.get('user')):
+        return
+    join_room(groups.room(conversation_id))
+
+@socketio.on('leave_group')
+def on_leave_group(data):
+    """离开群聊房间（退出群聊后收到 group_left 时发送）"""
+    conversation_id = data.get('id') if isinstance(data, dict) else None
+    if isinstance(conversation_id, int):
+        leave_room(groups.room(conversation_id))
+
 @socketio.on('leave')
 def on_leave(data):
     """用户离开房间"""
@@ -1574,20 +2167,31 @@ def on_send_message(data):
     sender = data['sender']
     recipient = data['recipient']
     content = data['content']
-    
-    # 保存消息到数据库
-    save_chat_message(sender, recipient, sender, content)
+    if not socket_user_matches(sender):
+        return
+    
+    # 保存消息到数据库，结果作为确认（ack）返回给客户端
+    message_id = save_chat_message(sender, recipient, sender, content)
+    if not message_id:
+        logger.error(f"通过WebSocket发送消息失败：{sender} -> {recipient}")
+        return {'ok': False, 'msg': '消息发送失败'}
     logger.info(f"通过WebSocket发送消息：{sender} -> {recipient}")
+    return {'ok': True, 'message_id': message_id}
 
 # 排除CSRF保护的端点（API和WebSocket）
 csrf.exempt(api_login)
 csrf.exempt(api_send_message)
 csrf.exempt(upload_image)
 csrf.exempt(upload_file)
+csrf.exempt(api_upload_init)
+csrf.exempt(api_upload_chunk)
+csrf.exempt(api_upload_complete)
+csrf.exempt(api_upload_abort)
 csrf.exempt(get_file_info)
 csrf.exempt(api_add_friend)
 csrf.exempt(api_remove_friend)
 csrf.exempt(api_mark_messages_as_read)
+csrf.exempt(api_mark_all_messages_as_read)
 csrf.exempt(api_clear_chat_history)
 csrf.exempt(api_change_username)
 csrf.exempt(api_change_password)
@@ -1598,6 +2202,13 @@ csrf.exempt(upvote_feedback)
 csrf.exempt(cancel_upvote_feedback)
 csrf.exempt(delete_feedback)
 csrf.exempt(check_op_status)
+csrf.exempt(api_send_announcement)
+csrf.exempt(api_mark_announcements_read)
+csrf.exempt(api_create_group)
+csrf.exempt(api_add_group_members)
+csrf.exempt(api_leave_group)
+csrf.exempt(api_send_group_message)
+csrf.exempt(api_mark_group_read)
 
 if __name__ == '__main__':
     # 初始化数据库
@@ -1606,55 +2217,3 @@ if __name__ == '__main__':
     # 启动服务器（包括WebSocket支持）
     socketio.run(app, host='0.0.0.0', port=80, debug=True, allow_unsafe_werkzeug=True)
     # app.run(host='0.0.0.0', port=80, debug=True)
-
-def is_user_involved_in_image_chat(current_user, image_id):
-    """检查用户是否参与了包含该图片的聊天"""
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # 查找包含该图片的消息
-        cursor.execute('''
-            SELECT sender, recipient 
-            FROM messages 
-            WHERE content = ?
-        ''', (f"Pic_{image_id}",))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result:
-            sender, recipient = result
-            # 如果用户是发送者或接收者，则有权查看图片
-            return current_user == sender or current_user == recipient
-            
-        return False
-    except Exception as e:
-        logger.error(f"检查用户聊天权限时出错: {e}")
-        return False
-
-def is_user_involved_in_file_chat(current_user, file_id):
-    """检查用户是否参与了包含该文件的聊天"""
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        # 查找包含该文件的消息
-        cursor.execute('''
-            SELECT sender, recipient 
-            FROM messages 
-            WHERE content = ?
-        ''', (f"File_{file_id}",))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        if result:
-            sender, recipient = result
-            # 如果用户是发送者或接收者，则有权查看文件
-            return current_user == sender or current_user == recipient
-            
-        return False
-    except Exception as e:
-        logger.error(f"检查用户文件聊天权限时出错: {e}")
-        return False
\ No newline at end of file
@@ -0,0 +1,128 @@
+"""按内容寻址的上传文件存储
+
+上传的图片和文件按 SHA-256 保存在分片目录中：<上传目录>/ab/cd/<sha256>，
+images/files 表的 filename 列保存相对路径，sha256 列指向 blobs 表中的记录。
+blobs.refcount 由触发器随 images/files 记录的增删自动维护（见 migrations.py 第7步）。
+
+相同内容只保存一份：再次上传相同的字节时丢弃临时文件，不再写入；
+删除记录后引用计数归零的文件（连同缩略图）在事务提交后才删除（删除时重新确认没有新的引用）。
+写入、释放和删除都在数据库写事务内进行，多个进程之间由SQLite的写锁串行化。
+
+旧版本以 uuid 文件名平铺保存的上传（sha256 为 NULL）用 migrate_uploads.py 离线迁移。
+"""
+import hashlib
+import os
+import uuid
+import logging
+from datetime import datetime
+
+import db
+import thumbnails
+
+logger = logging.getLogger('chat_app.blobs')
+
+_READ_BLOCK = 64 * 1024
+
+
+class BlobTooLarge(Exception):
+    """写入的内容超过大小上限"""
+
+
+class BlobStore:
+    """内容寻址的文件存储"""
+
+    def __init__(self, upload_dir):
+        self.root = str(upload_dir)
+        # 临时文件与分块上传放在同一目录，保证 os.replace 不跨文件系统
+        self.tmp_dir = os.path.join(self.root, '.partial')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @staticmethod
+    def relative_path(digest):
+        """文件相对于上传目录的路径，即 images/files 表中的 filename"""
+        return f'{digest[:2]}/{digest[2:4]}/{digest}'
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def write_temp(self, stream, max_size=None):
+        """把流写入临时文件并计算摘要，返回 (临时文件路径, SHA-256, 字节数)
+
+        写入超过 max_size 字节时停止读取，删除临时文件并抛出 BlobTooLarge。
+        """
+        temp_path = os.path.join(self.tmp_dir, f'{uuid.uuid4().hex}.tmp')
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                while True:
+                    block = stream.read(_READ_BLOCK)
+                    if not block:
+                        break
+                    f.write(block)
+                    hasher.update(block)
+                    size += len(block)
+                    if max_size is not None and size > max_size:
+                        raise BlobTooLarge(size)
+        except BaseException:
+            _remove(temp_path)
+            raise
+        return temp_path, hasher.hexdigest(), size
+
+    def store(self, cursor, temp_path, digest, size):
+        """把临时文件保存为内容寻址的文件，返回相对路径
+
+        必须在登记 images/files 记录的同一个写事务中调用（引用计数由该记录的触发器增加）。
+        已经保存过相同内容时直接删除临时文件。
+        """
+        cursor.execute('''
+            INSERT OR IGNORE INTO blobs (sha256, size, refcount, created_at)
+            VALUES (?, ?, 0, ?)
+        ''', (digest, size, datetime.now().isoformat()))
+        final_path = self.path(digest)
+        if os.path.exists(final_path):
+            _remove(temp_path)
+            logger.info(f"文件内容已存在，跳过写入: {digest}")
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(temp_path, final_path)
+        return self.relative_path(digest)
+
+    def release_unreferenced(self, cursor):
+        """删除引用计数已归零的 blobs 记录，返回这些文件的摘要
+
+        在删除 images/files 记录的事务中调用，事务提交后把返回值交给 purge() 删除文件。
+        """
+        digests = [row[0] for row in cursor.execute(
+            'SELECT sha256 FROM blobs WHERE refcount <= 0').fetchall()]
+        if digests:
+            cursor.executemany('DELETE FROM blobs WHERE sha256 = ?', [(d,) for d in digests])
+        return digests
+
+    def purge(self, digests):
+        """删除已释放的文件
+
+        在新的写事务中重新确认没有记录引用（期间可能有人上传了相同的内容），
+        持有写锁时删除，避免与 store() 交错。返回删除的文件数。
+        """
+        if not digests:
+            return 0
+        removed = 0
+        with db.transaction() as cursor:
+            for digest in digests:
+                if cursor.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (digest,)).fetchone():
+                    continue
+                path = self.path(digest)
+                if _remove(path):
+                    removed += 1
+                thumbnails.remove_variants(path)
+        logger.info(f"已删除 {removed} 个不再被引用的上传文件")
+        return removed
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
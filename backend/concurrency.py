@@ -0,0 +1,80 @@
+"""并发模式相关的辅助函数
+
+CHAT_ASYNC_MODE 决定 Flask-SocketIO 使用的异步模式：
+- threading（默认）：Werkzeug开发服务器，每个连接一个线程
+- eventlet / gevent：协程模式，由 server.py 在导入应用前完成 monkey patch
+
+协程模式下，socket、time.sleep、threading 等都会被替换为协作式实现，
+但 bcrypt 这类在C扩展中执行的CPU密集调用仍会阻塞整个事件循环，
+需要通过 run_blocking() 放到原生线程池中执行。
+"""
+import os
+import time
+import threading
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+ASYNC_MODE = os.environ.get('CHAT_ASYNC_MODE', 'threading')
+
+# 协程模式（eventlet/gevent）
+COOPERATIVE = ASYNC_MODE in ('eventlet', 'gevent')
+
+
+def run_blocking(func, *args, **kwargs):
+    """执行阻塞调用；协程模式下放到原生线程池，等待期间让出事件循环"""
+    if ASYNC_MODE == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(func, *args, **kwargs)
+    if ASYNC_MODE == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    return func(*args, **kwargs)
+
+
+# 在 forkserver 中预先导入的模块（各进程池的 module）
+_forkserver_preload = set()
+
+
+def process_pool(workers, module):
+    """创建进程池，把CPU密集的计算放到子进程中执行；module 为子进程中执行的函数所在的模块
+
+    子进程由 forkserver 启动：forkserver 是单独启动的、没有其他线程的解释器，子进程从它 fork 出来，
+    不会复制应用进程中被其他线程持有的锁（日志、连接池、指标等）和协程模式的事件循环状态。
+    module 在 forkserver 启动时预先导入，子进程不必各自导入。
+    子进程会以 __mp_main__ 的名字重新导入主模块，因此入口脚本在被这样导入时不能启动应用（见 server.py）。
+    """
+    _forkserver_preload.add(module)
+    context = multiprocessing.get_context('forkserver')
+    # 只在 forkserver 启动前生效；之后创建的进程池，其子进程在第一次执行任务时再导入模块
+    context.set_forkserver_preload(sorted(_forkserver_preload))
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_exit_with_parent)
+
+
+def _exit_with_parent():
+    """子进程在应用进程退出（包括被信号终止、来不及关闭进程池）后自行退出，不留下孤儿进程"""
+    sentinel = multiprocessing.parent_process().sentinel
+
+    def watch():
+        multiprocessing.connection.wait([sentinel])
+        os._exit(0)
+
+    threading.Thread(target=watch, name='parent-watch', daemon=True).start()
+
+
+def wait_future(future, timeout):
+    """等待 Future（进程池任务、写入队列等）的结果；协程模式下轮询，等待期间让出事件循环，
+    超时取消尚未开始的任务并抛出 TimeoutError
+    """
+    if COOPERATIVE:
+        deadline = time.monotonic() + timeout
+        while not future.done():
+            if time.monotonic() > deadline:
+                future.cancel()
+                raise TimeoutError('等待任务超时')
+            time.sleep(0.01)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise
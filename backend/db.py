@@ -0,0 +1,254 @@
+"""SQLite连接管理
+
+所有数据库访问都通过本模块获取连接，不再在每个函数里单独 sqlite3.connect：
+- 连接池复用连接，避免每次请求重新打开数据库文件
+- 使用WAL日志模式，读操作不会被写操作阻塞
+- 通过上下文管理器归还连接、提交或回滚事务，异常时不会泄漏连接
+
+协程模式（eventlet/gevent）下，SQLite在C代码中等待锁会阻塞整个事件循环，
+因此 configure(cooperative=True) 时不使用SQLite的busy_timeout，
+而是在Python中重试获取写锁，重试间隔的 time.sleep 会让出事件循环
+（启动时的迁移使用 blocking_connection()，在SQLite中等待锁）。
+
+用法：
+    with db.connection() as conn:          # 只读查询（自动提交模式）
+        conn.execute('SELECT ...')
+
+    with db.transaction() as cursor:       # 写操作，正常退出时提交，异常时回滚
+        cursor.execute('INSERT ...')
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger('chat_app.db')
+
+# 连接池大小和等待时间可通过环境变量调整
+POOL_SIZE = int(os.environ.get('CHAT_DB_POOL_SIZE', '16'))
+POOL_TIMEOUT = float(os.environ.get('CHAT_DB_POOL_TIMEOUT', '10'))
+# 数据库被锁定时的等待时间（毫秒）
+BUSY_TIMEOUT_MS = int(os.environ.get('CHAT_DB_BUSY_TIMEOUT_MS', '5000'))
+# 页缓存大小（KB），负数表示按KB计算
+CACHE_SIZE_KB = int(os.environ.get('CHAT_DB_CACHE_SIZE_KB', '16384'))
+# 同步级别：WAL模式下NORMAL只在检查点时fsync；需要每次提交都落盘时设为FULL
+SYNCHRONOUS = os.environ.get('CHAT_DB_SYNCHRONOUS', 'NORMAL').upper()
+# 内存映射大小（字节）
+MMAP_SIZE = int(os.environ.get('CHAT_DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+
+
+class TimedCursor(sqlite3.Cursor):
+    """记录每条语句执行耗时的游标（SELECT只计到取得第一行，后续fetch不计入）"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe_db_statement(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe_db_statement(sql, time.perf_counter() - started)
+
+
+class TimedConnection(sqlite3.Connection):
+    """所有语句都通过 TimedCursor 执行的连接"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        # sqlite3.Connection.execute 不经过 cursor()，需要显式使用计时游标
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            metrics.observe_db_statement('COMMIT', time.perf_counter() - started)
+
+    def rollback(self):
+        started = time.perf_counter()
+        try:
+            super().rollback()
+        finally:
+            metrics.observe_db_statement('ROLLBACK', time.perf_counter() - started)
+
+
+def _connect(db_file, busy_timeout_ms):
+    """创建一个新连接并设置PRAGMA"""
+    # isolation_level=None：由 transaction() 显式控制事务边界，读查询不会隐式开启事务
+    conn = sqlite3.connect(db_file, timeout=busy_timeout_ms / 1000,
+                           isolation_level=None, check_same_thread=False,
+                           factory=TimedConnection if metrics.ENABLED else sqlite3.Connection)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA synchronous={SYNCHRONOUS}')
+    conn.execute(f'PRAGMA busy_timeout={busy_timeout_ms}')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+
+class ConnectionPool:
+    """简单的SQLite连接池，按需创建连接，最多 size 个"""
+
+    def __init__(self, db_file, size=POOL_SIZE, timeout=POOL_TIMEOUT, cooperative=False):
+        self.db_file = str(db_file)
+        self.size = size
+        self.timeout = timeout
+        self.cooperative = cooperative
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取出一个连接，池中没有空闲连接且已达上限时等待"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return _connect(self.db_file, 0 if self.cooperative else BUSY_TIMEOUT_MS)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('数据库连接池已耗尽')
+
+    def release(self, conn):
+        """归还连接，未结束的事务会被回滚"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # 连接已损坏，丢弃
+            self._discard(conn)
+            return
+        self._idle.put(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def close_all(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure(db_file, **kwargs):
+    """设置数据库文件并重建连接池，参数见 ConnectionPool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+        _pool = ConnectionPool(db_file, **kwargs)
+    logger.info(f"数据库连接池已配置: {db_file}")
+
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError('数据库未配置，请先调用 db.configure()')
+    return _pool
+
+
+@contextmanager
+def connection():
+    """从连接池借出一个连接，退出时归还"""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+@contextmanager
+def blocking_connection():
+    """打开一个单独的、等待锁时由SQLite阻塞（busy_timeout）的连接，退出时关闭
+
+    用于启动时的数据库迁移：协程模式下连接池的连接不使用busy_timeout，
+    多个进程同时启动时迁移的 BEGIN IMMEDIATE、建表和设置WAL都会立即因为锁而失败；
+    启动时还没有开始处理请求，在SQLite中阻塞等待其他进程完成迁移即可。
+    """
+    conn = _connect(get_pool().db_file, BUSY_TIMEOUT_MS)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def _begin(conn, statement, cooperative):
+    """开启事务；协程模式下在Python中重试，等待期间让出事件循环"""
+    if not cooperative:
+        conn.execute(statement)
+        return
+    deadline = time.monotonic() + BUSY_TIMEOUT_MS / 1000
+    delay = 0.001
+    while True:
+        try:
+            conn.execute(statement)
+            return
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) or time.monotonic() >= deadline:
+                raise
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+@contextmanager
+def transaction(immediate=True):
+    """在一个事务中执行写操作，正常退出时提交，异常时回滚
+
+    默认使用 BEGIN IMMEDIATE 在事务开始时获取写锁，
+    避免读后写时两个事务互相等待导致的 SQLITE_BUSY。
+    """
+    pool = get_pool()
+    with connection() as conn:
+        _begin(conn, 'BEGIN IMMEDIATE' if immediate else 'BEGIN', pool.cooperative)
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
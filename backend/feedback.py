@@ -0,0 +1,270 @@
+"""反馈板
+
+反馈保存在 feedback 表中（见 migrations.py 第10步），不再每次请求都读写整个 feedback.json：
+- 点赞记录在 feedback_upvotes 中，(feedback_id, user) 唯一，重复点赞由唯一约束拒绝；
+  点赞数 feedback.upvotes 由触发器随点赞的增删在同一事务中更新，并发点赞不会丢失计数
+- 反馈ID中的序号按（位置, 日期）保存在 feedback_sequences 中，用 UPSERT ... RETURNING 原子地递增，
+  不需要遍历全部反馈计数，并发提交也不会得到相同的ID
+- 旧版本的 data/feedback.json 在启动时导入一次（import_json()），导入记录保存在 feedback_imports 中
+
+反馈列表（list_page()）在数据库中完成筛选、排序和分页：按点赞数或时间排序，用游标（上一页最后一项的排序键）
+取下一页，每项只返回点赞数和当前用户是否已点赞（userUpvoted），不再返回完整的点赞用户列表。
+"""
+import json
+import sqlite3
+import logging
+from datetime import datetime
+
+import db
+
+logger = logging.getLogger('chat_app.feedback')
+
+TYPE_CODES = {
+    "bug": "CB",
+    "suggestion": "CA",
+    "plan": "CP"
+}
+
+VALID_STATUSES = ('', 'completed', 'partial', 'alternative', 'impossible', 'failed')
+
+# 列表的排序方式：点赞数从多到少（同票数按提交顺序），或按时间从新到旧
+SORTS = ('upvotes', 'time')
+# 状态筛选中表示"未设置状态"的值
+STATUS_UNSET = 'unset'
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+_COLUMNS = 'id, type, location, time, content, author, upvotes, status, status_note'
+
+
+class AlreadyUpvoted(Exception):
+    """用户已经点赞过该反馈"""
+
+
+class NotUpvoted(Exception):
+    """用户还没有点赞该反馈"""
+
+
+def _next_serial(cursor, location, day):
+    """（位置, 日期）的下一个序号"""
+    cursor.execute('''
+        INSERT INTO feedback_sequences (location, day, last) VALUES (?, ?, 1)
+        ON CONFLICT (location, day) DO UPDATE SET last = last + 1
+        RETURNING last
+    ''', (location, day))
+    return cursor.fetchone()[0]
+
+
+def format_id(feedback_type, location, time_str, serial):
+    """反馈ID：类型代码-位置-时间-4位序号（同一位置同一天内递增，不区分类型）"""
+    type_code = TYPE_CODES.get(feedback_type, "CX")
+    return f"{type_code}-{location}-{time_str}-{serial:04d}"
+
+
+def create(feedback_type, location, content, author, now=None):
+    """保存一条新反馈，返回反馈ID"""
+    time_str = (now or datetime.now()).strftime("%Y%m%d%H%M%S")
+    with db.transaction() as cursor:
+        serial = _next_serial(cursor, location, time_str[:8])
+        feedback_id = format_id(feedback_type, location, time_str, serial)
+        cursor.execute('''
+            INSERT INTO feedback (id, type, location, time, content, author)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (feedback_id, feedback_type, location, time_str, content, author))
+    return feedback_id
+
+
+def _to_item(row):
+    """数据库行转换为反馈项（字段与原来 feedback.json 中的相同，不包括点赞用户列表）"""
+    feedback_id, feedback_type, location, time_str, content, author, upvotes, status, status_note = row
+    item = {
+        "id": feedback_id,
+        "type": feedback_type,
+        "location": location,
+        "time": time_str,
+        "content": content,
+        "author": author,
+        "upvotes": upvotes,
+    }
+    # 从未设置过状态的反馈没有 status 和 statusNote 字段
+    if status is not None:
+        item["status"] = status
+        item["statusNote"] = status_note or ''
+    return item
+
+
+def _encode_cursor(sort, upvotes, seq):
+    return f"{upvotes}.{seq}" if sort == 'upvotes' else str(seq)
+
+
+def _decode_cursor(sort, cursor):
+    """解析游标，格式错误时抛出 ValueError"""
+    if sort == 'upvotes':
+        upvotes, seq = cursor.split('.')
+        return int(upvotes), int(seq)
+    return (int(cursor),)
+
+
+def list_page(user, feedback_type=None, location=None, status=None, sort='upvotes',
+              limit=DEFAULT_PAGE_SIZE, cursor=None):
+    """筛选、排序后的一页反馈，返回 (反馈项列表, 下一页的游标)，没有下一页时游标为 None
+
+    status 为 STATUS_UNSET 时只返回未设置状态的反馈；cursor 为上一页返回的游标，格式错误时抛出 ValueError。
+    """
+    if sort not in SORTS:
+        raise ValueError(f"不支持的排序方式: {sort}")
+    conditions = []
+    params = [user]
+    if feedback_type:
+        conditions.append('f.type = ?')
+        params.append(feedback_type)
+    if location:
+        conditions.append('f.location = ?')
+        params.append(location)
+    if status == STATUS_UNSET:
+        conditions.append("(f.status IS NULL OR f.status = '')")
+    elif status:
+        conditions.append('f.status = ?')
+        params.append(status)
+    if cursor:
+        key = _decode_cursor(sort, cursor)
+        if sort == 'upvotes':
+            conditions.append('(f.upvotes < ? OR (f.upvotes = ? AND f.seq > ?))')
+            params.extend([key[0], key[0], key[1]])
+        else:
+            conditions.append('f.seq < ?')
+            params.append(key[0])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'f.upvotes DESC, f.seq' if sort == 'upvotes' else 'f.seq DESC'
+    columns = ', '.join(f'f.{column.strip()}' for column in _COLUMNS.split(','))
+
+    with db.connection() as conn:
+        rows = conn.execute(f'''
+            SELECT {columns}, f.seq,
+                   EXISTS (SELECT 1 FROM feedback_upvotes u WHERE u.feedback_id = f.id AND u.user = ?)
+            FROM feedback f
+            {where}
+            ORDER BY {order}
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(sort, rows[-1][6], rows[-1][9])
+    items = []
+    for row in rows:
+        item = _to_item(row[:9])
+        item["userUpvoted"] = bool(row[10])
+        items.append(item)
+    return items, next_cursor
+
+
+def get_author(feedback_id):
+    """反馈的发送者，反馈不存在时返回 None"""
+    with db.connection() as conn:
+        row = conn.execute('SELECT author FROM feedback WHERE id = ?', (feedback_id,)).fetchone()
+    return row[0] if row else None
+
+
+def set_status(feedback_id, status, note):
+    """设置反馈的状态和说明，反馈不存在时返回 False"""
+    with db.transaction() as cursor:
+        cursor.execute('UPDATE feedback SET status = ?, status_note = ? WHERE id = ?',
+                       (status, note, feedback_id))
+        return cursor.rowcount > 0
+
+
+def _upvotes(cursor, feedback_id):
+    cursor.execute('SELECT upvotes FROM feedback WHERE id = ?', (feedback_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def upvote(feedback_id, user):
+    """点赞，返回点赞后的点赞数；反馈不存在时返回 None，已经点赞过时抛出 AlreadyUpvoted"""
+    with db.transaction() as cursor:
+        if _upvotes(cursor, feedback_id) is None:
+            return None
+        try:
+            cursor.execute('INSERT INTO feedback_upvotes (feedback_id, user, created_at) VALUES (?, ?, ?)',
+                           (feedback_id, user, datetime.now().isoformat()))
+        except sqlite3.IntegrityError:
+            raise AlreadyUpvoted(feedback_id)
+        return _upvotes(cursor, feedback_id)
+
+
+def cancel_upvote(feedback_id, user):
+    """取消点赞，返回取消后的点赞数；反馈不存在时返回 None，还没有点赞时抛出 NotUpvoted"""
+    with db.transaction() as cursor:
+        if _upvotes(cursor, feedback_id) is None:
+            return None
+        cursor.execute('DELETE FROM feedback_upvotes WHERE feedback_id = ? AND user = ?', (feedback_id, user))
+        if cursor.rowcount == 0:
+            raise NotUpvoted(feedback_id)
+        return _upvotes(cursor, feedback_id)
+
+
+def delete(feedback_id):
+    """删除反馈（点赞记录由触发器删除），反馈不存在时返回 False"""
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM feedback WHERE id = ?', (feedback_id,))
+        return cursor.rowcount > 0
+
+
+def _parse_serial(feedback_id):
+    tail = feedback_id.rsplit('-', 1)[-1]
+    return int(tail) if tail.isascii() and tail.isdigit() else 0
+
+
+def import_json(path):
+    """导入旧版本的反馈文件（每个文件只导入一次），返回导入的反馈数，已导入或文件不存在时返回0
+
+    在一个事务中完成：反馈按文件中的顺序插入，点赞记录按 upvoted_by 的顺序插入（点赞数由触发器计算），
+    每个（位置, 日期）的序号从文件中已用过的最大序号继续，新反馈不会与旧反馈的ID重复。
+    导入后文件保持不变，不再读取。
+    """
+    source = path.name
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            items = json.load(f).get("feedback", [])
+    except FileNotFoundError:
+        return 0
+
+    with db.transaction() as cursor:
+        cursor.execute('SELECT 1 FROM feedback_imports WHERE source = ?', (source,))
+        if cursor.fetchone():
+            return 0
+
+        serials = {}
+        imported = 0
+        for item in items:
+            status = item.get("status")
+            cursor.execute('''
+                INSERT OR IGNORE INTO feedback (id, type, location, time, content, author, status, status_note)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (item["id"], item["type"], item["location"], item["time"], item["content"], item["author"],
+                  status, item.get("statusNote", '') if status is not None else None))
+            if cursor.rowcount == 0:
+                continue
+            imported += 1
+            cursor.executemany('''
+                INSERT OR IGNORE INTO feedback_upvotes (feedback_id, user, created_at) VALUES (?, ?, ?)
+            ''', [(item["id"], user, item["time"]) for user in item.get("upvoted_by", [])])
+
+            # 原来的序号是同一位置当天已有的反馈数+1，取计数和ID中序号的较大者
+            key = (item["location"], item["time"][:8])
+            count, max_serial = serials.get(key, (0, 0))
+            serials[key] = (count + 1, max(max_serial, _parse_serial(item["id"])))
+
+        for (location, day), (count, max_serial) in serials.items():
+            cursor.execute('''
+                INSERT INTO feedback_sequences (location, day, last) VALUES (?, ?, ?)
+                ON CONFLICT (location, day) DO UPDATE SET last = MAX(last, excluded.last)
+            ''', (location, day, max(count, max_serial)))
+
+        cursor.execute('INSERT INTO feedback_imports (source, count, imported_at) VALUES (?, ?, ?)',
+                       (source, imported, datetime.now().isoformat()))
+
+    logger.info(f"已从 {path} 导入 {imported} 条反馈，之后反馈保存在数据库中，该文件不再使用")
+    return imported
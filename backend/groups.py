@@ -0,0 +1,214 @@
+"""群聊
+
+群聊保存在 conversations 和 conversation_members 中（见 migrations.py 第13步），消息仍然写入 messages，
+conversation_id 为所在群聊、recipient 为空字符串：
+- 每条消息只保存一份，不为每个成员复制（读取时按群聊查询）
+- 成员的已读位置保存在 conversation_members.read_count 中，未读数 = 群聊的 message_count - read_count；
+  发送一条消息只更新群聊的计数和发送者自己的已读位置，写入量与群聊人数无关
+- 每条消息只向群聊房间（room()）推送一次，事件中的 seq 为该消息之后的 message_count，
+  客户端据此在本地递增未读数
+
+发送者发送消息时视为已读群聊中此前的全部消息。
+"""
+import os
+from datetime import datetime
+
+import db
+
+MAX_NAME_LENGTH = 50
+MAX_MEMBERS = int(os.environ.get('CHAT_GROUP_MAX_MEMBERS', '5000'))
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+_COLUMNS = 'c.id, c.name, c.creator, c.created_at, c.member_count, c.message_count, c.last_message_id'
+
+
+def room(conversation_id):
+    """群聊的 WebSocket 房间名"""
+    return f'group:{conversation_id}'
+
+
+class TooManyMembers(Exception):
+    """群聊人数超过 MAX_MEMBERS"""
+
+
+def _to_client(row, read_count=None):
+    conversation_id, name, creator, created_at, member_count, message_count, last_message_id = row
+    group = {
+        'id': conversation_id,
+        'name': name,
+        'creator': creator,
+        'createdAt': created_at,
+        'memberCount': member_count,
+        'messageCount': message_count,
+        'lastMessageId': last_message_id,
+    }
+    if read_count is not None:
+        group['unread'] = message_count - read_count
+    return group
+
+
+def _insert_members(cursor, conversation_id, users, joined_at):
+    """加入成员（已是成员的跳过），新成员从当前的消息数开始计算未读，返回新加入的成员
+
+    加入后人数会超过 MAX_MEMBERS 时在写入前抛出 TooManyMembers。
+    """
+    cursor.execute('SELECT member_count, message_count FROM conversations WHERE id = ?', (conversation_id,))
+    member_count, message_count = cursor.fetchone()
+    existing = set()
+    users = list(users)
+    # 按 SQLite 变量个数上限分批查询已是成员的用户
+    for start in range(0, len(users), 500):
+        chunk = users[start:start + 500]
+        cursor.execute(f'''
+            SELECT user FROM conversation_members
+            WHERE conversation_id = ? AND user IN ({', '.join('?' * len(chunk))})
+        ''', (conversation_id, *chunk))
+        existing.update(row[0] for row in cursor.fetchall())
+    added = [user for user in users if user not in existing]
+    if member_count + len(added) > MAX_MEMBERS:
+        raise TooManyMembers(conversation_id)
+    cursor.executemany('''
+        INSERT INTO conversation_members (conversation_id, user, joined_at, read_count)
+        VALUES (?, ?, ?, ?)
+    ''', [(conversation_id, user, joined_at, message_count) for user in added])
+    return added
+
+
+def create(creator, name, members):
+    """创建群聊（创建者自动加入），返回群聊的客户端格式；人数超过 MAX_MEMBERS 时抛出 TooManyMembers"""
+    created_at = datetime.now().isoformat()
+    with db.transaction() as cursor:
+        cursor.execute('INSERT INTO conversations (name, creator, created_at) VALUES (?, ?, ?)',
+                       (name, creator, created_at))
+        conversation_id = cursor.lastrowid
+        _insert_members(cursor, conversation_id, dict.fromkeys([creator, *members]), created_at)
+        cursor.execute(f'SELECT {_COLUMNS} FROM conversations c WHERE c.id = ?', (conversation_id,))
+        return _to_client(cursor.fetchone(), read_count=0)
+
+
+def get(conversation_id):
+    """群聊的客户端格式（不含未读数），不存在时返回 None"""
+    with db.connection() as conn:
+        row = conn.execute(f'SELECT {_COLUMNS} FROM conversations c WHERE c.id = ?', (conversation_id,)).fetchone()
+    return _to_client(row) if row else None
+
+
+def is_member(conversation_id, user):
+    with db.connection() as conn:
+        row = conn.execute('SELECT 1 FROM conversation_members WHERE conversation_id = ? AND user = ?',
+                           (conversation_id, user)).fetchone()
+    return row is not None
+
+
+def conversation_ids(user):
+    """用户加入的全部群聊ID"""
+    with db.connection() as conn:
+        return [row[0] for row in conn.execute(
+            'SELECT conversation_id FROM conversation_members WHERE user = ?', (user,))]
+
+
+def list_for(user):
+    """用户加入的群聊（最近有消息的在前），每个群聊带未读数"""
+    with db.connection() as conn:
+        rows = conn.execute(f'''
+            SELECT {_COLUMNS}, m.read_count
+            FROM conversation_members m
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE m.user = ?
+            ORDER BY c.last_message_id DESC, c.id DESC
+        ''', (user,)).fetchall()
+    return [_to_client(row[:7], read_count=row[7]) for row in rows]
+
+
+def members(conversation_id):
+    """群聊成员（按加入顺序）"""
+    with db.connection() as conn:
+        return [row[0] for row in conn.execute('''
+            SELECT user FROM conversation_members WHERE conversation_id = ? ORDER BY joined_at, user
+        ''', (conversation_id,))]
+
+
+def add_members(conversation_id, adder, users):
+    """由成员 adder 加入成员，返回新加入的成员；adder 不是成员（例如已退出群聊）时返回 None，
+    人数超过 MAX_MEMBERS 时抛出 TooManyMembers（不加入任何人）
+    """
+    with db.transaction() as cursor:
+        cursor.execute('SELECT 1 FROM conversation_members WHERE conversation_id = ? AND user = ?',
+                       (conversation_id, adder))
+        if cursor.fetchone() is None:
+            return None
+        return _insert_members(cursor, conversation_id, dict.fromkeys(users), datetime.now().isoformat())
+
+
+def remove_member(conversation_id, user):
+    """退出群聊，不是成员时返回 False"""
+    with db.transaction() as cursor:
+        cursor.execute('DELETE FROM conversation_members WHERE conversation_id = ? AND user = ?',
+                       (conversation_id, user))
+        return cursor.rowcount > 0
+
+
+def send(conversation_id, sender, message_type, content, attachment_id=None):
+    """在群聊中保存一条消息，返回 (消息ID, 发送后的 message_count, 时间)；发送者不是成员时返回 None
+
+    message_type、content 和 attachment_id 与一对一消息相同（见 message_types.py）。
+    """
+    timestamp = datetime.now().isoformat()
+    with db.transaction() as cursor:
+        cursor.execute('SELECT 1 FROM conversation_members WHERE conversation_id = ? AND user = ?',
+                       (conversation_id, sender))
+        if cursor.fetchone() is None:
+            return None
+        cursor.execute('''
+            INSERT INTO messages (sender, recipient, type, content, attachment_id, timestamp, conversation_id)
+            VALUES (?, '', ?, ?, ?, ?, ?)
+        ''', (sender, message_type, content, attachment_id, timestamp, conversation_id))
+        message_id = cursor.lastrowid
+        if attachment_id is not None:
+            cursor.execute('''
+                INSERT OR IGNORE INTO message_attachments (message_id, kind, attachment_id)
+                VALUES (?, ?, ?)
+            ''', (message_id, message_type, attachment_id))
+        cursor.execute('''
+            UPDATE conversations SET message_count = message_count + 1, last_message_id = ?
+            WHERE id = ?
+            RETURNING message_count
+        ''', (message_id, conversation_id))
+        seq = cursor.fetchone()[0]
+        cursor.execute('''
+            UPDATE conversation_members SET read_count = ?, last_read_message_id = ?
+            WHERE conversation_id = ? AND user = ?
+        ''', (seq, message_id, conversation_id, sender))
+    return message_id, seq, timestamp
+
+
+def history(conversation_id, before=None, limit=DEFAULT_PAGE_SIZE):
+    """群聊消息（从新到旧），返回 ([(ID, 发送者, 类型, 正文, 附件ID, 时间)], 下一页的游标)"""
+    params = [conversation_id]
+    condition = ''
+    if before is not None:
+        condition = 'AND id < ?'
+        params.append(before)
+    with db.connection() as conn:
+        rows = conn.execute(f'''
+            SELECT id, sender, type, content, attachment_id, timestamp
+            FROM messages
+            WHERE conversation_id = ? {condition}
+            ORDER BY id DESC
+            LIMIT ?
+        ''', params + [limit + 1]).fetchall()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def mark_read(conversation_id, user):
+    """把成员的已读位置推进到最新消息，不是成员时返回 False"""
+    with db.transaction() as cursor:
+        cursor.execute('''
+            UPDATE conversation_members
+            SET read_count = (SELECT message_count FROM conversations WHERE id = ?),
+                last_read_message_id = (SELECT last_message_id FROM conversations WHERE id = ?)
+            WHERE conversation_id = ? AND user = ?
+        ''', (conversation_id, conversation_id, conversation_id, user))
+        return cursor.rowcount > 0
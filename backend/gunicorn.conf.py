@@ -0,0 +1,33 @@
+"""gunicorn 配置
+
+    gunicorn -c backend/gunicorn.conf.py --chdir backend server:app
+
+环境变量：
+    CHAT_ASYNC_MODE           eventlet（默认）或 gevent
+    CHAT_HOST / CHAT_PORT     监听地址，默认 0.0.0.0:80
+    CHAT_WORKERS              工作进程数，默认 1
+    CHAT_WORKER_CONNECTIONS   每个进程的最大并发连接数，默认 1000
+"""
+import os
+
+_async_mode = os.environ.setdefault('CHAT_ASYNC_MODE', 'eventlet')
+
+bind = f"{os.environ.get('CHAT_HOST', '0.0.0.0')}:{os.environ.get('CHAT_PORT', '80')}"
+
+# Socket.IO 的房间只存在于单个进程内，多进程部署需要消息队列（CHAT_MESSAGE_QUEUE）和粘性会话；
+# gunicorn 的多个 worker 共享同一端口，无法保证粘性会话，多进程时应启动多个实例并由 nginx ip_hash 分流（见README）
+workers = int(os.environ.get('CHAT_WORKERS', '1'))
+worker_connections = int(os.environ.get('CHAT_WORKER_CONNECTIONS', '1000'))
+
+if _async_mode == 'gevent':
+    # gevent 需要支持 WebSocket 的 worker
+    worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+else:
+    worker_class = 'eventlet'
+
+# 长连接（WebSocket/长轮询）不应被超时杀掉
+timeout = 0
+graceful_timeout = 30
+reload = False
+accesslog = None
+errorlog = '-'
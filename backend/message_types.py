@@ -0,0 +1,142 @@
+"""消息类型
+
+messages 表用 type 列区分消息类型，图片/文件消息的ID保存在 attachment_id 列，content 只保存正文：
+- text：文字消息，content 为文字
+- image：图片消息，attachment_id 为 images.id
+- file：文件消息，attachment_id 为 files.id
+- music：音乐分享，content 为歌曲信息（JSON）
+
+客户端收发的消息内容仍然使用原来的前缀格式（Pic_<ID>、File_<ID>、Music_<JSON>，文字消息没有前缀），
+只在接口边界转换：parse_client_content() 解析客户端发来的内容，to_client_content() 生成返回给客户端的内容。
+
+旧版本把类型写在 content 的前缀中（Chat_文字、Pic_<ID>、Chat_File_<ID>、Chat_Music_<JSON>），
+这些行的 type 为 NULL，由后台线程分批改写（见 start_backfill()）；改写完成前读取时按前缀解析。
+"""
+import json
+import threading
+import time
+import logging
+
+import db
+
+logger = logging.getLogger('chat_app.message_types')
+
+TEXT = 'text'
+IMAGE = 'image'
+FILE = 'file'
+MUSIC = 'music'
+
+# 带附件的消息类型在客户端内容中的前缀
+_ATTACHMENT_PREFIXES = {IMAGE: 'Pic_', FILE: 'File_'}
+_MUSIC_PREFIX = 'Music_'
+
+# 后台改写旧消息：每批行数和批次间隔（秒），每批是一个短事务，不会长时间占用写锁
+BACKFILL_BATCH_SIZE = 500
+BACKFILL_PAUSE = 0.05
+
+
+def _parse_id(text):
+    return int(text) if text.isascii() and text.isdigit() else None
+
+
+def parse_client_content(content):
+    """解析客户端发来的消息内容，返回 (类型, 正文, 附件ID)"""
+    for message_type, prefix in _ATTACHMENT_PREFIXES.items():
+        if content.startswith(prefix):
+            attachment_id = _parse_id(content[len(prefix):])
+            if attachment_id is not None:
+                return message_type, '', attachment_id
+    if content.startswith(_MUSIC_PREFIX):
+        return MUSIC, content[len(_MUSIC_PREFIX):], None
+    return TEXT, content, None
+
+
+def to_client_content(message_type, content, attachment_id):
+    """生成返回给客户端的消息内容（与改为类型列之前的格式一致）"""
+    if message_type is None:
+        message_type, content, attachment_id = parse_legacy_content(content)
+    if message_type in _ATTACHMENT_PREFIXES:
+        return f'{_ATTACHMENT_PREFIXES[message_type]}{attachment_id}'
+    if message_type == MUSIC:
+        return _MUSIC_PREFIX + content
+    return content
+
+
+def music_song_id(client_content):
+    """音乐分享消息（客户端内容格式）中的歌曲ID，不是音乐消息或无法解析时返回 None"""
+    if not client_content.startswith(_MUSIC_PREFIX):
+        return None
+    try:
+        info = json.loads(client_content[len(_MUSIC_PREFIX):])
+    except ValueError:
+        return None
+    song_id = info.get('id') if isinstance(info, dict) else None
+    if isinstance(song_id, str) and song_id.isascii() and song_id.isdigit():
+        return int(song_id)
+    return song_id if type(song_id) is int else None
+
+
+def parse_legacy_content(content):
+    """解析旧版本带前缀保存的消息内容，返回 (类型, 正文, 附件ID)"""
+    if content.startswith('Chat_'):
+        # 文件和音乐分享当时作为文字消息发送，前缀在 Chat_ 之后
+        return parse_client_content(content[len('Chat_'):])
+    if content.startswith('Pic_'):
+        attachment_id = _parse_id(content[len('Pic_'):])
+        if attachment_id is not None:
+            return IMAGE, '', attachment_id
+    # 其他内容原样作为文字返回（与旧版本的显示一致）
+    return TEXT, content, None
+
+
+def backfill_batch(batch_size=BACKFILL_BATCH_SIZE):
+    """改写一批 type 为 NULL 的旧消息，返回改写的行数"""
+    with db.transaction() as cursor:
+        rows = cursor.execute('''
+            SELECT id, content FROM messages
+            WHERE type IS NULL
+            ORDER BY id
+            LIMIT ?
+        ''', (batch_size,)).fetchall()
+        updates = []
+        for message_id, content in rows:
+            message_type, body, attachment_id = parse_legacy_content(content)
+            updates.append((message_type, body, attachment_id, message_id))
+        # 只改写仍为旧格式的行，期间被删除或已改写的行不受影响
+        cursor.executemany('''
+            UPDATE messages SET type = ?, content = ?, attachment_id = ?
+            WHERE id = ? AND type IS NULL
+        ''', updates)
+    return len(rows)
+
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE, pause=BACKFILL_PAUSE):
+    """分批改写全部旧消息，返回改写的总行数"""
+    total = 0
+    while True:
+        count = backfill_batch(batch_size)
+        total += count
+        if count < batch_size:
+            return total
+        time.sleep(pause)
+
+
+def start_backfill():
+    """在后台线程中改写旧消息（应用正常提供服务），没有旧消息时不启动线程"""
+    with db.connection() as conn:
+        pending = conn.execute('SELECT 1 FROM messages WHERE type IS NULL LIMIT 1').fetchone()
+    if pending is None:
+        return None
+
+    def run():
+        started = time.monotonic()
+        try:
+            total = backfill()
+            logger.info(f"旧消息类型改写完成: {total} 条，耗时 {time.monotonic() - started:.1f} 秒")
+        except Exception as e:
+            logger.error(f"改写旧消息类型失败（下次启动时继续）: {e}", exc_info=True)
+
+    logger.info("开始在后台改写旧消息的类型")
+    thread = threading.Thread(target=run, name='message-type-backfill', daemon=True)
+    thread.start()
+    return thread
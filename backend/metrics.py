@@ -0,0 +1,208 @@
+"""运行指标（Prometheus文本格式）
+
+进程内记录以下指标，由 /metrics 接口输出（仅管理员可访问）：
+- chat_http_requests_total：按路由、方法、状态码统计的请求数
+- chat_http_request_duration_seconds：按路由、方法统计的请求耗时直方图
+- chat_db_statement_duration_seconds：按语句类型（SELECT/INSERT/...）统计的SQLite语句耗时直方图
+- chat_socket_events_total：按事件名统计的WebSocket推送次数（new_message、unread_update、status 等）
+- chat_socket_connections：当前连接的WebSocket客户端数
+- chat_music_cache_requests_total：音乐接口按结果统计的缓存查询数
+  （hit 命中、error_hit 命中缓存的上游错误、miss 请求上游、coalesced 等待了相同的进行中请求）
+- chat_music_upstream_duration_seconds：请求网易云音乐接口的耗时直方图（按接口和状态码）
+
+每次记录只有一次加锁和一次二分查找，开销很小，可以在生产环境常开；
+设置 CHAT_METRICS=0 可以完全关闭（SQLite语句不再计时）。
+多进程部署时每个进程分别输出自己的指标，由Prometheus按实例汇总。
+"""
+import bisect
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('CHAT_METRICS', '1') == '1'
+
+HTTP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# 语句类型标签只取这些值，其余归为OTHER，避免标签数量失控
+DB_OPERATIONS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'BEGIN', 'COMMIT', 'ROLLBACK',
+                 'SAVEPOINT', 'RELEASE', 'CREATE', 'DROP', 'PRAGMA', 'WITH'}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in items]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and not self.labelnames:
+            items = [((), 0)]
+        return [f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+                for labels, value in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=HTTP_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # 标签 -> [各桶计数（非累计，最后一个为+Inf）, 总和, 总数]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((labels, (list(counts), total, count))
+                           for labels, (counts, total, count) in self._values.items())
+        lines = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = ('le', _format_value(float(bound)))
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+HTTP_REQUESTS = Counter('chat_http_requests_total', 'HTTP请求数', ('route', 'method', 'status'))
+HTTP_DURATION = Histogram('chat_http_request_duration_seconds', 'HTTP请求耗时（秒）',
+                          ('route', 'method'), HTTP_BUCKETS)
+DB_DURATION = Histogram('chat_db_statement_duration_seconds', 'SQLite语句执行耗时（秒）',
+                        ('operation',), DB_BUCKETS)
+SOCKET_EVENTS = Counter('chat_socket_events_total', 'WebSocket推送的事件数', ('event',))
+SOCKET_CONNECTIONS = Gauge('chat_socket_connections', '当前连接的WebSocket客户端数')
+MUSIC_CACHE = Counter('chat_music_cache_requests_total', '音乐接口缓存查询数', ('endpoint', 'result'))
+MUSIC_UPSTREAM_DURATION = Histogram('chat_music_upstream_duration_seconds', '请求网易云音乐接口的耗时（秒）',
+                                    ('endpoint', 'status'), HTTP_BUCKETS)
+
+REGISTRY = [HTTP_REQUESTS, HTTP_DURATION, DB_DURATION, SOCKET_EVENTS, SOCKET_CONNECTIONS,
+            MUSIC_CACHE, MUSIC_UPSTREAM_DURATION]
+
+
+def render():
+    """输出所有指标的Prometheus文本格式"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def observe_db_statement(sql, seconds):
+    """记录一条SQLite语句的耗时"""
+    head = sql.lstrip()[:10].split(None, 1)
+    operation = head[0].upper() if head else ''
+    DB_DURATION.observe(seconds, operation if operation in DB_OPERATIONS else 'OTHER')
+
+
+def init_app(app, socketio):
+    """注册请求计时钩子（包括以未处理异常结束的请求），并统计 socketio 推送的事件"""
+    if not ENABLED:
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _remember_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    # 在 teardown 中记录：请求因未处理的异常中断（没有执行到上面的 after_request）时也会执行，按500统计
+    @app.teardown_request
+    def _record_request(exc):
+        started = g.pop('metrics_started', None)
+        status = g.pop('metrics_status', 500)
+        if started is not None:
+            # 使用路由规则而不是实际路径作为标签（/api/get-image/<int:image_id>），未匹配的请求统一归类
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            HTTP_DURATION.observe(time.perf_counter() - started, route, request.method)
+            HTTP_REQUESTS.inc(route, request.method, str(status))
+
+    # flask_socketio.emit 和 socketio.emit 最终都调用实例的 emit
+    original_emit = socketio.emit
+
+    def emit(event, *args, **kwargs):
+        SOCKET_EVENTS.inc(event)
+        return original_emit(event, *args, **kwargs)
+
+    socketio.emit = emit
@@ -0,0 +1,157 @@
+"""把旧版本平铺保存的上传文件迁移为按内容寻址的存储（离线执行）
+
+旧版本的上传以 uuid 文件名直接保存在上传目录中（images/files 表的 sha256 为 NULL）。
+本脚本逐条计算这些文件的 SHA-256，移动到 ab/cd/<sha256>，并更新记录的 filename 和 sha256
+（引用计数由触发器维护）；内容相同的文件只保留一份。
+
+请在停止应用后执行，数据目录和上传目录与应用相同（CHAT_DATA_DIR / CHAT_UPLOAD_DIR）：
+    python backend/migrate_uploads.py --dry-run    # 只统计，不修改
+    python backend/migrate_uploads.py
+
+每条记录单独提交，中途中断后可以重新执行，已迁移的记录会跳过。
+找不到文件的记录保持不变；上传目录中没有记录引用的旧文件只列出，不删除。
+"""
+import argparse
+import hashlib
+import os
+import pathlib
+import shutil
+import sys
+import uuid
+import logging
+
+import db
+import thumbnails
+from blobs import BlobStore
+from migrations import run_migrations
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('chat_app.migrate_uploads')
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='迁移旧的上传文件为按内容寻址的存储')
+    parser.add_argument('--data-dir', default=os.environ.get('CHAT_DATA_DIR') or str(ROOT / 'data'),
+                        help='数据目录（包含 chat.db）')
+    parser.add_argument('--upload-dir', default=os.environ.get('CHAT_UPLOAD_DIR') or str(ROOT / 'uploads'),
+                        help='上传目录')
+    parser.add_argument('--dry-run', action='store_true', help='只统计，不修改文件和数据库')
+    return parser.parse_args()
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _link_to_temp(store, path):
+    """把旧文件硬链接（不支持时复制）为临时文件，数据库提交前旧文件保持不变"""
+    temp_path = os.path.join(store.tmp_dir, f'{uuid.uuid4().hex}.tmp')
+    try:
+        os.link(path, temp_path)
+    except OSError:
+        shutil.copyfile(path, temp_path)
+    return temp_path
+
+
+def migrate(store, upload_dir, dry_run=False):
+    stats = {'migrated': 0, 'missing': 0, 'bytes': 0, 'deduplicated_bytes': 0}
+    seen = set()
+    for table in ('images', 'files'):
+        with db.connection() as conn:
+            rows = conn.execute(f'SELECT id, filename FROM {table} WHERE sha256 IS NULL ORDER BY id').fetchall()
+        logger.info(f"{table}: {len(rows)} 条记录需要迁移")
+
+        for record_id, filename in rows:
+            legacy_path = os.path.join(upload_dir, filename)
+            if not os.path.isfile(legacy_path):
+                logger.warning(f"{table} {record_id}: 找不到文件 {filename}，跳过")
+                stats['missing'] += 1
+                continue
+
+            digest = file_sha256(legacy_path)
+            size = os.path.getsize(legacy_path)
+            stats['bytes'] += size
+            if digest in seen or os.path.exists(store.path(digest)):
+                stats['deduplicated_bytes'] += size
+            seen.add(digest)
+            if dry_run:
+                stats['migrated'] += 1
+                continue
+
+            temp_path = _link_to_temp(store, legacy_path)
+            try:
+                with db.transaction() as cursor:
+                    relative = store.store(cursor, temp_path, digest, size)
+                    cursor.execute(f'UPDATE {table} SET filename = ?, sha256 = ? WHERE id = ?',
+                                   (relative, digest, record_id))
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            # 其他记录可能引用同一个旧文件，全部迁移后才删除
+            with db.connection() as conn:
+                still_used = conn.execute('''
+                    SELECT 1 FROM images WHERE filename = ? AND sha256 IS NULL
+                    UNION ALL
+                    SELECT 1 FROM files WHERE filename = ? AND sha256 IS NULL
+                ''', (filename, filename)).fetchone()
+            if not still_used:
+                os.remove(legacy_path)
+                thumbnails.remove_variants(legacy_path)
+            stats['migrated'] += 1
+
+    return stats
+
+
+def find_unreferenced(upload_dir):
+    """上传目录顶层没有记录引用的旧文件（不包括缩略图）"""
+    with db.connection() as conn:
+        referenced = {row[0] for row in conn.execute(
+            'SELECT filename FROM images UNION SELECT filename FROM files').fetchall()}
+    variant_suffixes = tuple(f'.{size}.webp' for size in thumbnails.SIZES)
+    return sorted(entry.name for entry in os.scandir(upload_dir)
+                  if entry.is_file() and entry.name not in referenced
+                  and not entry.name.endswith(variant_suffixes))
+
+
+def main():
+    args = _parse_args()
+    db_file = pathlib.Path(args.data_dir) / 'chat.db'
+    if not db_file.exists():
+        logger.error(f"数据库不存在: {db_file}")
+        return 1
+
+    db.configure(db_file)
+    if not args.dry_run:
+        with db.connection() as conn:
+            run_migrations(conn)
+    else:
+        with db.connection() as conn:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(images)').fetchall()]
+        if 'sha256' not in columns:
+            logger.error("数据库尚未升级，请先启动一次应用或不带 --dry-run 执行")
+            return 1
+
+    store = BlobStore(args.upload_dir)
+    stats = migrate(store, args.upload_dir, dry_run=args.dry_run)
+    action = '可迁移' if args.dry_run else '已迁移'
+    logger.info(f"{action} {stats['migrated']} 条记录（{stats['bytes'] / 1024 / 1024:.1f} MB），"
+                f"其中重复内容 {stats['deduplicated_bytes'] / 1024 / 1024:.1f} MB；"
+                f"找不到文件 {stats['missing']} 条")
+
+    unreferenced = find_unreferenced(args.upload_dir)
+    if unreferenced:
+        logger.info(f"上传目录中有 {len(unreferenced)} 个没有记录引用的旧文件（未删除）：")
+        for name in unreferenced[:50]:
+            logger.info(f"  {name}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,604 @@
+"""数据库结构迁移
+
+每个迁移步骤通过 @migration(版本号, 说明) 注册，启动时按版本号顺序执行。
+已执行的版本记录在 schema_version 表中，只有尚未应用的步骤才会运行，
+每个步骤在独立的事务中执行，失败时整体回滚。
+"""
+import logging
+from datetime import datetime
+
+logger = logging.getLogger('chat_app.migrations')
+
+# 已注册的迁移步骤：(版本号, 说明, 函数)
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """注册一个迁移步骤"""
+    def decorator(func):
+        if any(v == version for v, _, _ in MIGRATIONS):
+            raise ValueError(f"重复的迁移版本号: {version}")
+        MIGRATIONS.append((version, description, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+def get_schema_version(conn):
+    """获取当前数据库结构版本，未执行过任何迁移时返回0"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return row[0] or 0
+
+
+def run_migrations(conn):
+    """执行所有尚未应用的迁移步骤，返回执行后的结构版本"""
+    current = get_schema_version(conn)
+    conn.commit()
+
+    for version, description, func in MIGRATIONS:
+        if version <= current:
+            continue
+
+        # 使用IMMEDIATE事务，避免多个进程同时启动时重复执行同一步骤
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone()
+            if row is None:
+                func(conn.cursor())
+                conn.execute('''
+                    INSERT INTO schema_version (version, description, applied_at)
+                    VALUES (?, ?, ?)
+                ''', (version, description, datetime.now().isoformat()))
+                logger.info(f"已执行数据库迁移 {version}: {description}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"数据库迁移 {version} 执行失败: {description}", exc_info=True)
+            raise
+        current = version
+
+    return current
+
+
+@migration(1, '创建基础表')
+def _create_base_tables(cursor):
+    # 创建聊天记录表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+    ''')
+
+    # 创建好友关系表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS friendships (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user1 TEXT NOT NULL,
+            user2 TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+    ''')
+
+    # 创建已读消息标记表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS read_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+    ''')
+
+    # 创建图片表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            uploader TEXT NOT NULL,
+            upload_time TEXT NOT NULL
+        )
+    ''')
+
+    # 创建文件表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            file_size INTEGER NOT NULL,
+            file_type TEXT NOT NULL,
+            uploader TEXT NOT NULL,
+            upload_time TEXT NOT NULL
+        )
+    ''')
+
+
+@migration(2, '为热点查询添加索引')
+def _add_hot_query_indexes(cursor):
+    # 会话查询的双向OR条件（MULTI-INDEX OR）、since_id增量查询、MAX(id)，
+    # 以及未读消息统计 recipient = ? AND sender IN (...) 都由该索引提供
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_recipient_sender_id
+        ON messages (recipient, sender, id)
+    ''')
+
+    # 图片/文件消息的权限检查和清理，只索引带Pic_/File_前缀的行（覆盖索引）
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_pic_content
+        ON messages (content, sender, recipient)
+        WHERE content GLOB 'Pic_*'
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_file_content
+        ON messages (content, sender, recipient)
+        WHERE content GLOB 'File_*'
+    ''')
+
+    # 已读标记去重后添加唯一约束，标记已读时依赖IntegrityError跳过重复行
+    cursor.execute('''
+        DELETE FROM read_messages
+        WHERE id NOT IN (SELECT MIN(id) FROM read_messages GROUP BY user, message_id)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_read_messages_user_message
+        ON read_messages (user, message_id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_read_messages_message
+        ON read_messages (message_id)
+    ''')
+
+    # 好友关系双向查询
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_friendships_user1
+        ON friendships (user1, user2)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_friendships_user2
+        ON friendships (user2, user1)
+    ''')
+
+
+@migration(3, '已读状态改为按会话记录的已读水位')
+def _add_read_watermarks(cursor):
+    # 每个 (user, peer) 只保存一行：已读到的最后一条消息ID
+    # peer 为空字符串的行表示"全部会话已读"的全局水位
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS read_watermarks (
+            user TEXT NOT NULL,
+            peer TEXT NOT NULL,
+            last_read_message_id INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (user, peer)
+        ) WITHOUT ROWID
+    ''')
+
+    # 把逐条的已读标记合并为每个会话已读过的最大消息ID。
+    # 注意：这会丢失部分未读状态。水位以下、原来没有已读标记的消息（例如跳过未读的旧消息后读了较新的消息）
+    # 升级后都算作已读，只有水位之后的消息保持未读。read_messages 随后删除，之后的迁移无法再恢复
+    cursor.execute('''
+        INSERT OR REPLACE INTO read_watermarks (user, peer, last_read_message_id, updated_at)
+        SELECT r.user, m.sender, MAX(m.id), MAX(r.timestamp)
+        FROM read_messages r
+        JOIN messages m ON m.id = r.message_id AND m.recipient = r.user
+        GROUP BY r.user, m.sender
+    ''')
+
+    cursor.execute('DROP TABLE IF EXISTS read_messages')
+
+
+@migration(4, '添加物化的未读消息计数表')
+def _add_unread_counts(cursor):
+    # 每个 (user, peer) 一行：user 收到的来自 peer 的未读消息数
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS unread_counts (
+            user TEXT NOT NULL,
+            peer TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user, peer)
+        ) WITHOUT ROWID
+    ''')
+
+    # 根据已读水位回填现有的未读数
+    cursor.execute('''
+        INSERT OR REPLACE INTO unread_counts (user, peer, count)
+        SELECT m.recipient, m.sender, COUNT(*)
+        FROM messages m
+        LEFT JOIN read_watermarks w ON w.user = m.recipient AND w.peer = m.sender
+        LEFT JOIN read_watermarks g ON g.user = m.recipient AND g.peer = ''
+        WHERE m.sender != m.recipient
+          AND m.id > MAX(COALESCE(w.last_read_message_id, 0), COALESCE(g.last_read_message_id, 0))
+        GROUP BY m.recipient, m.sender
+    ''')
+
+
+# 可搜索的消息：文字消息（Chat_前缀），不包括以文字消息形式保存的文件和音乐分享
+_SEARCHABLE_MESSAGE = "{row}.content GLOB 'Chat_*' AND NOT {row}.content GLOB 'Chat_File_*' AND NOT {row}.content GLOB 'Chat_Music_*'"
+
+
+@migration(5, '添加消息全文索引（FTS5 trigram）')
+def _add_message_search_index(cursor):
+    # trigram分词不依赖空格分词，中文可以按任意连续3个字符匹配；
+    # rowid 即消息ID，body 为去掉 Chat_ 前缀后的正文
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+        USING fts5(body, tokenize = 'trigram')
+    ''')
+
+    # 由触发器与 messages 表保持同步（包括写入队列和清空聊天记录）
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        WHEN {_SEARCHABLE_MESSAGE.format(row='new')}
+        BEGIN
+            INSERT INTO messages_fts (rowid, body) VALUES (new.id, substr(new.content, 6));
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        WHEN {_SEARCHABLE_MESSAGE.format(row='old')}
+        BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages
+        BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.id;
+            INSERT INTO messages_fts (rowid, body)
+            SELECT new.id, substr(new.content, 6) WHERE {_SEARCHABLE_MESSAGE.format(row='new')};
+        END
+    ''')
+
+    # 为已有的文字消息建立索引
+    cursor.execute(f'''
+        INSERT INTO messages_fts (rowid, body)
+        SELECT id, substr(content, 6) FROM messages m
+        WHERE {_SEARCHABLE_MESSAGE.format(row='m')}
+    ''')
+
+
+@migration(6, '添加分块上传会话表')
+def _add_upload_sessions(cursor):
+    # 未完成的分块上传；已接收的数据保存在上传目录的 .partial/<id>.part 中
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            uploader TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            total_size INTEGER NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            expected_sha256 TEXT,
+            created_at TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    # 清理过期会话时按最后写入时间查找
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated_at
+        ON upload_sessions (updated_at)
+    ''')
+
+
+@migration(7, '添加按内容寻址的上传文件表')
+def _add_blobs(cursor):
+    # 按 SHA-256 保存的上传文件，refcount 为引用该文件的 images/files 记录数（见 blobs.py）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    # 清空聊天记录后查找不再被引用的文件
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_blobs_unreferenced
+        ON blobs (sha256) WHERE refcount <= 0
+    ''')
+
+    # 旧的上传记录 sha256 为 NULL，仍按 filename 平铺保存，由 migrate_uploads.py 离线迁移
+    for table in ('images', 'files'):
+        columns = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()]
+        if 'sha256' not in columns:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN sha256 TEXT')
+
+        # 引用计数随记录的增删和迁移自动维护
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_blob_ref_insert AFTER INSERT ON {table}
+            WHEN new.sha256 IS NOT NULL
+            BEGIN
+                UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = new.sha256;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_blob_ref_delete AFTER DELETE ON {table}
+            WHEN old.sha256 IS NOT NULL
+            BEGIN
+                UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = old.sha256;
+            END
+        ''')
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_blob_ref_update AFTER UPDATE OF sha256 ON {table}
+            WHEN old.sha256 IS NOT new.sha256
+            BEGIN
+                UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = old.sha256;
+                UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = new.sha256;
+            END
+        ''')
+
+
+@migration(8, '添加消息附件表')
+def _add_message_attachments(cursor):
+    # 消息引用的图片/文件，用于附件的权限检查和清理。
+    # 图片消息保存为 Pic_<图片ID>；文件消息由文字消息形式发送，保存为 Chat_File_<文件ID>
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_attachments (
+            message_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            attachment_id INTEGER NOT NULL,
+            PRIMARY KEY (kind, attachment_id, message_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_message_attachments_message
+        ON message_attachments (message_id)
+    ''')
+
+    # 删除消息（清空聊天记录）时同时删除附件引用
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS message_attachments_delete AFTER DELETE ON messages
+        BEGIN
+            DELETE FROM message_attachments WHERE message_id = old.id;
+        END
+    ''')
+
+    # 为已有的图片和文件消息建立引用（只取前缀之后是纯数字ID的消息）
+    cursor.execute('''
+        INSERT OR IGNORE INTO message_attachments (message_id, kind, attachment_id)
+        SELECT id, 'image', CAST(substr(content, 5) AS INTEGER) FROM messages
+        WHERE content GLOB 'Pic_[0-9]*' AND NOT substr(content, 5) GLOB '*[^0-9]*'
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO message_attachments (message_id, kind, attachment_id)
+        SELECT id, 'file', CAST(substr(content, 11) AS INTEGER) FROM messages
+        WHERE content GLOB 'Chat_File_[0-9]*' AND NOT substr(content, 11) GLOB '*[^0-9]*'
+    ''')
+
+    # 权限检查和清理改为查询附件表，按内容前缀建立的部分索引不再使用
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_pic_content')
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_file_content')
+
+
+# 文字消息在全文索引中的正文：有类型的行为 content，尚未改写的旧行去掉 Chat_ 前缀（见 message_types.py）
+_TEXT_BODY = ("CASE WHEN {row}.type = 'text' THEN {row}.content "
+              "WHEN {row}.type IS NULL AND " + _SEARCHABLE_MESSAGE + " THEN substr({row}.content, 6) END")
+
+
+@migration(9, '消息改为使用类型列')
+def _add_message_type_columns(cursor):
+    # 新消息写入 type/attachment_id，content 不再带类型前缀；
+    # 已有的消息 type 为 NULL，由应用启动后在后台分批改写（message_types.start_backfill）
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(messages)').fetchall()]
+    if 'type' not in columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN type TEXT')
+    if 'attachment_id' not in columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN attachment_id INTEGER')
+
+    # 后台改写时查找尚未改写的行；改写完成后该索引为空
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_untyped
+        ON messages (id) WHERE type IS NULL
+    ''')
+
+    # 全文索引触发器改为按类型判断；改写旧行时正文不变，不会重建索引
+    cursor.execute('DROP TRIGGER IF EXISTS messages_fts_insert')
+    cursor.execute('DROP TRIGGER IF EXISTS messages_fts_delete')
+    cursor.execute('DROP TRIGGER IF EXISTS messages_fts_update')
+    cursor.execute(f'''
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages
+        WHEN {_TEXT_BODY.format(row='new')} IS NOT NULL
+        BEGIN
+            INSERT INTO messages_fts (rowid, body) VALUES (new.id, {_TEXT_BODY.format(row='new')});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+        WHEN {_TEXT_BODY.format(row='old')} IS NOT NULL
+        BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF type, content ON messages
+        WHEN ({_TEXT_BODY.format(row='old')}) IS NOT ({_TEXT_BODY.format(row='new')})
+        BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.id;
+            INSERT INTO messages_fts (rowid, body)
+            SELECT new.id, {_TEXT_BODY.format(row='new')} WHERE {_TEXT_BODY.format(row='new')} IS NOT NULL;
+        END
+    ''')
+
+
+# 当前全文索引触发器使用的文字消息正文表达式（{row} 为行的别名）；search.py 的 LIKE 查询使用同一个表达式，
+# 两者对"文字消息"的判断始终一致。修改时在新的迁移步骤中按新的表达式重建触发器和索引，并让这里指向新的表达式
+TEXT_BODY = _TEXT_BODY
+
+
+@migration(10, '反馈改为保存在数据库中')
+def _add_feedback_tables(cursor):
+    # 反馈原来保存在 data/feedback.json 中，应用启动时导入一次（见 feedback.import_json()）。
+    # seq 保持提交顺序；id 为对外的反馈ID（CB-backend-20251201200439-0001）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS feedback (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            type TEXT NOT NULL,
+            location TEXT NOT NULL,
+            time TEXT NOT NULL,
+            content TEXT NOT NULL,
+            author TEXT NOT NULL,
+            upvotes INTEGER NOT NULL DEFAULT 0,
+            status TEXT,
+            status_note TEXT
+        )
+    ''')
+    # 每个用户对每条反馈最多点赞一次（唯一约束），upvotes 由触发器随点赞的增删维护；
+    # 点赞用户列表按 rowid（点赞顺序）返回
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS feedback_upvotes (
+            feedback_id TEXT NOT NULL,
+            user TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            UNIQUE (feedback_id, user)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS feedback_upvote_insert AFTER INSERT ON feedback_upvotes
+        BEGIN
+            UPDATE feedback SET upvotes = upvotes + 1 WHERE id = new.feedback_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS feedback_upvote_delete AFTER DELETE ON feedback_upvotes
+        BEGIN
+            UPDATE feedback SET upvotes = upvotes - 1 WHERE id = old.feedback_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS feedback_delete AFTER DELETE ON feedback
+        BEGIN
+            DELETE FROM feedback_upvotes WHERE feedback_id = old.id;
+        END
+    ''')
+    # 反馈ID中按（位置, 日期）递增的序号，删除反馈后序号不会重复
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS feedback_sequences (
+            location TEXT NOT NULL,
+            day TEXT NOT NULL,
+            last INTEGER NOT NULL,
+            PRIMARY KEY (location, day)
+        ) WITHOUT ROWID
+    ''')
+    # 已导入的旧反馈文件，每个文件只导入一次
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS feedback_imports (
+            source TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            imported_at TEXT NOT NULL
+        )
+    ''')
+
+
+@migration(11, '反馈列表按点赞数排序的索引')
+def _add_feedback_sort_index(cursor):
+    # 反馈列表默认按点赞数从多到少、同票数按提交顺序分页（见 feedback.list_page()）；
+    # 按时间排序直接使用主键 seq
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_feedback_upvotes ON feedback (upvotes DESC, seq)')
+
+
+@migration(12, '添加管理员公告表')
+def _add_announcement_tables(cursor):
+    # 一条公告只保存一行：audience 为 all 时发给所有用户，为 list 时只发给 announcement_recipients 中的用户
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS announcements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            content TEXT NOT NULL,
+            audience TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    ''')
+    # 指定接收者的公告（多播）在同一事务中批量写入接收者
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS announcement_recipients (
+            user TEXT NOT NULL,
+            announcement_id INTEGER NOT NULL,
+            PRIMARY KEY (user, announcement_id)
+        ) WITHOUT ROWID
+    ''')
+    # 每个用户的已读水位，用户第一次标记已读时才创建；发送公告不写入这张表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS announcement_reads (
+            user TEXT PRIMARY KEY,
+            last_read_id INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+@migration(13, '添加群聊')
+def _add_group_conversations(cursor):
+    # 群聊消息只保存一份（读取时按成员的已读位置计算未读），recipient 为空字符串、conversation_id 为所在群聊；
+    # 一对一消息的 conversation_id 为 NULL，原有的查询和索引不受影响
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(messages)').fetchall()]
+    if 'conversation_id' not in columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN conversation_id INTEGER')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+        ON messages (conversation_id, id) WHERE conversation_id IS NOT NULL
+    ''')
+
+    # message_count 为群聊的消息总数，每条消息加1；member_count 由触发器维护
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            creator TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_message_id INTEGER NOT NULL DEFAULT 0,
+            member_count INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # 成员的已读位置：read_count 为已读到的 message_count，未读数 = message_count - read_count，
+    # 发送消息和标记已读时只更新一个成员的这一行，与群聊人数无关
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_members (
+            conversation_id INTEGER NOT NULL,
+            user TEXT NOT NULL,
+            joined_at TEXT NOT NULL,
+            read_count INTEGER NOT NULL DEFAULT 0,
+            last_read_message_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (conversation_id, user)
+        ) WITHOUT ROWID
+    ''')
+    # 查询用户加入的群聊
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversation_members_user
+        ON conversation_members (user, conversation_id)
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversation_member_insert AFTER INSERT ON conversation_members
+        BEGIN
+            UPDATE conversations SET member_count = member_count + 1 WHERE id = new.conversation_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS conversation_member_delete AFTER DELETE ON conversation_members
+        BEGIN
+            UPDATE conversations SET member_count = member_count - 1 WHERE id = old.conversation_id;
+        END
+    ''')
+
+
+@migration(14, '按发送者查找消息的索引')
+def _add_sender_index(cursor):
+    # 搜索短词时按发送者或接收者查找用户参与的一对一消息（见 search.py），
+    # 接收者一侧使用第2步的 idx_messages_recipient_sender_id，发送者一侧使用这个索引，不再扫描整个 messages
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_sender_recipient_id
+        ON messages (sender, recipient, id)
+    ''')
@@ -0,0 +1,310 @@
+"""网易云音乐接口客户端
+
+音乐搜索、详情和歌词都经过这里请求上游接口：
+- 共用一个 requests.Session（连接池、keep-alive），不再每次请求都重新建立TLS连接
+- 连接和读取都有超时（CHAT_MUSIC_CONNECT_TIMEOUT / CHAT_MUSIC_READ_TIMEOUT），上游无响应时不会一直占用工作线程
+- 结果按 TTL+LRU 缓存在进程内：搜索结果 SEARCH_TTL，歌曲详情和歌词几乎不变，缓存 DETAIL_TTL / LYRIC_TTL
+- 同一个查询正在请求上游时，其他请求等待这次的结果（single-flight），不重复请求
+- 上游出错（超时、非200、返回内容无法解析）的结果也缓存 ERROR_TTL 秒，上游故障时不会被持续重试拖慢
+- 歌曲详情可以批量获取（details()）：按ID逐个查缓存，只请求未命中的ID，每 DETAIL_BATCH_SIZE 个ID一次上游请求
+
+上游地址可以通过 CHAT_MUSIC_UPSTREAM 指向本地的模拟服务（见 bench/fake_music.py），离线测试缓存命中率。
+缓存命中和上游请求耗时记录在运行指标中（chat_music_cache_requests_total、chat_music_upstream_duration_seconds）。
+"""
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger('chat_app.music')
+
+UPSTREAM = os.environ.get('CHAT_MUSIC_UPSTREAM', 'https://music.163.com').rstrip('/')
+CONNECT_TIMEOUT = float(os.environ.get('CHAT_MUSIC_CONNECT_TIMEOUT', '3'))
+READ_TIMEOUT = float(os.environ.get('CHAT_MUSIC_READ_TIMEOUT', '5'))
+# 连接池中保留的keep-alive连接数
+POOL_SIZE = int(os.environ.get('CHAT_MUSIC_POOL_SIZE', '16'))
+CACHE_SIZE = int(os.environ.get('CHAT_MUSIC_CACHE_SIZE', '2000'))
+
+SEARCH_TTL = float(os.environ.get('CHAT_MUSIC_SEARCH_TTL', '600'))
+DETAIL_TTL = float(os.environ.get('CHAT_MUSIC_DETAIL_TTL', '86400'))
+LYRIC_TTL = float(os.environ.get('CHAT_MUSIC_LYRIC_TTL', '86400'))
+ERROR_TTL = float(os.environ.get('CHAT_MUSIC_ERROR_TTL', '10'))
+
+MAX_SEARCH_LIMIT = 100
+# 批量获取歌曲详情时，每次上游请求包含的ID数
+DETAIL_BATCH_SIZE = int(os.environ.get('CHAT_MUSIC_DETAIL_BATCH', '50'))
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Referer': 'https://music.163.com'
+}
+
+
+class MusicError(Exception):
+    """上游请求失败或没有结果，status 为返回给客户端的HTTP状态码"""
+
+    def __init__(self, msg, status=502):
+        super().__init__(msg)
+        self.msg = msg
+        self.status = status
+
+
+class TTLCache:
+    """带过期时间的LRU缓存（线程安全）"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # 键 -> (过期时间, 值)，按最近使用的顺序排列
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now=None):
+        """返回 (是否命中, 值)"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] <= now:
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[1]
+
+    def set(self, key, value, ttl, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._entries[key] = (now + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SingleFlight:
+    """合并相同键的并发调用：同一时刻只有一个调用方执行，其他调用方等待并共享结果"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout):
+        """返回 (结果, 是否共享了其他调用方的结果)；func 抛出的异常同样传给所有等待方"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result(timeout=timeout), True
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result(), False
+
+
+def _parse_search_song(song):
+    """搜索结果中的歌曲"""
+    # 检查是否为VIP歌曲：fee=1表示付费歌曲，payed=0表示未付费
+    privilege = song.get('privilege') or {}
+    is_vip = privilege.get('fee', 0) == 1 and privilege.get('payed', 0) == 0
+    return {
+        'id': song.get('id'),
+        'name': song.get('name'),
+        'artists': [artist.get('name', '') for artist in song.get('ar', [])],
+        'album': song.get('al', {}).get('name', ''),
+        'picUrl': song.get('al', {}).get('picUrl', ''),
+        'isVip': is_vip,
+    }
+
+
+def _parse_detail_song(song):
+    """歌曲详情"""
+    return {
+        'id': song.get('id'),
+        'name': song.get('name'),
+        'artists': [artist.get('name', '') for artist in song.get('artists', [])],
+        'album': song.get('album', {}).get('name', ''),
+        'picUrl': song.get('album', {}).get('picUrl', ''),
+        'duration': song.get('duration', 0),
+    }
+
+
+class MusicClient:
+    """带缓存的网易云音乐接口客户端"""
+
+    def __init__(self, upstream=UPSTREAM, cache_size=CACHE_SIZE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
+        self.upstream = upstream
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = TTLCache(cache_size)
+        self._flight = SingleFlight()
+
+    def search(self, keyword, limit=30):
+        """搜索单曲，返回歌曲列表"""
+        limit = max(1, min(int(limit), MAX_SEARCH_LIMIT))
+
+        def fetch():
+            data = self._request('search', 'POST', '/api/cloudsearch/pc',
+                                 data={'s': keyword, 'type': '1', 'limit': limit, 'offset': '0'})
+            return [_parse_search_song(song) for song in (data.get('result') or {}).get('songs', [])]
+
+        return self._cached('search', (keyword, limit), SEARCH_TTL, fetch)
+
+    def detail(self, music_id):
+        """获取歌曲详情"""
+        music_id = int(music_id)
+        found = self.details([music_id])
+        if music_id not in found:
+            raise MusicError('歌曲不存在', 404)
+        return found[music_id]
+
+    def details(self, music_ids):
+        """批量获取歌曲详情，返回 {ID: 详情}，不存在的歌曲不包含在内
+
+        重复的ID只查询一次；缓存中没有的ID分块请求上游，相同的分块正在请求时等待其结果。
+        上游出错时抛出 MusicError（错误结果按ID缓存 ERROR_TTL 秒）。
+        """
+        found = {}
+        misses = []
+        for music_id in dict.fromkeys(int(i) for i in music_ids):
+            hit, entry = self.cache.get(('detail', music_id))
+            if not hit:
+                misses.append(music_id)
+                continue
+            ok, value = entry
+            metrics.MUSIC_CACHE.inc('detail', 'hit' if ok else 'error_hit')
+            if ok:
+                found[music_id] = value
+            elif value[1] != 404:
+                raise MusicError(*value)
+
+        for start in range(0, len(misses), DETAIL_BATCH_SIZE):
+            chunk = tuple(misses[start:start + DETAIL_BATCH_SIZE])
+            songs, shared = self._shared(('details', chunk), lambda chunk=chunk: self._fetch_details(chunk),
+                                         [('detail', music_id) for music_id in chunk])
+            metrics.MUSIC_CACHE.inc('detail', 'coalesced' if shared else 'miss', amount=len(chunk))
+            found.update(songs)
+        return found
+
+    def _fetch_details(self, music_ids):
+        """一次上游请求获取多首歌曲的详情，结果（包括不存在的歌曲）写入缓存"""
+        try:
+            data = self._request('detail', 'GET', '/api/song/detail',
+                                 params={'ids': '[' + ','.join(str(i) for i in music_ids) + ']'})
+        except MusicError as e:
+            for music_id in music_ids:
+                self.cache.set(('detail', music_id), (False, (e.msg, e.status)), ERROR_TTL)
+            raise
+        songs = {}
+        for song in data.get('songs') or []:
+            info = _parse_detail_song(song)
+            songs[info['id']] = info
+        for music_id in music_ids:
+            if music_id in songs:
+                self.cache.set(('detail', music_id), (True, songs[music_id]), DETAIL_TTL)
+            else:
+                self.cache.set(('detail', music_id), (False, ('歌曲不存在', 404)), ERROR_TTL)
+        return {music_id: songs[music_id] for music_id in music_ids if music_id in songs}
+
+    def lyric(self, music_id):
+        """获取歌词（LRC格式），没有歌词时为空字符串"""
+        music_id = int(music_id)
+
+        def fetch():
+            data = self._request('lyric', 'GET', '/api/song/lyric',
+                                 params={'id': music_id, 'lv': -1, 'kv': -1, 'tv': -1})
+            return (data.get('lrc') or {}).get('lyric', '')
+
+        return self._cached('lyric', music_id, LYRIC_TTL, fetch)
+
+    def _cached(self, endpoint, key, ttl, fetch):
+        """先查缓存，未命中时（合并相同的并发查询）请求上游并缓存结果或错误"""
+        cache_key = (endpoint, key)
+        hit, entry = self.cache.get(cache_key)
+        if hit:
+            metrics.MUSIC_CACHE.inc(endpoint, 'hit' if entry[0] else 'error_hit')
+            return self._unwrap(entry)
+
+        def load():
+            # 等待期间可能已经有其他调用方写入了缓存
+            hit, entry = self.cache.get(cache_key)
+            if hit:
+                return entry
+            try:
+                entry = (True, fetch())
+                self.cache.set(cache_key, entry, ttl)
+            except MusicError as e:
+                entry = (False, (e.msg, e.status))
+                self.cache.set(cache_key, entry, ERROR_TTL)
+            return entry
+
+        entry, shared = self._shared(cache_key, load, [cache_key])
+        metrics.MUSIC_CACHE.inc(endpoint, 'coalesced' if shared else 'miss')
+        return self._unwrap(entry)
+
+    def _shared(self, key, func, cache_keys):
+        """合并相同的并发调用（见 SingleFlight），返回 (结果, 是否共享)
+
+        等待其他调用方的结果超时时，为 cache_keys 中还没有结果的键缓存错误 ERROR_TTL 秒，并抛出 MusicError。
+        """
+        try:
+            return self._flight.do(key, func, timeout=sum(self.timeout) + 1)
+        except FutureTimeoutError:
+            logger.error(f"等待音乐接口的结果超时: {key[0]}")
+            error = ('上游超时', 504)
+            for cache_key in cache_keys:
+                if not self.cache.get(cache_key)[0]:
+                    self.cache.set(cache_key, (False, error), ERROR_TTL)
+            raise MusicError(*error)
+
+    @staticmethod
+    def _unwrap(entry):
+        ok, value = entry
+        if not ok:
+            raise MusicError(*value)
+        return value
+
+    def _request(self, endpoint, method, path, **kwargs):
+        """请求上游接口，返回解析后的JSON；失败时抛出 MusicError"""
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.session.request(method, self.upstream + path, timeout=self.timeout, **kwargs)
+            status = str(response.status_code)
+            response.raise_for_status()
+            data = response.json()
+        except requests.Timeout:
+            status = 'timeout'
+            logger.error(f"请求音乐接口超时: {path}")
+            raise MusicError('音乐服务响应超时', 504)
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"请求音乐接口失败: {path}: {e}")
+            raise MusicError('音乐服务暂时不可用')
+        finally:
+            metrics.MUSIC_UPSTREAM_DURATION.observe(time.perf_counter() - started, endpoint, status)
+        if not isinstance(data, dict) or data.get('code') != 200:
+            logger.error(f"音乐接口返回错误: {path}: {str(data)[:200]}")
+            raise MusicError('音乐服务返回错误')
+        return data
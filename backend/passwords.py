@@ -0,0 +1,110 @@
+"""密码哈希和校验
+
+bcrypt 的计算是刻意设计的CPU密集操作（每次约几十到几百毫秒），在处理请求的线程中执行时，
+大量登录请求（包括撞库攻击）会占满CPU和工作线程，拖慢正常的消息收发。
+这里把 hashpw/checkpw 放到固定大小的进程池中执行，并限制排队的任务数：
+超过 QUEUE_LIMIT 时立即抛出 PasswordBusy（接口返回503），不再继续堆积；
+单个任务等待超过 TIMEOUT 时同样抛出 PasswordBusy。
+
+登录成功后签发会话令牌（见 tokens.py），之后的请求只校验令牌，每个会话只计算一次 bcrypt。
+
+本模块会在进程池的子进程中导入，除 concurrency 外不依赖应用的其他模块。
+"""
+import os
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import bcrypt
+
+from concurrency import process_pool, run_blocking, wait_future
+
+# 计算 bcrypt 的进程数，0 表示在当前进程中计算
+WORKERS = int(os.environ.get('CHAT_BCRYPT_WORKERS', str(min(4, os.cpu_count() or 1))))
+# 同时执行和排队的 bcrypt 任务上限（每个进程各自计算）
+QUEUE_LIMIT = int(os.environ.get('CHAT_BCRYPT_QUEUE', '64'))
+# 等待单个任务的最长时间（秒）
+TIMEOUT = 30
+
+HASH_PREFIX = '$2b$'
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+class PasswordBusy(Exception):
+    """排队的密码计算任务已达上限"""
+
+
+def is_hashed(stored_password):
+    """存储的密码是否已经是 bcrypt 哈希（否则为旧版本的明文密码）"""
+    return stored_password.startswith(HASH_PREFIX)
+
+
+def _hashpw(password):
+    return bcrypt.hashpw(password, bcrypt.gensalt()).decode('utf-8')
+
+
+def _checkpw(password, hashed_password):
+    try:
+        return bcrypt.checkpw(password, hashed_password)
+    except ValueError:
+        # 存储的哈希格式错误
+        return False
+
+
+def _get_pool():
+    global _pool
+    if WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # 第一次使用时才创建：gunicorn 等多进程部署中，每个工作进程有自己的进程池；
+            # 子进程由 forkserver 启动，不从已有多个线程的应用进程中 fork
+            _pool = process_pool(WORKERS, 'passwords')
+        return _pool
+
+
+def _acquire():
+    global _pending
+    with _pending_lock:
+        if _pending >= QUEUE_LIMIT:
+            raise PasswordBusy('密码计算任务过多')
+        _pending += 1
+
+
+def _release():
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+
+def _run(func, *args):
+    """在进程池中执行 bcrypt 计算，排队已满或等待超时时抛出 PasswordBusy"""
+    _acquire()
+    try:
+        pool = _get_pool()
+        if pool is None:
+            return run_blocking(func, *args)
+        try:
+            return wait_future(pool.submit(func, *args), TIMEOUT)
+        except (TimeoutError, FutureTimeoutError) as e:
+            raise PasswordBusy('密码计算超时') from e
+    finally:
+        _release()
+
+
+def hash_password(password):
+    """计算密码的 bcrypt 哈希"""
+    return _run(_hashpw, password.encode('utf-8'))
+
+
+def verify_password(password, hashed_password):
+    """验证密码是否与存储的 bcrypt 哈希匹配"""
+    return _run(_checkpw, password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def pending():
+    """当前进程中正在执行和排队的任务数"""
+    return _pending
@@ -0,0 +1,202 @@
+"""本地发布/订阅代理（Redis协议兼容的最小实现）
+
+多进程部署时，Flask-SocketIO 通过消息队列在进程之间转发 emit。生产环境使用 Redis，
+本模块实现了 Redis 协议（RESP2/RESP3）中 pub/sub 所需的最小命令子集
+（PING、SUBSCRIBE、UNSUBSCRIBE、PUBLISH 以及客户端握手时的 HELLO/CLIENT/SELECT/ECHO），
+可以在没有 Redis 的环境中（本地开发、离线测试）作为替身，redis-py 客户端无需任何改动。
+
+不支持持久化、模式订阅和认证，只应监听在本机地址上。
+
+    python backend/pubsub_broker.py --port 6379
+    CHAT_MESSAGE_QUEUE=redis://127.0.0.1:6379/0 python backend/server.py
+"""
+import argparse
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger('chat_app.pubsub_broker')
+
+
+def _encode(value):
+    """把Python值编码为RESP格式（RESP2与RESP3通用的部分）"""
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    if isinstance(value, (list, tuple)):
+        return b'*%d\r\n' % len(value) + b''.join(_encode(v) for v in value)
+    if isinstance(value, dict):
+        return b'%%%d\r\n' % len(value) + b''.join(_encode(k) + _encode(v) for k, v in value.items())
+    raise TypeError(f"无法编码的类型: {type(value)}")
+
+
+def _push(items, protocol):
+    """编码pub/sub推送消息：RESP3使用推送类型(>)，RESP2使用普通数组"""
+    if protocol == 3:
+        return b'>%d\r\n' % len(items) + b''.join(_encode(v) for v in items)
+    return _encode(items)
+
+
+def _simple(text):
+    return b'+%s\r\n' % text.encode('utf-8')
+
+
+def _error(text):
+    return b'-ERR %s\r\n' % text.encode('utf-8')
+
+
+async def _read_command(reader):
+    """读取一条命令（RESP数组或内联命令），连接关闭时返回None"""
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        return line.strip().split()
+    count = int(line[1:])
+    args = []
+    for _ in range(count):
+        header = await reader.readline()
+        if not header.startswith(b'$'):
+            raise ValueError('协议错误：期望批量字符串')
+        length = int(header[1:])
+        data = await reader.readexactly(length + 2)
+        args.append(data[:-2])
+    return args
+
+
+class PubSubBroker:
+    """基于asyncio的pub/sub代理"""
+
+    def __init__(self, host='127.0.0.1', port=6379):
+        self.host = host
+        self.port = port
+        self._channels = {}  # 频道名 -> {订阅该频道的连接: 该连接使用的协议版本}
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        # 端口为0时由系统分配
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"发布/订阅代理已启动: {self.host}:{self.port}")
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def _publish(self, channel, message):
+        subscribers = self._channels.get(channel, {})
+        for writer, protocol in list(subscribers.items()):
+            try:
+                writer.write(_push([b'message', channel, message], protocol))
+            except Exception:
+                subscribers.pop(writer, None)
+        return len(subscribers)
+
+    def _unsubscribe_all(self, writer, subscribed):
+        for channel in subscribed:
+            subscribers = self._channels.get(channel)
+            if subscribers is not None:
+                subscribers.pop(writer, None)
+                if not subscribers:
+                    del self._channels[channel]
+        subscribed.clear()
+
+    async def _handle_client(self, reader, writer):
+        subscribed = set()
+        protocol = 2
+        try:
+            while True:
+                try:
+                    args = await _read_command(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    break
+                if args is None:
+                    break
+                if not args:
+                    continue
+                command = args[0].upper()
+                params = args[1:]
+
+                if command == b'HELLO':
+                    if params:
+                        protocol = int(params[0])
+                    info = {'server': 'redis', 'version': '7.0.0', 'proto': protocol,
+                            'id': id(writer), 'mode': 'standalone', 'role': 'master', 'modules': []}
+                    if protocol == 3:
+                        writer.write(_encode(info))
+                    else:
+                        writer.write(_encode([x for kv in info.items() for x in kv]))
+                elif command == b'PING':
+                    if subscribed and protocol == 2:
+                        writer.write(_encode([b'pong', params[0] if params else b'']))
+                    else:
+                        writer.write(_encode(params[0]) if params else _simple('PONG'))
+                elif command == b'SUBSCRIBE':
+                    for channel in params:
+                        self._channels.setdefault(channel, {})[writer] = protocol
+                        subscribed.add(channel)
+                        writer.write(_push([b'subscribe', channel, len(subscribed)], protocol))
+                elif command == b'UNSUBSCRIBE':
+                    channels = params or list(subscribed)
+                    for channel in channels:
+                        subscribers = self._channels.get(channel)
+                        if subscribers is not None:
+                            subscribers.pop(writer, None)
+                            if not subscribers:
+                                del self._channels[channel]
+                        subscribed.discard(channel)
+                        writer.write(_push([b'unsubscribe', channel, len(subscribed)], protocol))
+                elif command == b'PUBLISH' and len(params) == 2:
+                    writer.write(_encode(self._publish(params[0], params[1])))
+                elif command in (b'CLIENT', b'SELECT'):
+                    # redis-py 连接时会发送 CLIENT SETINFO / SELECT，直接确认
+                    writer.write(_simple('OK'))
+                elif command == b'ECHO' and params:
+                    writer.write(_encode(params[0]))
+                elif command == b'QUIT':
+                    writer.write(_simple('OK'))
+                    break
+                else:
+                    writer.write(_error(f"unsupported command '{command.decode(errors='replace')}'"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._unsubscribe_all(writer, subscribed)
+            writer.close()
+
+
+def start_in_thread(host='127.0.0.1', port=0):
+    """在后台线程中启动代理（供测试脚本使用），返回实际监听的端口"""
+    broker = PubSubBroker(host, port)
+    ready = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(broker.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name='pubsub-broker', daemon=True).start()
+    ready.wait()
+    return broker.port
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地发布/订阅代理（Redis协议兼容）')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    asyncio.run(PubSubBroker(args.host, args.port).serve_forever())
+
+
+if __name__ == '__main__':
+    main()
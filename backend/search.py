@@ -0,0 +1,161 @@
+"""消息全文搜索
+
+索引为 messages_fts（FTS5，trigram分词，见 migrations.py 第5步），只包含文字消息的正文。
+trigram 按连续3个字符建立索引，中文无需分词即可匹配任意子串，但少于3个字符的词无法使用索引：
+- 查询中不少于3个字符的词使用 MATCH（按bm25相关度排序）
+- 少于3个字符的词（例如两个汉字的词）使用 LIKE 过滤；全部都是短词时按时间倒序扫描
+
+搜索范围限定为调用者参与的会话：一对一会话和调用者所在的群聊（可以再指定某个好友或群聊）。
+返回的摘要已经做过HTML转义，命中的部分用 <mark> 标出。
+"""
+import html
+
+import migrations
+
+# 消息 m 的正文：文字消息的 content，其他类型为 NULL；与全文索引触发器使用同一个表达式（见 migrations.py 第9步）
+TEXT_BODY = migrations.TEXT_BODY.format(row='m')
+
+MIN_INDEXED_LENGTH = 3
+MAX_TERMS = 8
+MAX_QUERY_LENGTH = 100
+SNIPPET_TOKENS = 16
+SNIPPET_CHARS = 40
+
+# 摘要中标记命中位置的占位符（Unicode私用区字符），转义后替换为 <mark>
+_MARK_START = '\ue000'
+_MARK_END = '\ue001'
+_ELLIPSIS = '…'
+
+
+def parse_query(query):
+    """把查询拆分为词（按空白分隔、去重），返回 (可用索引的词, 短词)"""
+    terms = []
+    for term in query[:MAX_QUERY_LENGTH].split():
+        if term not in terms:
+            terms.append(term)
+    terms = terms[:MAX_TERMS]
+    indexed = [t for t in terms if len(t) >= MIN_INDEXED_LENGTH]
+    short = [t for t in terms if len(t) < MIN_INDEXED_LENGTH]
+    return indexed, short
+
+
+def _match_expression(terms):
+    """多个词之间为AND，每个词作为短语匹配（双引号转义）"""
+    return ' AND '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def _strip_marks(text):
+    return text.replace(_MARK_START, '').replace(_MARK_END, '')
+
+
+def _render_snippet(text):
+    """转义摘要并把占位符替换为 <mark>"""
+    return (html.escape(text)
+            .replace(_MARK_START, '<mark>')
+            .replace(_MARK_END, '</mark>'))
+
+
+def _mark(text, terms):
+    """用占位符标出文本中所有命中的词（不区分ASCII大小写，重叠的命中合并）"""
+    lower = text.lower()
+    marked = [False] * len(text)
+    for term in terms:
+        term_lower = term.lower()
+        index = lower.find(term_lower)
+        while index >= 0:
+            for i in range(index, index + len(term_lower)):
+                marked[i] = True
+            index = lower.find(term_lower, index + 1)
+
+    parts = []
+    for i, ch in enumerate(text):
+        if marked[i] and (i == 0 or not marked[i - 1]):
+            parts.append(_MARK_START)
+        parts.append(ch)
+        if marked[i] and (i == len(text) - 1 or not marked[i + 1]):
+            parts.append(_MARK_END)
+    return ''.join(parts)
+
+
+def _highlight(body, terms):
+    """截取第一个命中位置附近的摘要（用于没有MATCH条件、无法使用snippet()的查询）"""
+    lower = body.lower()
+    positions = [p for p in (lower.find(t.lower()) for t in terms) if p >= 0]
+    first = min(positions) if positions else 0
+    start = max(0, first - SNIPPET_CHARS // 2)
+    end = min(len(body), start + SNIPPET_CHARS)
+    prefix = _ELLIPSIS if start > 0 else ''
+    suffix = _ELLIPSIS if end < len(body) else ''
+    return prefix + _mark(body[start:end], terms) + suffix
+
+
+def search_messages(conn, user, query, peer=None, conversation_id=None, limit=20, offset=0):
+    """在用户参与的会话中搜索消息，返回 (结果列表, 是否还有更多结果)
+
+    指定 conversation_id 时只搜索该群聊，调用方需要先确认用户是群聊成员。
+    """
+    indexed, short = parse_query(query)
+    if not indexed and not short:
+        return [], False
+
+    if peer:
+        scope = '((m.sender = ? AND m.recipient = ?) OR (m.sender = ? AND m.recipient = ?))'
+        scope_params = [user, peer, peer, user]
+    elif conversation_id is not None:
+        scope = 'm.conversation_id = ?'
+        scope_params = [conversation_id]
+    else:
+        # 一对一会话（按发送者、接收者的索引查找；群聊消息的 recipient 为空字符串）和用户所在的群聊
+        scope = '''((m.sender = ? AND m.conversation_id IS NULL) OR m.recipient = ?
+                  OR m.conversation_id IN (SELECT conversation_id FROM conversation_members WHERE user = ?))'''
+        scope_params = [user, user, user]
+
+    like_clauses = ''.join(" AND f.body LIKE ? ESCAPE '\\'" for _ in short)
+    like_params = [_like_pattern(t) for t in short]
+
+    # 多取一条用于判断是否还有下一页
+    if indexed:
+        rows = conn.execute(f'''
+            SELECT m.id, m.sender, m.recipient, m.conversation_id, m.timestamp,
+                   snippet(messages_fts, 0, ?, ?, ?, ?)
+            FROM messages_fts f
+            JOIN messages m ON m.id = f.rowid
+            WHERE messages_fts MATCH ? AND {scope}{like_clauses}
+            ORDER BY bm25(messages_fts), m.id DESC
+            LIMIT ? OFFSET ?
+        ''', [_MARK_START, _MARK_END, _ELLIPSIS, SNIPPET_TOKENS, _match_expression(indexed),
+              *scope_params, *like_params, limit + 1, offset]).fetchall()
+        # snippet() 只标出MATCH命中的部分，有短词时在Python中重新标记全部词
+        if short:
+            rows = [row[:5] + (_mark(_strip_marks(row[5]), indexed + short),) for row in rows]
+    else:
+        # 没有可用索引的词：从新到旧扫描用户参与的消息，凑满一页即停止
+        like_clauses = ''.join(f" AND ({TEXT_BODY}) LIKE ? ESCAPE '\\'" for _ in short)
+        rows = conn.execute(f'''
+            SELECT m.id, m.sender, m.recipient, m.conversation_id, m.timestamp, {TEXT_BODY}
+            FROM messages m
+            WHERE {scope}{like_clauses}
+            ORDER BY m.id DESC
+            LIMIT ? OFFSET ?
+        ''', [*scope_params, *like_params, limit + 1, offset]).fetchall()
+        rows = [row[:5] + (_highlight(row[5], short),) for row in rows]
+
+    results = []
+    for message_id, sender, recipient, group_id, timestamp, snippet in rows[:limit]:
+        results.append({
+            'id': message_id,
+            'sender': sender,
+            'recipient': recipient,
+            # 群聊消息没有对方，用 conversationId 标识所在的群聊
+            'peer': None if group_id is not None else (recipient if sender == user else sender),
+            'conversationId': group_id,
+            'timestamp': timestamp,
+            'snippet': _render_snippet(snippet),
+        })
+    return results, len(rows) > limit
+
@@ -0,0 +1,60 @@
+"""生产环境入口
+
+与 `python backend/app.py`（Werkzeug开发服务器，debug模式）不同，这里：
+- 使用 eventlet 或 gevent 协程模式（CHAT_ASYNC_MODE，默认 eventlet），
+  在导入应用之前完成 monkey patch，使 socket（包括 requests 调用网易云音乐接口）、
+  time.sleep、threading、queue 都变为协作式
+- 关闭 debug 和自动重载
+- 启动时执行数据库迁移
+
+直接运行（单进程）：
+    CHAT_ASYNC_MODE=eventlet CHAT_PORT=8000 python backend/server.py
+
+使用 gunicorn（配置见 gunicorn.conf.py）：
+    gunicorn -c backend/gunicorn.conf.py --chdir backend server:app
+
+环境变量：
+    CHAT_ASYNC_MODE          eventlet（默认）或 gevent
+    CHAT_HOST / CHAT_PORT    监听地址，默认 0.0.0.0:80
+    CHAT_MAX_CONNECTIONS     单进程最大并发连接数（eventlet），默认 1000
+    CHAT_MESSAGE_QUEUE       多进程部署时的消息队列地址（如 redis://127.0.0.1:6379/0）
+"""
+import os
+
+os.environ.setdefault('CHAT_ASYNC_MODE', 'eventlet')
+ASYNC_MODE = os.environ['CHAT_ASYNC_MODE']
+
+# bcrypt 和缩略图进程池的子进程（见 concurrency.process_pool()）会以 __mp_main__ 的名字重新导入本模块，
+# 子进程只执行计算任务，不做 monkey patch，也不导入应用和执行迁移
+if __name__ != '__mp_main__':
+    if ASYNC_MODE == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif ASYNC_MODE == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    else:
+        raise RuntimeError(f"生产环境不支持的异步模式: {ASYNC_MODE}（可选 eventlet 或 gevent）")
+
+    # monkey patch 完成后才能导入应用
+    from app import app, socketio, init_db, logger  # noqa: E402
+
+    # 迁移在事务中执行并记录版本，多个进程同时启动也只会执行一次
+    init_db()
+
+HOST = os.environ.get('CHAT_HOST', '0.0.0.0')
+PORT = int(os.environ.get('CHAT_PORT', '80'))
+MAX_CONNECTIONS = int(os.environ.get('CHAT_MAX_CONNECTIONS', '1000'))
+
+
+def main():
+    logger.info(f"聊天应用正在以生产模式启动（{ASYNC_MODE}），监听 {HOST}:{PORT}")
+    options = {}
+    if ASYNC_MODE == 'eventlet':
+        options['max_size'] = MAX_CONNECTIONS
+    socketio.run(app, host=HOST, port=PORT, debug=False, use_reloader=False,
+                 log_output=False, **options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""聊天图片的缩略图和预览图
+
+每张图片有两种缩小的版本，与原图保存在同一目录，文件名为 <原图文件名>.<规格>.webp：
+- thumb：聊天记录中显示（最长边 THUMB_SIZE）
+- medium：图片查看器中显示（最长边 MEDIUM_SIZE）
+原图按内容寻址保存（见 blobs.py），相同内容的图片共用同一组缩略图，删除原图时一起删除。
+
+图片上传后在进程池中生成（解码和缩放是CPU密集操作，不占用处理请求的线程和GIL）；
+请求的版本尚未生成时当场生成，失败或无法处理（不是图片、动图的预览图）时返回原图。
+没有安装 Pillow 时不生成缩略图，始终返回原图。
+
+本模块会在进程池的子进程中导入，除 concurrency 外不依赖应用的其他模块。
+"""
+import os
+import threading
+import uuid
+import logging
+
+try:
+    from PIL import Image, ImageOps
+    AVAILABLE = True
+except ImportError:
+    AVAILABLE = False
+
+from concurrency import process_pool, run_blocking, wait_future
+
+logger = logging.getLogger('chat_app.thumbnails')
+
+THUMB_SIZE = int(os.environ.get('CHAT_THUMB_SIZE', '400'))
+MEDIUM_SIZE = int(os.environ.get('CHAT_MEDIUM_SIZE', '1600'))
+# 生成缩略图的进程数，0 表示在当前进程中生成
+WORKERS = int(os.environ.get('CHAT_THUMBNAIL_WORKERS', str(min(2, os.cpu_count() or 1))))
+# 等待当场生成的最长时间（秒），超时返回原图
+GENERATE_TIMEOUT = 30
+
+SIZES = {'thumb': THUMB_SIZE, 'medium': MEDIUM_SIZE}
+MIMETYPE = 'image/webp'
+_QUALITY = {'thumb': 75, 'medium': 82}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def variant_path(original_path, size):
+    return f'{original_path}.{size}.webp'
+
+
+def remove_variants(original_path):
+    """删除图片的所有缩略图"""
+    for size in SIZES:
+        try:
+            os.remove(variant_path(original_path, size))
+        except FileNotFoundError:
+            pass
+
+
+def render_variant(original_path, size):
+    """生成缩略图（在子进程中执行），返回是否生成；不需要或无法生成时返回 False"""
+    target = variant_path(original_path, size)
+    if os.path.exists(target):
+        return True
+    max_edge = SIZES[size]
+    try:
+        with Image.open(original_path) as img:
+            # 动图缩小后会丢失动画，预览图直接使用原图；缩略图取第一帧
+            if getattr(img, 'is_animated', False) and size != 'thumb':
+                return False
+            # JPEG 可以在解码时直接按比例缩小，大图只解码需要的分辨率
+            img.draft('RGB', (max_edge, max_edge))
+            img = ImageOps.exif_transpose(img)
+            has_alpha = img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+            temp = f'{target}.{uuid.uuid4().hex}.tmp'
+            try:
+                img.save(temp, 'WEBP', quality=_QUALITY[size], method=4)
+                os.replace(temp, target)
+            except BaseException:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # 不是可识别的图片，或者图片过大
+        return False
+    return True
+
+
+def _get_pool():
+    global _pool
+    if WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            # 第一次使用时才创建：gunicorn 等多进程部署中，每个工作进程有自己的进程池；
+            # 子进程由 forkserver 启动，不从已有多个线程的应用进程中 fork
+            _pool = process_pool(WORKERS, 'thumbnails')
+        return _pool
+
+
+def generate_async(original_path):
+    """上传后在后台生成所有规格的缩略图"""
+    if not AVAILABLE:
+        return
+    pool = _get_pool()
+    for size in SIZES:
+        if pool is None:
+            threading.Thread(target=render_variant, args=(str(original_path), size), daemon=True).start()
+            continue
+        future = pool.submit(render_variant, str(original_path), size)
+        future.add_done_callback(_log_failure)
+
+
+def _log_failure(future):
+    error = future.exception()
+    if error is not None:
+        logger.error(f"生成缩略图失败: {error}")
+
+
+def ensure_variant(original_path, size):
+    """返回指定规格的图片路径；缩略图不存在时当场生成，无法生成时返回原图路径"""
+    if size not in SIZES or not AVAILABLE:
+        return original_path
+    target = variant_path(original_path, size)
+    if os.path.exists(target):
+        return target
+    try:
+        pool = _get_pool()
+        if pool is None:
+            created = run_blocking(render_variant, str(original_path), size)
+        else:
+            created = wait_future(pool.submit(render_variant, str(original_path), size), GENERATE_TIMEOUT)
+    except Exception as e:
+        logger.error(f"生成缩略图失败 {original_path} ({size}): {e}")
+        return original_path
+    return target if created else original_path
+
@@ -0,0 +1,110 @@
+"""会话令牌
+
+登录成功后签发带有效期的令牌，之后的HTTP请求（Authorization: Bearer <令牌>）和WebSocket连接
+只做一次 HMAC-SHA256 计算和常量时间比较，不再计算 bcrypt，也不查数据库。
+
+令牌格式：<用户名(base64url)>.<过期时间(Unix秒)>.<签名(base64url)>
+签名的内容包括用户名、过期时间和用户当前存储的密码哈希：
+修改密码后旧令牌立即失效，修改用户名后旧令牌也不再对应任何用户。
+
+签名密钥取自环境变量 CHAT_TOKEN_SECRET；未设置时在数据目录中生成 token_secret 文件，
+共享数据目录的多个进程使用同一个密钥。
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+import logging
+
+logger = logging.getLogger('chat_app.tokens')
+
+# 令牌有效期；剩余有效期不足一半时，请求的响应中附带续期的新令牌
+TTL = float(os.environ.get('CHAT_TOKEN_TTL_MINUTES', '120')) * 60
+
+SECRET_FILE_NAME = 'token_secret'
+
+
+class InvalidToken(Exception):
+    """令牌格式错误、签名不匹配或用户已不存在"""
+
+
+class TokenExpired(InvalidToken):
+    """令牌已过期"""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def load_secret(data_dir):
+    """获取签名密钥：优先使用环境变量，否则读取（首次时生成）数据目录中的密钥文件"""
+    secret = os.environ.get('CHAT_TOKEN_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    path = os.path.join(str(data_dir), SECRET_FILE_NAME)
+    try:
+        # 多个进程同时启动时只有一个能创建成功，其余读取该文件
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        pass
+    else:
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        logger.info(f"已生成会话令牌密钥: {path}")
+    # 另一个进程可能刚创建文件、尚未写入内容
+    for _ in range(50):
+        with open(path, 'r') as f:
+            secret = f.read().strip()
+        if secret:
+            return secret.encode('utf-8')
+        time.sleep(0.01)
+    raise RuntimeError(f"会话令牌密钥文件为空: {path}")
+
+
+class TokenSigner:
+    """签发和校验会话令牌"""
+
+    def __init__(self, secret, ttl=TTL):
+        self._secret = secret
+        self.ttl = ttl
+
+    def _sign(self, encoded_user, expires, credential):
+        message = f'{encoded_user}.{expires}.'.encode('ascii') + credential.encode('utf-8')
+        return _b64encode(hmac.new(self._secret, message, hashlib.sha256).digest())
+
+    def issue(self, username, credential, now=None):
+        """签发令牌，credential 为用户当前存储的密码（哈希），返回 (令牌, 过期时间)"""
+        expires = int((now or time.time()) + self.ttl)
+        encoded_user = _b64encode(username.encode('utf-8'))
+        return f'{encoded_user}.{expires}.{self._sign(encoded_user, expires, credential)}', expires
+
+    def verify(self, token, get_credential, now=None):
+        """校验令牌，返回 (用户名, 过期时间)
+
+        get_credential(用户名) 返回用户当前存储的密码，用户不存在时返回 None。
+        校验失败时抛出 InvalidToken，签名有效但已过期时抛出 TokenExpired。
+        """
+        try:
+            encoded_user, expires_text, signature = token.split('.')
+            username = _b64decode(encoded_user).decode('utf-8')
+            expires = int(expires_text)
+        except (ValueError, UnicodeDecodeError):
+            raise InvalidToken('令牌格式错误')
+        credential = get_credential(username)
+        if credential is None:
+            raise InvalidToken('用户不存在')
+        if not hmac.compare_digest(signature, self._sign(encoded_user, expires, credential)):
+            raise InvalidToken('令牌签名不匹配')
+        if expires <= (now or time.time()):
+            raise TokenExpired('令牌已过期')
+        return username, expires
+
+    def needs_renewal(self, expires, now=None):
+        """剩余有效期不足一半时需要续期"""
+        return expires - (now or time.time()) < self.ttl / 2
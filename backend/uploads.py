@@ -0,0 +1,289 @@
+"""分块上传（支持断点续传）
+
+上传分为三步，每一步都是独立的短请求，大文件不会长时间占用一个工作线程/协程：
+    POST   /api/upload/init                   {kind: image|file, filename, size[, sha256]}
+    PUT    /api/upload/<upload_id>?offset=N   请求体为分块的原始字节
+    POST   /api/upload/<upload_id>/complete   校验后写入 images/files 表
+另外 GET /api/upload/<upload_id> 查询已接收的字节数（断点续传），DELETE 放弃上传。
+
+分块直接从请求流写入磁盘（.partial/<upload_id>.part），不在内存中缓存整个文件；
+SHA-256 随分块增量计算。上传会话保存在 upload_sessions 表中，进程重启或分块落到
+其他进程时仍可续传（此时先从磁盘重新计算已接收部分的摘要）。
+超过 EXPIRE_SECONDS 没有写入的会话由后台线程清理。
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+import logging
+from datetime import datetime
+
+import db
+
+logger = logging.getLogger('chat_app.uploads')
+
+# 大小限制和清理周期可通过环境变量调整
+MAX_FILE_SIZE = int(os.environ.get('CHAT_MAX_UPLOAD_MB', '100')) * 1024 * 1024
+MAX_IMAGE_SIZE = int(os.environ.get('CHAT_MAX_IMAGE_MB', '20')) * 1024 * 1024
+# 建议的分块大小，以及单个分块的上限
+CHUNK_SIZE = int(os.environ.get('CHAT_UPLOAD_CHUNK_KB', '1024')) * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+EXPIRE_SECONDS = float(os.environ.get('CHAT_UPLOAD_EXPIRE_HOURS', '24')) * 3600
+REAP_INTERVAL = float(os.environ.get('CHAT_UPLOAD_REAP_INTERVAL', '600'))
+
+KINDS = {'image': MAX_IMAGE_SIZE, 'file': MAX_FILE_SIZE}
+_READ_BLOCK = 64 * 1024
+
+
+class UploadError(Exception):
+    """上传请求错误，status 为对应的HTTP状态码"""
+
+    def __init__(self, msg, status=400, **extra):
+        super().__init__(msg)
+        self.msg = msg
+        self.status = status
+        self.extra = extra
+
+
+class ChunkedUploads:
+    """分块上传会话管理"""
+
+    def __init__(self, upload_dir):
+        self.partial_dir = os.path.join(str(upload_dir), '.partial')
+        os.makedirs(self.partial_dir, exist_ok=True)
+        # 本进程内各上传的增量摘要：upload_id -> (sha256对象, 已计算到的偏移)
+        self._hashers = {}
+        # 同一上传的分块在本进程内串行写入
+        self._writing = set()
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def partial_path(self, upload_id):
+        return os.path.join(self.partial_dir, f'{upload_id}.part')
+
+    def create(self, kind, uploader, filename, size, sha256=None):
+        """创建上传会话，返回会话信息"""
+        if kind not in KINDS:
+            raise UploadError('不支持的上传类型')
+        if not filename:
+            raise UploadError('文件名为空')
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError('文件大小无效')
+        if size > KINDS[kind]:
+            raise UploadError(f'文件大小超过限制（最大 {KINDS[kind] // 1024 // 1024} MB）', 413)
+        if sha256 is not None:
+            sha256 = str(sha256).lower()
+            if len(sha256) != 64 or any(c not in '0123456789abcdef' for c in sha256):
+                raise UploadError('SHA-256 格式无效')
+
+        upload_id = uuid.uuid4().hex
+        open(self.partial_path(upload_id), 'wb').close()
+        with db.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO upload_sessions
+                    (id, kind, uploader, original_name, total_size, received, expected_sha256, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?)
+            ''', (upload_id, kind, uploader, filename, size, sha256, datetime.now().isoformat(), time.time()))
+        return {'upload_id': upload_id, 'received': 0, 'size': size, 'chunk_size': CHUNK_SIZE}
+
+    def get(self, upload_id, uploader):
+        """获取上传会话，不存在或不属于该用户时抛出 UploadError"""
+        with db.connection() as conn:
+            row = conn.execute('''
+                SELECT kind, uploader, original_name, total_size, received, expected_sha256
+                FROM upload_sessions WHERE id = ?
+            ''', (upload_id,)).fetchone()
+        if row is None or row[1] != uploader:
+            raise UploadError('上传不存在或已过期', 404)
+        session = {
+            'upload_id': upload_id,
+            'kind': row[0],
+            'uploader': row[1],
+            'original_name': row[2],
+            'size': row[3],
+            'received': row[4],
+            'expected_sha256': row[5],
+        }
+        # 服务器异常退出时，最后确认的分块可能没有完整落盘，以磁盘上的实际大小为准
+        try:
+            on_disk = os.path.getsize(self.partial_path(upload_id))
+        except OSError:
+            raise UploadError('上传不存在或已过期', 404)
+        if on_disk < session['received']:
+            session['received'] = on_disk
+            self._set_received(upload_id, on_disk)
+        return session
+
+    def write_chunk(self, upload_id, uploader, offset, stream, length):
+        """把请求流中的 length 字节写到 offset 处，返回写入后已接收的字节数
+
+        offset 必须等于已接收的字节数（不允许跳过数据）；不一致时返回409和服务器端的已接收字节数，
+        客户端据此从正确的位置继续。
+        """
+        if length is None:
+            raise UploadError('缺少 Content-Length', 411)
+        if length <= 0 or length > MAX_CHUNK_SIZE:
+            raise UploadError(f'分块大小无效（最大 {MAX_CHUNK_SIZE // 1024 // 1024} MB）', 413)
+
+        with self._lock:
+            if upload_id in self._writing:
+                raise UploadError('该上传正在写入其他分块', 409)
+            self._writing.add(upload_id)
+        try:
+            session = self.get(upload_id, uploader)
+            received = session['received']
+            if offset != received:
+                raise UploadError('分块偏移与已接收的字节数不一致', 409, received=received)
+            if offset + length > session['size']:
+                raise UploadError('分块超出文件大小', 400, received=received)
+
+            hasher = self._hasher_at(upload_id, offset)
+            written = 0
+            try:
+                with open(self.partial_path(upload_id), 'r+b') as f:
+                    f.seek(offset)
+                    f.truncate()
+                    while written < length:
+                        block = stream.read(min(_READ_BLOCK, length - written))
+                        if not block:
+                            break
+                        f.write(block)
+                        hasher.update(block)
+                        written += len(block)
+            except BaseException:
+                # 摘要已包含不完整的数据，丢弃，下次从磁盘重新计算
+                self._drop_hasher(upload_id)
+                raise
+            if written != length:
+                self._drop_hasher(upload_id)
+                raise UploadError('分块数据不完整', 400, received=received)
+
+            if not self._set_received(upload_id, offset + written, expected=offset):
+                self._drop_hasher(upload_id)
+                raise UploadError('该上传已被其他请求修改', 409)
+            with self._lock:
+                self._hashers[upload_id] = (hasher, offset + written)
+            return offset + written
+        finally:
+            with self._lock:
+                self._writing.discard(upload_id)
+
+    def finish(self, upload_id, uploader):
+        """校验上传是否完整，返回 (会话信息, 临时文件路径, SHA-256)
+
+        调用方在登记附件的写事务中先调用 claim() 认领会话，再移动临时文件、写入数据库，最后调用 discard()。
+        """
+        session = self.get(upload_id, uploader)
+        if session['received'] != session['size']:
+            raise UploadError('上传尚未完成', 409, received=session['received'])
+        try:
+            digest = self._hasher_at(upload_id, session['size']).hexdigest()
+        except FileNotFoundError:
+            # 并发的另一个请求已经完成了这次上传，临时文件已被移走
+            raise UploadError('上传不存在或已过期', 404)
+        if session['expected_sha256'] and digest != session['expected_sha256']:
+            self.discard(upload_id)
+            raise UploadError('文件校验失败，请重新上传', 422)
+        return session, self.partial_path(upload_id), digest
+
+    def claim(self, cursor, upload_id):
+        """在完成上传的写事务中认领会话（删除会话记录），会话已被其他请求认领或已过期时抛出 UploadError
+
+        同一上传并发的两个 complete 请求只有一个能认领成功，另一个在登记附件之前失败，不会登记两次。
+        """
+        cursor.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+        if cursor.rowcount != 1:
+            raise UploadError('上传不存在或已过期', 404)
+
+    def discard(self, upload_id, cursor=None):
+        """删除上传会话和临时文件"""
+        self._drop_hasher(upload_id)
+        if cursor is not None:
+            cursor.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+        else:
+            with db.transaction() as cursor:
+                cursor.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+        try:
+            os.remove(self.partial_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def reap(self, now=None):
+        """清理过期的上传会话和没有对应会话的临时文件，返回清理的数量"""
+        cutoff = (now or time.time()) - EXPIRE_SECONDS
+        with db.transaction() as cursor:
+            expired = [row[0] for row in cursor.execute(
+                'SELECT id FROM upload_sessions WHERE updated_at < ?', (cutoff,)).fetchall()]
+            cursor.execute('DELETE FROM upload_sessions WHERE updated_at < ?', (cutoff,))
+            active = {row[0] for row in cursor.execute('SELECT id FROM upload_sessions').fetchall()}
+
+        removed = 0
+        for upload_id in expired:
+            self._drop_hasher(upload_id)
+        for name in os.listdir(self.partial_dir):
+            upload_id, ext = os.path.splitext(name)
+            path = os.path.join(self.partial_dir, name)
+            # .tmp 为普通上传写入中的临时文件（见 blobs.py），进程异常退出时可能残留
+            if ext not in ('.part', '.tmp') or upload_id in active:
+                continue
+            try:
+                # 刚创建、会话尚未提交的文件不删除
+                if upload_id in expired or os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        if expired or removed:
+            logger.info(f"已清理 {len(expired)} 个过期上传会话，删除 {removed} 个临时文件")
+        return removed
+
+    def start_reaper(self, interval=REAP_INTERVAL):
+        """启动定期清理过期上传的后台线程"""
+        if self._reaper is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reap()
+                except Exception as e:
+                    logger.error(f"清理过期上传失败: {e}")
+
+        self._reaper = threading.Thread(target=run, name='upload-reaper', daemon=True)
+        self._reaper.start()
+
+    def _set_received(self, upload_id, received, expected=None):
+        """更新已接收字节数；给出 expected 时只有当前值等于 expected 才更新"""
+        with db.transaction() as cursor:
+            if expected is None:
+                cursor.execute('UPDATE upload_sessions SET received = ?, updated_at = ? WHERE id = ?',
+                               (received, time.time(), upload_id))
+            else:
+                cursor.execute('''
+                    UPDATE upload_sessions SET received = ?, updated_at = ?
+                    WHERE id = ? AND received = ?
+                ''', (received, time.time(), upload_id, expected))
+            return cursor.rowcount == 1
+
+    def _hasher_at(self, upload_id, offset):
+        """返回已计算到 offset 的摘要对象；本进程没有缓存时从磁盘重新计算"""
+        with self._lock:
+            cached = self._hashers.get(upload_id)
+        if cached is not None and cached[1] == offset:
+            return cached[0].copy()
+        hasher = hashlib.sha256()
+        remaining = offset
+        with open(self.partial_path(upload_id), 'rb') as f:
+            while remaining > 0:
+                block = f.read(min(_READ_BLOCK, remaining))
+                if not block:
+                    break
+                hasher.update(block)
+                remaining -= len(block)
+        return hasher
+
+    def _drop_hasher(self, upload_id):
+        with self._lock:
+            self._hashers.pop(upload_id, None)
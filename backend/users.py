@@ -0,0 +1,135 @@
+"""用户目录和管理员列表缓存
+
+users.json 和 ops.json 只在文件发生变化（mtime/inode/大小）或通过 save() 写入时重新加载，
+用户存在性检查和管理员检查直接查内存，不再每个请求都打开并解析JSON文件。
+文件变化检测最多每 check_interval 秒执行一次 stat。
+"""
+import abc
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+import logging
+
+logger = logging.getLogger('chat_app.users')
+
+
+class _JsonFileCache(abc.ABC):
+    """JSON文件的内存缓存，文件在外部被修改时重新加载"""
+
+    # 日志中的名称
+    label = 'JSON文件'
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = str(path)
+        self.check_interval = check_interval
+        self._data = self._parse(None)
+        self._signature = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self._reload()
+
+    @abc.abstractmethod
+    def _parse(self, data):
+        """把文件内容转换为缓存的数据，文件不存在时 data 为 None"""
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+    def _reload(self):
+        """从磁盘重新加载"""
+        with self._lock:
+            signature = self._stat_signature()
+            if signature is None:
+                data = self._parse(None)
+            else:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = self._parse(json.load(f))
+            # 整体替换引用，读取方无需加锁
+            self._data = data
+            self._signature = signature
+            self._last_check = time.monotonic()
+        logger.info(f"已加载{self.label}，共 {len(data)} 项")
+
+    def _refresh(self):
+        """文件在外部被修改时重新加载"""
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if self._stat_signature() != self._signature:
+            try:
+                self._reload()
+            except (OSError, ValueError) as e:
+                # 文件正在被外部编辑或格式错误时继续使用旧数据
+                logger.error(f"重新加载{self.label}失败: {e}")
+
+
+class OpsList(_JsonFileCache):
+    """ops.json（管理员用户名列表）的内存缓存"""
+
+    label = '管理员列表'
+
+    def _parse(self, data):
+        return frozenset(data or ())
+
+    def contains(self, username):
+        """检查用户是否为管理员"""
+        if not username:
+            return False
+        self._refresh()
+        return username in self._data
+
+
+class UserDirectory(_JsonFileCache):
+    """users.json 的内存缓存，写入时使用临时文件+重命名保证原子性"""
+
+    label = '用户目录'
+
+    def _parse(self, data):
+        return data or {}
+
+    def exists(self, username):
+        """检查用户是否存在"""
+        if not username:
+            return False
+        self._refresh()
+        return username in self._data
+
+    def get_password(self, username):
+        """获取用户存储的密码（哈希或明文），用户不存在时返回None"""
+        self._refresh()
+        return self._data.get(username)
+
+    def snapshot(self):
+        """返回用户数据的副本，供需要修改后再 save() 的调用方使用"""
+        self._refresh()
+        return dict(self._data)
+
+    def save(self, users):
+        """原子写入用户数据并更新缓存"""
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            fd, tmp_path = tempfile.mkstemp(prefix='.users-', suffix='.json.tmp', dir=directory)
+            try:
+                # 保持原文件的权限
+                if os.path.exists(self.path):
+                    os.chmod(tmp_path, stat.S_IMODE(os.stat(self.path).st_mode))
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(users, f, ensure_ascii=False, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            self._data = dict(users)
+            self._signature = self._stat_signature()
+            self._last_check = time.monotonic()
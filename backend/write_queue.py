@@ -0,0 +1,121 @@
+"""消息写入队列（组提交）
+
+开启后，消息写入不再在请求线程中各自开启事务并提交，而是放入进程内队列，
+由单个写线程批量取出，在同一个事务中执行并一次提交（一次fsync）。
+调用方通过 submit() 返回的 Future 等待所在批次提交完成，拿到写入结果
+（例如分配的消息ID）后再发送WebSocket事件，保证事件不会早于数据落库。
+等待最多 WAIT_TIMEOUT 秒：写线程卡住或已退出时调用方按写入失败处理，不会一直阻塞；
+超时的写操作如果还没有被写线程取出会被取消，不再写入。
+
+每条写入在独立的 SAVEPOINT 中执行，单条失败只回滚该条，不影响同批次的其他写入。
+"""
+import os
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+import db
+
+logger = logging.getLogger('chat_app.write_queue')
+
+# 是否启用写入队列，以及批次大小和最长等待时间，可通过环境变量调整
+ENABLED = os.environ.get('CHAT_WRITE_QUEUE', '0') == '1'
+BATCH_SIZE = int(os.environ.get('CHAT_WRITE_QUEUE_BATCH_SIZE', '64'))
+# 最长等待时间为0时不额外等待：写线程每次取走队列中已有的全部写操作，
+# 提交期间到达的写操作自然进入下一批（批次大小随负载自适应）
+MAX_DELAY_MS = float(os.environ.get('CHAT_WRITE_QUEUE_MAX_DELAY_MS', '0'))
+# 调用方等待写入结果的最长时间（秒）
+WAIT_TIMEOUT = float(os.environ.get('CHAT_WRITE_QUEUE_TIMEOUT', '10'))
+
+
+class WriteQueue:
+    """把写操作合并成批次提交的队列，只有一个写线程"""
+
+    def __init__(self, batch_size=BATCH_SIZE, max_delay_ms=MAX_DELAY_MS):
+        self.batch_size = batch_size
+        self.max_delay = max_delay_ms / 1000
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='message-write-queue', daemon=True)
+        self._thread.start()
+
+    def submit(self, write_fn):
+        """提交一个写操作 write_fn(cursor)，返回在批次提交后完成的 Future"""
+        if self._stopped.is_set() or not self._thread.is_alive():
+            raise RuntimeError('写入队列已停止')
+        future = Future()
+        self._queue.put((write_fn, future))
+        return future
+
+    def stop(self, timeout=None):
+        """停止写线程，已提交的写操作会先全部处理完"""
+        self._stopped.set()
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _collect_batch(self):
+        """阻塞等待第一条写操作，然后在批次大小或时间阈值内继续收集队列中的写操作"""
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # 停止信号放回队列，处理完本批次后退出
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                # 意外错误不能让写线程退出，否则之后的写操作都无人处理
+                logger.exception(f"处理写入批次时出错: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _write_batch(self, batch):
+        # 跳过调用方等待超时后已取消的写操作
+        batch = [(write_fn, future) for write_fn, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        results = []
+        try:
+            with db.transaction() as cursor:
+                for write_fn, future in batch:
+                    cursor.execute('SAVEPOINT write_item')
+                    try:
+                        results.append((future, write_fn(cursor), None))
+                        cursor.execute('RELEASE write_item')
+                    except Exception as e:
+                        cursor.execute('ROLLBACK TO write_item')
+                        cursor.execute('RELEASE write_item')
+                        results.append((future, None, e))
+        except Exception as e:
+            # 提交失败，整个批次都没有落库
+            logger.error(f"批量写入失败（{len(batch)} 条）: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        # 提交成功后才通知调用方
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
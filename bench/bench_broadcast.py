@@ -0,0 +1,224 @@
+"""公告广播/多播吞吐基准：发送成本与接收者数量的关系，以及WebSocket推送的送达延迟
+
+在临时数据目录中创建大量用户，启动本地实例，然后：
+1. 连接若干个Socket.IO客户端（不同用户），管理员反复广播公告（不指定接收者），
+   测量发送接口的延迟和每个客户端收到 announcement 事件的延迟
+2. 对不同大小的接收者列表（多播）测量发送接口的延迟
+3. 作为对比，按原来的做法逐个调用 /api/send-message 向同样数量的用户发送消息，测量总耗时
+4. 测量接收者读取公告列表（/api/announcements，包含未读数）的延迟
+报告为JSON。
+
+需要 python-socketio 客户端：
+    pip install "python-socketio[client]"
+    python bench/bench_broadcast.py --users 20000 --sizes 10,100,1000,10000
+"""
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+from datetime import datetime
+
+import requests
+import socketio
+
+from load_test import _git_commit, summarize
+from local_instance import (auth_headers, free_port, login, make_data_dir, start_instance,
+                            stop_instance, wait_for_port)
+
+ADMIN = 'broadcast_admin'
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='公告广播/多播吞吐基准')
+    parser.add_argument('--async-mode', default='threading', choices=['threading', 'eventlet', 'gevent'],
+                        help='本地实例的异步模式')
+    parser.add_argument('--users', type=int, default=20000, help='注册用户数')
+    parser.add_argument('--sockets', type=int, default=50, help='接收广播的WebSocket客户端数')
+    parser.add_argument('--broadcasts', type=int, default=20, help='广播次数')
+    parser.add_argument('--sizes', default='10,100,1000,10000', help='多播的接收者数（逗号分隔）')
+    parser.add_argument('--repeat', type=int, default=5, help='每种多播大小的发送次数')
+    parser.add_argument('--baseline', type=int, default=200,
+                        help='逐个调用 /api/send-message 的用户数（0 表示不测）')
+    parser.add_argument('--reads', type=int, default=200, help='读取公告列表的次数')
+    parser.add_argument('--output', help='报告输出文件，不指定时打印到标准输出')
+    return parser.parse_args()
+
+
+class Receivers:
+    """若干个接收广播的WebSocket客户端，记录每条公告到达各客户端的时间"""
+
+    def __init__(self, base_url, users):
+        self.base_url = base_url
+        self.users = users
+        self.clients = []
+        self.arrivals = {}
+        self.connect_errors = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        session = requests.Session()
+        for user in self.users:
+            client = socketio.Client(reconnection=False)
+
+            @client.on('announcement')
+            def on_announcement(data):
+                received = time.perf_counter()
+                with self._lock:
+                    self.arrivals.setdefault(data.get('id'), []).append(received)
+
+            try:
+                client.connect(self.base_url, transports=['websocket', 'polling'], wait_timeout=10,
+                               auth={'token': login(self.base_url, user, user, session=session)})
+                self.clients.append(client)
+            except Exception:
+                self.connect_errors += 1
+
+    def wait(self, announcement_id, timeout):
+        """等待所有客户端收到公告，返回各客户端的到达时间"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                arrivals = list(self.arrivals.get(announcement_id, []))
+            if len(arrivals) >= len(self.clients):
+                return arrivals
+            time.sleep(0.005)
+        return arrivals
+
+    def close(self):
+        for client in self.clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+
+def _send(session, base_url, headers, content, recipients=None):
+    """发送一条公告，返回 (公告ID, 发送开始时间, 接口延迟)"""
+    payload = {'content': content}
+    if recipients is not None:
+        payload['recipients'] = recipients
+    started = time.perf_counter()
+    response = session.post(f'{base_url}/api/announcements', json=payload, headers=headers, timeout=120)
+    latency = time.perf_counter() - started
+    response.raise_for_status()
+    return response.json()['announcement']['id'], started, latency
+
+
+def bench_broadcast(session, base_url, headers, receivers, count):
+    send_latencies = []
+    delivery_latencies = []
+    missed = 0
+    start = time.perf_counter()
+    for i in range(count):
+        announcement_id, started, latency = _send(session, base_url, headers, f'广播 {i}')
+        send_latencies.append(latency)
+        arrivals = receivers.wait(announcement_id, timeout=10)
+        delivery_latencies.extend(arrival - started for arrival in arrivals)
+        missed += len(receivers.clients) - len(arrivals)
+    elapsed = time.perf_counter() - start
+    return {
+        'send': summarize(send_latencies, elapsed),
+        'delivery': summarize(delivery_latencies, elapsed),
+        'clients': len(receivers.clients),
+        'missed': missed,
+    }
+
+
+def bench_multicast(session, base_url, headers, users, sizes, repeat):
+    results = {}
+    for size in sizes:
+        recipients = users[:size]
+        latencies = []
+        start = time.perf_counter()
+        for i in range(repeat):
+            _, _, latency = _send(session, base_url, headers, f'多播 {size} {i}', recipients)
+            latencies.append(latency)
+        results[str(size)] = summarize(latencies, time.perf_counter() - start)
+    return results
+
+
+def bench_per_user_messages(session, base_url, headers, users):
+    """原来的做法：逐个用户调用 /api/send-message"""
+    start = time.perf_counter()
+    errors = 0
+    for user in users:
+        response = session.post(f'{base_url}/api/send-message', json={'recipient': user, 'content': '公告'},
+                                headers=headers, timeout=30)
+        if response.status_code != 200:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    return {'recipients': len(users), 'total_ms': round(elapsed * 1000, 3),
+            'per_recipient_ms': round(elapsed * 1000 / len(users), 3), 'errors': errors}
+
+
+def bench_reads(base_url, user, count):
+    session = requests.Session()
+    headers = auth_headers(user, login(base_url, user, user, session=session))
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(count):
+        started = time.perf_counter()
+        response = session.get(f'{base_url}/api/announcements', headers=headers, timeout=30)
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - started)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def main():
+    args = _parse_args()
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    users = [f'bc_user_{i:06d}' for i in range(max(args.users, max(sizes, default=0), args.sockets))]
+    accounts = {user: user for user in users}
+    accounts[ADMIN] = ADMIN
+    data_dir = make_data_dir(accounts)
+    with open(f'{data_dir}/ops.json', 'w', encoding='utf-8') as f:
+        json.dump([ADMIN], f)
+
+    port = free_port()
+    instance = start_instance(port, data_dir, async_mode=args.async_mode)
+    base_url = f'http://127.0.0.1:{port}'
+    receivers = None
+    try:
+        if not wait_for_port(port, 30):
+            raise SystemExit('本地实例启动超时')
+        session = requests.Session()
+        headers = auth_headers(ADMIN, login(base_url, ADMIN, ADMIN, session=session))
+
+        receivers = Receivers(base_url, users[-args.sockets:] if args.sockets else [])
+        receivers.connect()
+        broadcast = bench_broadcast(session, base_url, headers, receivers, args.broadcasts)
+        multicast = bench_multicast(session, base_url, headers, users, sizes, args.repeat)
+        baseline = (bench_per_user_messages(session, base_url, headers, users[:args.baseline])
+                    if args.baseline else None)
+        reads = bench_reads(base_url, users[0], args.reads)
+    finally:
+        if receivers is not None:
+            receivers.close()
+        stop_instance(instance)
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'started_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        },
+        'broadcast': broadcast,
+        'multicast': multicast,
+        'per_user_messages': baseline,
+        'reads': reads,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f'报告已写入 {args.output}', file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
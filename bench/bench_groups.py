@@ -0,0 +1,196 @@
+"""群聊基准：发送消息和未读数的延迟随群聊人数的变化
+
+在临时数据目录中创建用户和不同人数的群聊（例如10、100、1000、5000人），启动本地实例，然后对每个群聊：
+1. 若干个成员连接Socket.IO客户端，按顺序发送消息，测量发送接口的延迟和客户端收到 group_message 的延迟
+2. 另一个成员反复读取群聊列表（/api/groups，包含各群聊的未读数）和标记已读，测量延迟
+消息只保存一份、每条消息只推送一次、未读数按已读位置计算，这些延迟应当基本不随人数变化。
+报告为JSON。
+
+需要 python-socketio 客户端：
+    pip install "python-socketio[client]"
+    python bench/bench_groups.py --sizes 10,100,1000,5000 --messages 200
+"""
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+from datetime import datetime
+
+import requests
+import socketio
+
+from load_test import _git_commit, summarize
+from local_instance import (auth_headers, free_port, login, make_data_dir, start_instance,
+                            stop_instance, wait_for_port)
+
+OWNER = 'group_owner'
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='群聊发送和未读数基准')
+    parser.add_argument('--async-mode', default='threading', choices=['threading', 'eventlet', 'gevent'],
+                        help='本地实例的异步模式')
+    parser.add_argument('--sizes', default='10,100,1000,5000', help='群聊人数（逗号分隔）')
+    parser.add_argument('--messages', type=int, default=200, help='每个群聊发送的消息数')
+    parser.add_argument('--sockets', type=int, default=10, help='每个群聊中连接WebSocket的成员数')
+    parser.add_argument('--reads', type=int, default=200, help='读取群聊列表和标记已读的次数')
+    parser.add_argument('--output', help='报告输出文件，不指定时打印到标准输出')
+    return parser.parse_args()
+
+
+class Listeners:
+    """若干个成员的WebSocket客户端，记录每条群聊消息到达的时间"""
+
+    def __init__(self, base_url, tokens):
+        self.base_url = base_url
+        self.tokens = tokens
+        self.clients = []
+        self.arrivals = {}
+        self._lock = threading.Lock()
+
+    def connect(self):
+        # 连接时服务端让客户端加入其所在的全部群聊房间
+        for user, token in self.tokens.items():
+            client = socketio.Client(reconnection=False)
+
+            @client.on('group_message')
+            def on_group_message(data):
+                received = time.perf_counter()
+                with self._lock:
+                    self.arrivals.setdefault(data.get('id'), []).append(received)
+
+            client.connect(self.base_url, transports=['websocket', 'polling'], wait_timeout=10,
+                           auth={'token': token})
+            self.clients.append(client)
+
+    def wait(self, message_id, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                arrivals = list(self.arrivals.get(message_id, []))
+            if len(arrivals) >= len(self.clients):
+                return arrivals
+            time.sleep(0.002)
+        return arrivals
+
+    def close(self):
+        for client in self.clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+
+def bench_group(base_url, group_id, sender_headers, listeners, messages):
+    session = requests.Session()
+    send_latencies = []
+    delivery_latencies = []
+    missed = 0
+    start = time.perf_counter()
+    for i in range(messages):
+        started = time.perf_counter()
+        response = session.post(f'{base_url}/api/groups/{group_id}/messages', json={'content': f'消息 {i}'},
+                                headers=sender_headers, timeout=30)
+        send_latencies.append(time.perf_counter() - started)
+        response.raise_for_status()
+        arrivals = listeners.wait(response.json()['message_id'], timeout=10)
+        delivery_latencies.extend(arrival - started for arrival in arrivals)
+        missed += len(listeners.clients) - len(arrivals)
+    elapsed = time.perf_counter() - start
+    return {
+        'send': summarize(send_latencies, elapsed),
+        'delivery': summarize(delivery_latencies, elapsed),
+        'missed': missed,
+    }
+
+
+def bench_unread(base_url, group_id, headers, count):
+    """成员读取群聊列表（含未读数）并标记已读"""
+    session = requests.Session()
+    list_latencies = []
+    read_latencies = []
+    unread = None
+    start = time.perf_counter()
+    for _ in range(count):
+        started = time.perf_counter()
+        groups = session.get(f'{base_url}/api/groups', headers=headers, timeout=30).json()['groups']
+        list_latencies.append(time.perf_counter() - started)
+        if unread is None:
+            unread = next(g['unread'] for g in groups if g['id'] == group_id)
+        started = time.perf_counter()
+        session.post(f'{base_url}/api/groups/{group_id}/read', headers=headers, timeout=30)
+        read_latencies.append(time.perf_counter() - started)
+    elapsed = time.perf_counter() - start
+    return {'unread_before_read': unread, 'list': summarize(list_latencies, elapsed),
+            'mark_read': summarize(read_latencies, elapsed)}
+
+
+def main():
+    args = _parse_args()
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    users = [f'grp_user_{i:06d}' for i in range(max(sizes))]
+    accounts = {user: user for user in users}
+    accounts[OWNER] = OWNER
+    data_dir = make_data_dir(accounts)
+
+    port = free_port()
+    instance = start_instance(port, data_dir, async_mode=args.async_mode,
+                              extra_env={'CHAT_GROUP_MAX_MEMBERS': str(max(sizes) + 1)})
+    base_url = f'http://127.0.0.1:{port}'
+    results = {}
+    try:
+        if not wait_for_port(port, 30):
+            raise SystemExit('本地实例启动超时')
+        session = requests.Session()
+        owner_headers = auth_headers(OWNER, login(base_url, OWNER, OWNER, session=session))
+        # 最后一个用户只读取未读数，不连接WebSocket，也不发送消息
+        reader = users[-1]
+        reader_headers = auth_headers(reader, login(base_url, reader, reader, session=session))
+        listener_tokens = {user: login(base_url, user, user, session=session) for user in users[:args.sockets]}
+
+        for size in sizes:
+            # 所有群聊都包含连接WebSocket的成员和读取者，加上创建者共 size 人
+            members = list(dict.fromkeys(users[:args.sockets] + [reader] + users))[:size - 1]
+            started = time.perf_counter()
+            response = session.post(f'{base_url}/api/groups', json={'name': f'{size}人', 'members': members},
+                                    headers=owner_headers, timeout=120)
+            response.raise_for_status()
+            group = response.json()['group']
+            create_ms = round((time.perf_counter() - started) * 1000, 3)
+
+            listeners = Listeners(base_url, listener_tokens)
+            listeners.connect()
+            try:
+                result = bench_group(base_url, group['id'], owner_headers, listeners, args.messages)
+            finally:
+                listeners.close()
+            result.update(bench_unread(base_url, group['id'], reader_headers, args.reads))
+            result.update({'members': group['memberCount'], 'create_ms': create_ms,
+                           'listeners': len(listeners.clients)})
+            results[str(size)] = result
+    finally:
+        stop_instance(instance)
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'started_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        },
+        'groups': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f'报告已写入 {args.output}', file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""登录吞吐基准：bcrypt 进程池、排队上限，以及登录高峰对普通请求的影响
+
+在临时数据目录中启动本地实例（用户密码为 bcrypt 哈希），然后：
+- 多个线程不间断地请求 /api/login（一部分使用错误的密码，模拟撞库），
+  统计每秒完成的密码校验数、状态码（503 为排队已满被拒绝）和延迟
+- 同时按固定速率以已登录用户的令牌请求 /api/unread-messages，
+  测量登录高峰期间普通请求的延迟（bcrypt 占满工作线程时这里的延迟会明显上升）
+- 另外在本进程中测量一次令牌校验的耗时
+
+用法：
+    python bench/bench_login.py --concurrency 32 --duration 10
+    python bench/bench_login.py --workers 0             # 在请求线程中计算 bcrypt，作为对比
+    python bench/bench_login.py --queue 8 --output login.json
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+import bcrypt
+import requests
+
+from load_test import _git_commit, summarize
+from local_instance import (BACKEND_DIR, auth_headers, free_port, login, make_data_dir,
+                            start_instance, stop_instance, wait_for_port)
+
+sys.path.insert(0, str(BACKEND_DIR))
+
+import tokens  # noqa: E402
+
+PASSWORD = 'bench-password'
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='登录吞吐基准')
+    parser.add_argument('--async-mode', default='threading', choices=['threading', 'eventlet', 'gevent'],
+                        help='本地实例的异步模式')
+    parser.add_argument('--users', type=int, default=20, help='用户数')
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt 的 cost 参数')
+    parser.add_argument('--workers', type=int, help='CHAT_BCRYPT_WORKERS（0 表示在请求线程中计算）')
+    parser.add_argument('--queue', type=int, help='CHAT_BCRYPT_QUEUE')
+    parser.add_argument('--concurrency', type=int, default=32, help='并发登录的线程数')
+    parser.add_argument('--wrong-ratio', type=float, default=0.5, help='使用错误密码的比例')
+    parser.add_argument('--probe-rate', type=float, default=20, help='普通请求的速率（次/秒）')
+    parser.add_argument('--duration', type=float, default=10, help='压测时长（秒）')
+    parser.add_argument('--seed', type=int, default=1, help='随机数种子')
+    parser.add_argument('--output', help='报告输出文件，不指定时打印到标准输出')
+    return parser.parse_args()
+
+
+class LoginLoad:
+    """多个线程不间断地登录，记录状态码和延迟"""
+
+    def __init__(self, base_url, users, concurrency, wrong_ratio, duration, seed):
+        self.base_url = base_url
+        self.users = users
+        self.concurrency = concurrency
+        self.wrong_ratio = wrong_ratio
+        self.duration = duration
+        self.seed = seed
+        # 完成了密码校验的请求（200 和 401）的延迟，以及被拒绝（503）的请求的延迟
+        self.verified = []
+        self.rejected = []
+        self.status_codes = {}
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _worker(self, index, deadline):
+        rng = random.Random(self.seed * 1000 + index)
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            user = rng.choice(self.users)
+            password = PASSWORD if rng.random() >= self.wrong_ratio else 'wrong-password'
+            started = time.perf_counter()
+            try:
+                response = session.post(f'{self.base_url}/api/login', timeout=60,
+                                        json={'username': user, 'password': password})
+                status = str(response.status_code)
+            except requests.RequestException:
+                status = None
+            latency = time.perf_counter() - started
+            with self._lock:
+                if status is None:
+                    self.errors += 1
+                    continue
+                self.status_codes[status] = self.status_codes.get(status, 0) + 1
+                if status in ('200', '401'):
+                    self.verified.append(latency)
+                elif status == '503':
+                    self.rejected.append(latency)
+                else:
+                    self.errors += 1
+
+    def run(self):
+        start = time.perf_counter()
+        deadline = start + self.duration
+        threads = [threading.Thread(target=self._worker, args=(i, deadline), daemon=True)
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start
+
+    def report(self):
+        return {
+            'elapsed_s': round(self.elapsed, 3),
+            'verified': summarize(self.verified, self.elapsed),
+            'rejected': summarize(self.rejected, self.elapsed),
+            'status_codes': self.status_codes,
+            'errors': self.errors,
+        }
+
+
+class ProbeLoad:
+    """按固定速率发送普通请求，延迟从计划发送时间开始计算"""
+
+    def __init__(self, base_url, user, token, rate, duration):
+        self.url = f'{base_url}/api/unread-messages'
+        self.headers = auth_headers(user, token)
+        self.rate = rate
+        self.duration = duration
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        session = requests.Session()
+        start = time.perf_counter()
+        total = int(self.rate * self.duration)
+        for ticket in range(total):
+            scheduled = start + ticket / self.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                response = session.get(self.url, headers=self.headers, timeout=60)
+                ok = response.status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                self.latencies.append(time.perf_counter() - scheduled)
+            else:
+                self.errors += 1
+        self.elapsed = time.perf_counter() - start
+
+    def report(self):
+        summary = summarize(self.latencies, self.elapsed)
+        summary['errors'] = self.errors
+        return summary
+
+
+def measure_token_verify(iterations=100000):
+    """本进程中校验一个有效令牌的平均耗时（微秒）"""
+    signer = tokens.TokenSigner(b'0' * 64)
+    credential = bcrypt.hashpw(b'x', bcrypt.gensalt(4)).decode('utf-8')
+    token, _ = signer.issue('bench_user', credential)
+    get_credential = {'bench_user': credential}.get
+    started = time.perf_counter()
+    for _ in range(iterations):
+        signer.verify(token, get_credential)
+    return round((time.perf_counter() - started) / iterations * 1e6, 3)
+
+
+def main():
+    args = _parse_args()
+    users = [f'login_user_{i:04d}' for i in range(args.users)]
+    # 所有用户使用同一个哈希，不影响校验的计算量
+    hashed = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(args.rounds)).decode('utf-8')
+    data_dir = make_data_dir({user: hashed for user in users})
+
+    env = {}
+    if args.workers is not None:
+        env['CHAT_BCRYPT_WORKERS'] = str(args.workers)
+    if args.queue is not None:
+        env['CHAT_BCRYPT_QUEUE'] = str(args.queue)
+    port = free_port()
+    instance = start_instance(port, data_dir, async_mode=args.async_mode, extra_env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        if not wait_for_port(port, 30):
+            raise SystemExit('本地实例启动超时')
+        probe_token = login(base_url, users[0], PASSWORD)
+
+        login_load = LoginLoad(base_url, users, args.concurrency, args.wrong_ratio, args.duration, args.seed)
+        probe_load = ProbeLoad(base_url, users[0], probe_token, args.probe_rate, args.duration)
+        probe_thread = threading.Thread(target=probe_load.run, daemon=True)
+        probe_thread.start()
+        login_load.run()
+        probe_thread.join()
+    finally:
+        stop_instance(instance)
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'started_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        },
+        'login': login_load.report(),
+        'probe': probe_load.report(),
+        'token_verify_us': measure_token_verify(),
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f'报告已写入 {args.output}', file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""音乐接口缓存基准：缓存命中率、请求合并和错误缓存（离线，使用 fake_music.py 代替网易云音乐）
+
+在后台启动模拟的上游接口（带固定延迟），再启动一个指向它的本地实例（CHAT_MUSIC_UPSTREAM），然后：
+1. 多个线程按偏斜分布（少数热门关键词和歌曲占大多数请求）混合请求搜索、详情和歌词
+2. 许多客户端同时发起同一个新的搜索，检查上游只收到一次请求
+3. 反复请求一个上游会出错的搜索，检查错误结果被缓存
+报告为JSON：各接口的客户端请求数和延迟、上游实际收到的请求数、/metrics 中的缓存命中统计。
+
+用法：
+    python bench/bench_music.py --duration 10 --latency-ms 80
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+import fake_music
+from load_test import _git_commit, summarize
+from local_instance import (auth_headers, free_port, login, make_data_dir, start_instance,
+                            stop_instance, wait_for_port)
+
+ADMIN = 'music_admin'
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='音乐接口缓存基准')
+    parser.add_argument('--async-mode', default='threading', choices=['threading', 'eventlet', 'gevent'],
+                        help='本地实例的异步模式')
+    parser.add_argument('--latency-ms', type=float, default=80, help='模拟上游每个请求的延迟（毫秒）')
+    parser.add_argument('--concurrency', type=int, default=16, help='请求线程数')
+    parser.add_argument('--duration', type=float, default=10, help='混合负载的时长（秒）')
+    parser.add_argument('--keywords', type=int, default=200, help='关键词总数')
+    parser.add_argument('--songs', type=int, default=2000, help='歌曲总数')
+    parser.add_argument('--burst', type=int, default=32, help='同时发起相同搜索的客户端数')
+    parser.add_argument('--seed', type=int, default=1, help='随机数种子')
+    parser.add_argument('--output', help='报告输出文件，不指定时打印到标准输出')
+    return parser.parse_args()
+
+
+def _skewed(rng, count):
+    """偏斜分布的下标：约80%的请求落在前20%"""
+    return min(count - 1, int(rng.paretovariate(1.16)) - 1)
+
+
+class MusicLoad:
+    def __init__(self, base_url, headers, args):
+        self.base_url = base_url
+        self.headers = headers
+        self.args = args
+        self.results = {name: {'latencies': [], 'errors': 0} for name in ('search', 'detail', 'lyric')}
+        self._lock = threading.Lock()
+
+    def _worker(self, index, deadline):
+        rng = random.Random(self.args.seed * 1000 + index)
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            name = rng.choices(['search', 'detail', 'lyric'], [5, 3, 2])[0]
+            if name == 'search':
+                url = f'{self.base_url}/api/music/search'
+                params = {'keyword': f'关键词{_skewed(rng, self.args.keywords)}'}
+            else:
+                url = f'{self.base_url}/api/music/{name}'
+                params = {'id': 100000 + _skewed(rng, self.args.songs)}
+            started = time.perf_counter()
+            try:
+                ok = session.get(url, params=params, headers=self.headers, timeout=30).status_code == 200
+            except requests.RequestException:
+                ok = False
+            latency = time.perf_counter() - started
+            with self._lock:
+                if ok:
+                    self.results[name]['latencies'].append(latency)
+                else:
+                    self.results[name]['errors'] += 1
+
+    def run(self):
+        start = time.perf_counter()
+        threads = [threading.Thread(target=self._worker, args=(i, start + self.args.duration), daemon=True)
+                   for i in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start
+
+    def report(self):
+        endpoints = {}
+        for name, result in self.results.items():
+            summary = summarize(result['latencies'], self.elapsed)
+            summary['errors'] = result['errors']
+            endpoints[name] = summary
+        return endpoints
+
+
+def burst(base_url, headers, keyword, count):
+    """count 个客户端同时请求同一个搜索，返回各自的状态码"""
+    barrier = threading.Barrier(count)
+    statuses = []
+    lock = threading.Lock()
+
+    def run():
+        barrier.wait()
+        status = requests.get(f'{base_url}/api/music/search', params={'keyword': keyword},
+                              headers=headers, timeout=30).status_code
+        with lock:
+            statuses.append(status)
+
+    threads = [threading.Thread(target=run) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def music_cache_metrics(base_url, headers):
+    """从 /metrics 中读取音乐接口的缓存统计：{接口: {结果: 次数}}"""
+    text = requests.get(f'{base_url}/metrics', headers=headers, timeout=30).text
+    stats = {}
+    for line in text.splitlines():
+        if not line.startswith('chat_music_cache_requests_total{'):
+            continue
+        labels, value = line[line.index('{') + 1:].split('} ')
+        fields = dict(part.split('=') for part in labels.split(','))
+        endpoint, result = fields['endpoint'].strip('"'), fields['result'].strip('"')
+        stats.setdefault(endpoint, {})[result] = int(float(value))
+    for counts in stats.values():
+        total = sum(counts.values())
+        counts['hit_rate'] = round((counts.get('hit', 0) + counts.get('error_hit', 0)) / total, 4) if total else None
+    return stats
+
+
+def main():
+    args = _parse_args()
+    upstream = fake_music.start_in_thread(latency=args.latency_ms / 1000)
+    data_dir = make_data_dir({ADMIN: ADMIN})
+    with open(f'{data_dir}/ops.json', 'w', encoding='utf-8') as f:
+        json.dump([ADMIN], f)
+
+    port = free_port()
+    env = {'CHAT_MUSIC_UPSTREAM': f'http://127.0.0.1:{upstream.server_port}'}
+    instance = start_instance(port, data_dir, async_mode=args.async_mode, extra_env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        if not wait_for_port(port, 30):
+            raise SystemExit('本地实例启动超时')
+        headers = auth_headers(ADMIN, login(base_url, ADMIN, ADMIN))
+
+        load = MusicLoad(base_url, headers, args)
+        load.run()
+        after_load = upstream.stats()
+
+        burst_statuses = burst(base_url, headers, f'同时搜索{time.time()}', args.burst)
+        after_burst = upstream.stats()
+
+        error_statuses = [requests.get(f'{base_url}/api/music/search', params={'keyword': 'error-keyword'},
+                                       headers=headers, timeout=30).status_code for _ in range(20)]
+        after_errors = upstream.stats()
+        cache = music_cache_metrics(base_url, headers)
+    finally:
+        stop_instance(instance)
+        upstream.shutdown()
+
+    client_requests = {name: r['count'] + r['errors'] for name, r in load.report().items()}
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'started_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        },
+        'load': {
+            'elapsed_s': round(load.elapsed, 3),
+            'endpoints': load.report(),
+            'client_requests': client_requests,
+            'upstream_requests': after_load,
+        },
+        'burst': {
+            'clients': args.burst,
+            'status_codes': {str(s): burst_statuses.count(s) for s in sorted(set(burst_statuses))},
+            'upstream_requests': after_burst.get('search', 0) - after_load.get('search', 0),
+        },
+        'errors': {
+            'requests': len(error_statuses),
+            'status_codes': {str(s): error_statuses.count(s) for s in sorted(set(error_statuses))},
+            'upstream_requests': after_errors.get('search', 0) - after_burst.get('search', 0),
+        },
+        'cache': cache,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f'报告已写入 {args.output}', file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
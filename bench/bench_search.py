@@ -0,0 +1,187 @@
+"""消息全文搜索基准：FTS5 trigram 索引 vs LIKE 全表扫描
+
+在临时数据库中生成大量中英文混合的文字消息（通过触发器同时写入全文索引），然后对比：
+- fts：search.search_messages（MATCH + bm25 排序；短词退化为 LIKE 过滤）
+- scan：不使用索引，直接在 messages 上 content LIKE '%词%'（相当于拉取全部历史后在客户端查找）
+
+消息由按Zipf分布抽取的词组成（高频词出现在大量消息中，低频词很少出现），
+分别测量高频、中频、低频词，以及少于3个字符的短词（无法使用trigram索引）。
+
+用法：
+    python bench/bench_search.py --messages 200000 --users 200
+"""
+import argparse
+import json
+import os
+import pathlib
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'backend'))
+
+import db  # noqa: E402
+import search  # noqa: E402
+from migrations import run_migrations  # noqa: E402
+
+# 常用汉字（生成词表用）
+CHARS = ('的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经'
+         '十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表'
+         '间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革'
+         '位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南'
+         '给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具'
+         '万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容'
+         '儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江'
+         '型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严龙飞')
+ENGLISH_WORDS = ['python', 'flask', 'sqlite', 'github', 'release', 'meeting', 'deadline', 'server',
+                 'deploy', 'review', 'docker', 'linux', 'socket', 'cache', 'index', 'query']
+VOCABULARY_SIZE = 5000
+
+# 查询：(说明, 查询内容)
+# {long[n]} 表示不少于3个字符的词中按出现频率排第n位的词，{short[n]} 为两个字符的词
+QUERIES = [
+    ('高频词', '{long[5]}'),
+    ('中频词', '{long[300]}'),
+    ('低频词', '{long[2000]}'),
+    ('英文词', 'sqlite'),
+    ('两个词', '{long[20]} {long[200]}'),
+    ('两字短词', '{short[5]}'),
+    ('短词+长词', '{short[5]} {long[300]}'),
+    ('无结果', '不存在的内容'),
+]
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='消息全文搜索基准')
+    parser.add_argument('--messages', type=int, default=200000, help='生成的消息数')
+    parser.add_argument('--users', type=int, default=200, help='用户数')
+    parser.add_argument('--repeat', type=int, default=20, help='每个查询重复次数')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+def generate_vocabulary(rng):
+    """生成词表，按出现频率从高到低排列（Zipf分布）"""
+    words = list(ENGLISH_WORDS)
+    seen = set(words)
+    while len(words) < VOCABULARY_SIZE:
+        word = ''.join(rng.choice(CHARS) for _ in range(rng.choice((2, 2, 3, 3, 4))))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    rng.shuffle(words)
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(len(words))]
+    return words, weights
+
+
+def generate_corpus(count, users, rng):
+    """生成消息：每个用户主要和少数几个好友聊天，消息由3~15个词组成"""
+    names = [f'user{i:04d}' for i in range(users)]
+    friends = {name: rng.sample(names, min(8, users)) for name in names}
+    words, weights = generate_vocabulary(rng)
+    now = datetime.now().isoformat()
+    rows = []
+    for _ in range(count):
+        sender = rng.choice(names)
+        recipient = rng.choice(friends[sender])
+        length = rng.randint(3, 15)
+        text = ' '.join(rng.choices(words, weights, k=length))
+        rows.append((sender, recipient, 'text', text, now))
+    return names, words, rows
+
+
+def build_query(template, words):
+    return template.format(long=[w for w in words if len(w) >= 3],
+                           short=[w for w in words if len(w) < 3])
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[max(0, int(len(values) * p / 100 + 0.999999) - 1)]
+
+
+def timed(func, repeat):
+    latencies = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        latencies.append(time.perf_counter() - started)
+    return result, {
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+    }
+
+
+def scan_search(conn, user, query, limit=20):
+    """不使用全文索引的基线：在用户参与的消息上逐条 LIKE"""
+    terms = query.split()
+    likes = ''.join(' AND content LIKE ?' for _ in terms)
+    return conn.execute(f'''
+        SELECT id FROM messages
+        WHERE (sender = ? OR recipient = ?) AND type = 'text'{likes}
+        ORDER BY id DESC LIMIT ?
+    ''', [user, user, *[f'%{t}%' for t in terms], limit + 1]).fetchall()
+
+
+def main():
+    args = _parse_args()
+    rng = random.Random(args.seed)
+    directory = tempfile.mkdtemp(prefix='chat-bench-search-')
+    db_file = os.path.join(directory, 'chat.db')
+    db.configure(db_file)
+    with db.connection() as conn:
+        run_migrations(conn)
+
+    names, words, rows = generate_corpus(args.messages, args.users, rng)
+    started = time.perf_counter()
+    with db.transaction() as cursor:
+        cursor.executemany('''
+            INSERT INTO messages (sender, recipient, type, content, timestamp) VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+    insert_elapsed = time.perf_counter() - started
+
+    with db.connection() as conn:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        indexed_rows = conn.execute('SELECT COUNT(*) FROM messages_fts').fetchone()[0]
+
+    users = rng.sample(names, min(10, len(names)))
+    results = []
+    with db.connection() as conn:
+        for label, template in QUERIES:
+            query = build_query(template, words)
+            fts_latencies = {'p50_ms': [], 'p95_ms': []}
+            scan_latencies = {'p50_ms': [], 'p95_ms': []}
+            hits = 0
+            for user in users:
+                (found, _), fts = timed(lambda: search.search_messages(conn, user, query), args.repeat)
+                _, scan = timed(lambda: scan_search(conn, user, query), args.repeat)
+                hits += len(found)
+                for key in fts_latencies:
+                    fts_latencies[key].append(fts[key])
+                    scan_latencies[key].append(scan[key])
+            results.append({
+                'query': label,
+                'text': query,
+                'avg_hits': round(hits / len(users), 1),
+                'fts_p50_ms': round(sum(fts_latencies['p50_ms']) / len(users), 3),
+                'fts_p95_ms': round(max(fts_latencies['p95_ms']), 3),
+                'scan_p50_ms': round(sum(scan_latencies['p50_ms']) / len(users), 3),
+                'scan_p95_ms': round(max(scan_latencies['p95_ms']), 3),
+            })
+
+    report = {
+        'messages': args.messages,
+        'users': args.users,
+        'indexed_rows': indexed_rows,
+        'insert_per_s': round(args.messages / insert_elapsed),
+        'db_size_mb': round(os.path.getsize(db_file) / 1024 / 1024, 1),
+        'queries': results,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""消息写入吞吐基准：逐条提交 vs 写入队列组提交
+
+在临时数据库上用多个线程并发写入消息，分别测量：
+- direct：每条消息单独开启事务并提交（默认行为）
+- queued：通过 write_queue.WriteQueue 批量提交（CHAT_WRITE_QUEUE=1）
+
+用法：
+    python bench/bench_write_queue.py --threads 16 --messages 200
+    python bench/bench_write_queue.py --synchronous FULL   # 每次提交都fsync的场景
+"""
+import argparse
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'backend'))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='消息写入吞吐基准')
+    parser.add_argument('--threads', type=int, default=16, help='并发写线程数')
+    parser.add_argument('--messages', type=int, default=200, help='每个线程写入的消息数')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-delay-ms', type=float, default=0)
+    parser.add_argument('--synchronous', default='NORMAL', choices=['OFF', 'NORMAL', 'FULL'],
+                        help='SQLite同步级别')
+    return parser.parse_args()
+
+
+args = _parse_args()
+# 同步级别在创建连接时读取，必须在导入 db 之前设置
+os.environ['CHAT_DB_SYNCHRONOUS'] = args.synchronous
+
+import db
+import message_types
+import write_queue
+from migrations import run_migrations
+import app
+
+
+def setup_database(directory, name):
+    """在临时目录中创建一个全新的数据库"""
+    db.configure(os.path.join(directory, name))
+    with db.connection() as conn:
+        run_migrations(conn)
+
+
+def run_writers(threads, messages, write_one):
+    """启动多个写线程，返回 (总消息数, 耗时秒)"""
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index):
+        sender = f"bench_sender_{index}"
+        barrier.wait()
+        for i in range(messages):
+            write_one(sender, 'bench_recipient', f"message {i}")
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+        t.join()
+    return threads * messages, time.perf_counter() - start
+
+
+def bench_direct(threads, messages):
+    def write_one(sender, recipient, content):
+        with db.transaction() as cursor:
+            app.insert_chat_message(cursor, sender, recipient, message_types.TEXT, content)
+    return run_writers(threads, messages, write_one)
+
+
+def bench_queued(threads, messages, batch_size, max_delay_ms):
+    queue = write_queue.WriteQueue(batch_size=batch_size, max_delay_ms=max_delay_ms)
+
+    def write_one(sender, recipient, content):
+        queue.submit(lambda cursor: app.insert_chat_message(cursor, sender, recipient, message_types.TEXT, content)).result()
+
+    try:
+        return run_writers(threads, messages, write_one)
+    finally:
+        queue.stop()
+
+
+def main():
+    results = {'synchronous': args.synchronous, 'threads': args.threads}
+    with tempfile.TemporaryDirectory() as directory:
+        setup_database(directory, 'direct.db')
+        total, elapsed = bench_direct(args.threads, args.messages)
+        results['direct'] = {'messages': total, 'seconds': round(elapsed, 3),
+                             'msgs_per_sec': round(total / elapsed, 1)}
+
+        setup_database(directory, 'queued.db')
+        total, elapsed = bench_queued(args.threads, args.messages, args.batch_size, args.max_delay_ms)
+        results['queued'] = {'messages': total, 'seconds': round(elapsed, 3),
+                             'msgs_per_sec': round(total / elapsed, 1),
+                             'batch_size': args.batch_size, 'max_delay_ms': args.max_delay_ms}
+
+    results['speedup'] = round(results['queued']['msgs_per_sec'] / results['direct']['msgs_per_sec'], 2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
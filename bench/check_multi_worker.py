@@ -0,0 +1,88 @@
+"""多进程消息转发检查：在一个进程发送的消息能推送到连接在另一个进程上的客户端
+
+步骤：
+1. 启动本地发布/订阅代理（backend/pubsub_broker.py，代替Redis）
+2. 在临时数据目录中创建用户 alice、bob，启动两个共享该目录和消息队列的应用进程 A、B
+3. bob 的Socket.IO客户端连接进程 B 并加入与 alice 的聊天室
+4. 通过进程 A 的HTTP接口以 alice 身份发送消息
+5. 检查 bob 在进程 B 上收到 new_message 事件
+
+需要 python-socketio 客户端和 redis：
+    pip install "python-socketio[client]" redis
+    python bench/check_multi_worker.py
+
+成功时退出码为0，失败时为1。
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+
+import requests
+import socketio
+
+from local_instance import (BACKEND_DIR, auth_headers, free_port, login, make_data_dir,
+                            start_instance, stop_instance, wait_for_port)
+
+sys.path.insert(0, str(BACKEND_DIR))
+
+import pubsub_broker  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多进程消息转发检查')
+    parser.add_argument('--timeout', type=float, default=10, help='等待进程启动和消息到达的秒数')
+    args = parser.parse_args()
+
+    broker_port = pubsub_broker.start_in_thread()
+    data_dir = make_data_dir({'alice': 'alice', 'bob': 'bob'})
+    env = {'CHAT_MESSAGE_QUEUE': f'redis://127.0.0.1:{broker_port}/0'}
+    port_a, port_b = free_port(), free_port()
+    # 先启动A并等待其完成迁移，避免两个进程同时建表
+    workers = [start_instance(port_a, data_dir, extra_env=env)]
+    ok = False
+    try:
+        if not wait_for_port(port_a, args.timeout):
+            print('进程A启动超时')
+            return 1
+        workers.append(start_instance(port_b, data_dir, extra_env=env))
+        if not wait_for_port(port_b, args.timeout):
+            print('进程B启动超时')
+            return 1
+
+        received = threading.Event()
+        content = f'multi-worker check {time.time()}'
+        client = socketio.Client()
+
+        @client.on('new_message')
+        def on_new_message(data):
+            if data.get('content') == content:
+                received.set()
+
+        # 两个进程共享数据目录中的令牌密钥，在A登录得到的令牌在B上同样有效
+        alice_token = login(f'http://127.0.0.1:{port_a}', 'alice', 'alice', timeout=args.timeout)
+        bob_token = login(f'http://127.0.0.1:{port_a}', 'bob', 'bob', timeout=args.timeout)
+        client.connect(f'http://127.0.0.1:{port_b}', transports=['websocket', 'polling'],
+                       auth={'token': bob_token})
+        client.emit('join', {'username': 'bob', 'friend': 'alice'})
+        # 等待join在进程B上处理完成
+        time.sleep(0.5)
+
+        response = requests.post(f'http://127.0.0.1:{port_a}/api/send-message',
+                                 json={'recipient': 'bob', 'content': content},
+                                 headers=auth_headers('alice', alice_token), timeout=args.timeout)
+        response.raise_for_status()
+        ok = received.wait(args.timeout)
+        client.disconnect()
+    finally:
+        for worker in workers:
+            stop_instance(worker)
+
+    result = {'worker_a': port_a, 'worker_b': port_b, 'broker': broker_port, 'delivered': ok}
+    print(json.dumps(result, ensure_ascii=False))
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""模拟的网易云音乐接口（离线测试 backend/music.py 的缓存和请求合并）
+
+实现应用用到的三个接口，返回的数据由参数确定性地生成：
+    POST /api/cloudsearch/pc     搜索（s、limit）
+    GET  /api/song/detail        歌曲详情（ids=[1,2,3]）
+    GET  /api/song/lyric         歌词（id）
+关键词以 error 开头的搜索返回500，用于测试错误结果的缓存；ID 不小于 MISSING_FROM 的歌曲不存在。
+每个请求可以附加固定延迟（模拟跨网络的往返）；GET /__stats 返回各接口收到的请求数。
+
+单独运行，然后让应用指向它：
+    python bench/fake_music.py --port 8765 --latency-ms 80
+    CHAT_MUSIC_UPSTREAM=http://127.0.0.1:8765 python backend/app.py
+"""
+import argparse
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MISSING_FROM = 900000000
+
+
+class FakeMusicServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint):
+        with self._lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+def _song(song_id):
+    return {
+        'id': song_id,
+        'name': f'歌曲 {song_id}',
+        'artists': [{'name': f'歌手 {song_id % 97}'}],
+        'album': {'name': f'专辑 {song_id % 31}', 'picUrl': f'http://p.example/{song_id}.jpg'},
+        'duration': 180000 + song_id % 60000,
+    }
+
+
+def _search_song(song_id):
+    song = _song(song_id)
+    return {
+        'id': song_id,
+        'name': song['name'],
+        'ar': song['artists'],
+        'al': song['album'],
+        'privilege': {'fee': 1 if song_id % 5 == 0 else 0, 'payed': 0},
+    }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == '/__stats':
+            return self._reply(200, self.server.stats())
+        if url.path == '/api/song/detail':
+            self.server.record('detail')
+            time.sleep(self.server.latency)
+            ids = json.loads(query.get('ids', ['[]'])[0])
+            return self._reply(200, {'code': 200, 'songs': [_song(int(i)) for i in ids if int(i) < MISSING_FROM]})
+        if url.path == '/api/song/lyric':
+            self.server.record('lyric')
+            time.sleep(self.server.latency)
+            song_id = int(query.get('id', ['0'])[0])
+            lines = '\n'.join(f'[00:{i:02d}.00]第 {i} 句歌词（{song_id}）' for i in range(20))
+            return self._reply(200, {'code': 200, 'lrc': {'lyric': lines}})
+        self._reply(404, {'code': 404})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+        if url.path != '/api/cloudsearch/pc':
+            return self._reply(404, {'code': 404})
+        self.server.record('search')
+        time.sleep(self.server.latency)
+        keyword = form.get('s', [''])[0]
+        if keyword.startswith('error'):
+            return self._reply(500, {'code': 500})
+        limit = int(form.get('limit', ['30'])[0])
+        base = sum(keyword.encode('utf-8')) * 1000
+        songs = [_search_song(base + i) for i in range(limit)]
+        self._reply(200, {'code': 200, 'result': {'songs': songs, 'songCount': limit}})
+
+
+def start_in_thread(port=0, latency=0.0):
+    """在后台线程中启动模拟服务，返回服务器对象（server.server_port 为端口）"""
+    server = FakeMusicServer(('127.0.0.1', port), latency=latency)
+    threading.Thread(target=server.serve_forever, name='fake-music', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟的网易云音乐接口')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0, help='每个请求的附加延迟（毫秒）')
+    args = parser.parse_args()
+    server = FakeMusicServer(('127.0.0.1', args.port), latency=args.latency_ms / 1000)
+    print(f'模拟音乐接口监听 http://127.0.0.1:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
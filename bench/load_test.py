@@ -0,0 +1,404 @@
+"""端到端压测：HTTP接口吞吐与延迟、WebSocket消息投递延迟
+
+默认在临时数据目录中启动一个本地实例（见 local_instance.py），创建 N 个合成用户和好友关系，
+然后按固定速率（开环，不因服务变慢而降低发送速率）混合请求以下接口：
+    /api/send-message、/api/chat-history、/api/unread-messages、/api/mark-messages-as-read
+同时由若干对WebSocket客户端通过 join/send_message 收发消息，
+测量从 send_message 发出到对方收到 new_message 的投递延迟。
+
+HTTP延迟从请求的计划发送时间开始计算：服务端变慢导致请求积压时，排队时间也计入延迟，
+避免只统计"实际发出的请求"而低估尾延迟。
+
+报告为JSON（包含提交号和全部参数），可以保存后在不同提交之间比较：
+    python bench/load_test.py --users 50 --rate 200 --duration 30 --output report.json
+    python bench/load_test.py --async-mode eventlet --output eventlet.json
+
+对已经运行的实例压测时，需要同时给出该实例的数据目录以便写入合成用户：
+    CHAT_DATA_DIR=/tmp/chat-data python backend/server.py
+    python bench/load_test.py --url http://127.0.0.1:80 --data-dir /tmp/chat-data
+"""
+import argparse
+import itertools
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import requests
+import socketio
+
+from local_instance import (BACKEND_DIR, auth_headers, free_port, login, make_data_dir,
+                            start_instance, stop_instance, wait_for_port, write_users)
+
+# 各接口在混合负载中的默认权重
+DEFAULT_MIX = {
+    'send-message': 3,
+    'chat-history': 4,
+    'unread-messages': 2,
+    'mark-messages-as-read': 1,
+}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='聊天后端端到端压测')
+    parser.add_argument('--url', help='已运行实例的地址，不指定时启动本地实例')
+    parser.add_argument('--data-dir', help='已运行实例的数据目录（与 --url 一起使用）')
+    parser.add_argument('--async-mode', default='threading', choices=['threading', 'eventlet', 'gevent'],
+                        help='本地实例的异步模式')
+    parser.add_argument('--users', type=int, default=20, help='合成用户数')
+    parser.add_argument('--friends', type=int, default=5, help='每个用户的好友数')
+    parser.add_argument('--rate', type=float, default=100, help='HTTP请求总速率（次/秒）')
+    parser.add_argument('--concurrency', type=int, default=32, help='发送HTTP请求的线程数')
+    parser.add_argument('--duration', type=float, default=10, help='压测时长（秒）')
+    parser.add_argument('--mix', default=','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items()),
+                        help='接口权重，例如 send-message=3,chat-history=4')
+    parser.add_argument('--history-limit', type=int, default=50, help='chat-history 每次获取的条数')
+    parser.add_argument('--socket-pairs', type=int, default=5, help='WebSocket客户端对数（0表示不测）')
+    parser.add_argument('--socket-rate', type=float, default=20, help='send_message 总速率（次/秒）')
+    parser.add_argument('--seed', type=int, default=1, help='随机数种子')
+    parser.add_argument('--output', help='报告输出文件，不指定时打印到标准输出')
+    args = parser.parse_args()
+    if args.url and not args.data_dir:
+        parser.error('--url 需要同时指定 --data-dir')
+    return args
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in DEFAULT_MIX:
+            raise SystemExit(f'未知的接口: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, p):
+    """最近秩百分位数"""
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def summarize(latencies, duration):
+    """延迟（秒）列表转为报告中的统计（毫秒）"""
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'throughput_per_s': round(len(values) / duration, 2) if duration else None,
+        'latency_ms': {
+            'mean': _ms(sum(values) / len(values)) if values else None,
+            'p50': _ms(percentile(values, 50)),
+            'p95': _ms(percentile(values, 95)),
+            'p99': _ms(percentile(values, 99)),
+            'max': _ms(values[-1]) if values else None,
+        },
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_users(count, friends, rng):
+    """生成合成用户和好友关系（每个用户与随后的 friends 个用户成为好友，首尾相接）"""
+    users = [f'load_user_{i:04d}' for i in range(count)]
+    pairs = set()
+    for i, user in enumerate(users):
+        for step in range(1, min(friends, count - 1) + 1):
+            pairs.add(tuple(sorted((user, users[(i + step) % count]))))
+    pairs = sorted(pairs)
+    rng.shuffle(pairs)
+    return users, pairs
+
+
+def login_users(base_url, passwords):
+    """登录所有合成用户，返回 {用户名: 会话令牌}"""
+    session = requests.Session()
+    return {user: login(base_url, user, password, session=session) for user, password in passwords.items()}
+
+
+def setup_friendships(base_url, pairs, tokens):
+    """通过 /api/add-friend 建立好友关系"""
+    session = requests.Session()
+    for user, friend in pairs:
+        response = session.post(f'{base_url}/api/add-friend', json={'friendName': friend},
+                                headers=auth_headers(user, tokens[user]), timeout=30)
+        # 已是好友（重复运行）时返回400，忽略
+        if response.status_code not in (200, 400):
+            raise SystemExit(f'建立好友关系失败: {user} -> {friend}: {response.status_code}')
+
+
+class HttpLoad:
+    """按固定速率发送混合HTTP请求，记录每个接口的延迟和状态码"""
+
+    def __init__(self, base_url, pairs, tokens, mix, rate, concurrency, duration, history_limit, seed):
+        self.base_url = base_url
+        self.pairs = pairs
+        self.tokens = tokens
+        self.rate = rate
+        self.concurrency = concurrency
+        self.duration = duration
+        self.history_limit = history_limit
+        self.seed = seed
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.results = {name: {'latencies': [], 'status_codes': {}, 'errors': 0} for name in self.names}
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+        self.late_starts = 0
+
+    def _request(self, session, name, user, friend):
+        headers = auth_headers(user, self.tokens[user])
+        if name == 'send-message':
+            return session.post(f'{self.base_url}/api/send-message', headers=headers, timeout=30,
+                                json={'recipient': friend, 'content': f'load {time.time()}'})
+        if name == 'chat-history':
+            return session.get(f'{self.base_url}/api/chat-history', headers=headers, timeout=30,
+                               params={'friend': friend, 'limit': self.history_limit})
+        if name == 'unread-messages':
+            return session.get(f'{self.base_url}/api/unread-messages', headers=headers, timeout=30)
+        return session.post(f'{self.base_url}/api/mark-messages-as-read', headers=headers, timeout=30,
+                            json={'friend': friend})
+
+    def _worker(self, index, start):
+        rng = random.Random(self.seed * 1000 + index)
+        session = requests.Session()
+        total = int(self.rate * self.duration)
+        while True:
+            ticket = next(self._tickets)
+            if ticket >= total:
+                return
+            scheduled = start + ticket / self.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.01:
+                with self._lock:
+                    self.late_starts += 1
+
+            name = rng.choices(self.names, self.weights)[0]
+            user, friend = rng.choice(self.pairs)
+            if rng.random() < 0.5:
+                user, friend = friend, user
+            result = self.results[name]
+            try:
+                response = self._request(session, name, user, friend)
+                status = str(response.status_code)
+            except requests.RequestException:
+                status = None
+            latency = time.perf_counter() - scheduled
+            with self._lock:
+                if status is None:
+                    result['errors'] += 1
+                else:
+                    result['status_codes'][status] = result['status_codes'].get(status, 0) + 1
+                    if status.startswith('2') or status == '304':
+                        result['latencies'].append(latency)
+                    else:
+                        result['errors'] += 1
+
+    def run(self):
+        start = time.perf_counter() + 0.1
+        threads = [threading.Thread(target=self._worker, args=(i, start), daemon=True)
+                   for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start
+
+    def report(self):
+        endpoints = {}
+        for name, result in self.results.items():
+            summary = summarize(result['latencies'], self.elapsed)
+            summary['errors'] = result['errors']
+            summary['status_codes'] = result['status_codes']
+            endpoints[name] = summary
+        all_latencies = [v for r in self.results.values() for v in r['latencies']]
+        return {
+            'elapsed_s': round(self.elapsed, 3),
+            'late_starts': self.late_starts,
+            'total': summarize(all_latencies, self.elapsed),
+            'endpoints': endpoints,
+        }
+
+
+class SocketLoad:
+    """若干对WebSocket客户端互发消息，测量 send_message 到 new_message 的投递延迟"""
+
+    def __init__(self, base_url, pairs, tokens, count, rate, duration):
+        self.base_url = base_url
+        self.pairs = pairs[:count]
+        self.tokens = tokens
+        self.rate = rate
+        self.duration = duration
+        self.clients = []
+        self.sent = {}
+        self.latencies = []
+        self.connect_errors = 0
+        self._lock = threading.Lock()
+
+    def _on_new_message(self, data):
+        received = time.perf_counter()
+        content = data.get('content', '')
+        with self._lock:
+            sent = self.sent.pop(content, None)
+            if sent is not None:
+                self.latencies.append(received - sent)
+
+    def _connect(self, username, friend):
+        client = socketio.Client(reconnection=False)
+
+        @client.on('new_message')
+        def on_new_message(data):
+            # 只统计接收方收到的事件（发送方也在房间里）
+            if data.get('recipient') == username:
+                self._on_new_message(data)
+
+        client.connect(self.base_url, transports=['websocket', 'polling'], wait_timeout=10,
+                       auth={'token': self.tokens[username]})
+        client.emit('join', {'username': username, 'friend': friend})
+        return client
+
+    def connect(self):
+        for sender, recipient in self.pairs:
+            try:
+                self.clients.append((self._connect(sender, recipient), sender, recipient))
+                self.clients.append((self._connect(recipient, sender), recipient, sender))
+            except Exception:
+                self.connect_errors += 1
+        # 等待 join 处理完成
+        time.sleep(0.5)
+
+    def run(self):
+        senders = self.clients[::2]
+        start = time.perf_counter()
+        total = int(self.rate * self.duration) if senders else 0
+        for ticket in range(total):
+            delay = start + ticket / self.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            client, sender, recipient = senders[ticket % len(senders)]
+            content = f'socket {ticket} {time.time()}'
+            with self._lock:
+                self.sent[content] = time.perf_counter()
+            try:
+                client.emit('send_message', {'sender': sender, 'recipient': recipient, 'content': content})
+            except Exception:
+                with self._lock:
+                    self.sent.pop(content, None)
+        self.elapsed = time.perf_counter() - start
+        self.total = total
+
+    def finish(self, timeout=5):
+        """等待未到达的消息，然后断开所有连接"""
+        deadline = time.monotonic() + timeout
+        while self.sent and time.monotonic() < deadline:
+            time.sleep(0.05)
+        for client, _, _ in self.clients:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+    def report(self):
+        summary = summarize(self.latencies, self.elapsed)
+        summary.update({
+            'pairs': len(self.pairs),
+            'sent': self.total,
+            'delivered': len(self.latencies),
+            'lost': len(self.sent),
+            'connect_errors': self.connect_errors,
+        })
+        return summary
+
+
+def main():
+    args = _parse_args()
+    mix = _parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    users, pairs = make_users(args.users, args.friends, rng)
+    passwords = {user: user for user in users}
+
+    instance = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+        write_users(args.data_dir, passwords)
+        # 等待实例重新加载 users.json（变化检测间隔1秒）
+        time.sleep(1.5)
+    else:
+        data_dir = make_data_dir(passwords)
+        port = free_port()
+        instance = start_instance(port, data_dir, async_mode=args.async_mode)
+        base_url = f'http://127.0.0.1:{port}'
+        if not wait_for_port(port, 30):
+            stop_instance(instance)
+            raise SystemExit('本地实例启动超时')
+
+    try:
+        setup_started = time.perf_counter()
+        tokens = login_users(base_url, passwords)
+        setup_friendships(base_url, pairs, tokens)
+        setup_elapsed = time.perf_counter() - setup_started
+
+        socket_load = None
+        if args.socket_pairs > 0:
+            socket_load = SocketLoad(base_url, pairs, tokens, args.socket_pairs, args.socket_rate, args.duration)
+            socket_load.connect()
+
+        http_load = HttpLoad(base_url, pairs, tokens, mix, args.rate, args.concurrency, args.duration,
+                             args.history_limit, args.seed)
+        socket_thread = None
+        if socket_load is not None:
+            socket_thread = threading.Thread(target=socket_load.run, daemon=True)
+            socket_thread.start()
+        http_load.run()
+        if socket_thread is not None:
+            socket_thread.join()
+            socket_load.finish()
+    finally:
+        if instance is not None:
+            stop_instance(instance)
+
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'started_at': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'target': args.url or f'local ({args.async_mode})',
+            'params': {k: v for k, v in vars(args).items() if k not in ('output', 'data_dir')},
+            'mix': mix,
+            'friendships': len(pairs),
+            'setup_s': round(setup_elapsed, 3),
+        },
+        'http': http_load.report(),
+        'socket': socket_load.report() if socket_load is not None else None,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+        print(f'报告已写入 {args.output}', file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
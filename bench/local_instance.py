@@ -0,0 +1,105 @@
+"""在本机启动独立的应用实例（供 bench/ 下的脚本使用）
+
+每个实例使用 CHAT_DATA_DIR 指向的临时数据目录，不会读写项目的 data/ 和 uploads/。
+"""
+import json
+import os
+import pathlib
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+BACKEND_DIR = pathlib.Path(__file__).resolve().parent.parent / 'backend'
+
+# threading 模式：导入应用、执行迁移，然后用开发服务器（关闭debug）监听指定端口
+DEV_SERVER_CODE = '''
+import sys
+import app
+app.init_db()
+app.socketio.run(app.app, host='127.0.0.1', port=int(sys.argv[1]), allow_unsafe_werkzeug=True)
+'''
+
+
+def free_port():
+    """获取一个空闲的本地端口"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout):
+    """等待端口可以连接，超时返回False"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def make_data_dir(users):
+    """创建临时数据目录并写入用户（明文密码），返回目录路径"""
+    data_dir = tempfile.mkdtemp(prefix='chat-bench-')
+    write_users(data_dir, users)
+    return data_dir
+
+
+def write_users(data_dir, users):
+    """把用户合并写入数据目录的 users.json（运行中的实例会自动重新加载）"""
+    path = os.path.join(data_dir, 'users.json')
+    existing = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            existing = json.load(f)
+    existing.update(users)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(existing, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def login(base_url, username, password, session=None, timeout=30):
+    """登录并返回会话令牌，请求时放在 Authorization: Bearer <令牌> 中"""
+    response = (session or requests).post(f'{base_url}/api/login', timeout=timeout,
+                                          json={'username': username, 'password': password})
+    response.raise_for_status()
+    return response.json()['token']
+
+
+def auth_headers(username, token):
+    """以指定用户身份请求接口的请求头"""
+    return {'X-User': username, 'Authorization': f'Bearer {token}'}
+
+
+def start_instance(port, data_dir, async_mode='threading', extra_env=None, log_file=None):
+    """启动一个应用实例，返回 Popen 对象
+
+    threading 模式使用开发服务器，eventlet/gevent 模式使用生产入口 server.py。
+    """
+    env = dict(os.environ,
+               CHAT_ASYNC_MODE=async_mode,
+               CHAT_DATA_DIR=str(data_dir),
+               CHAT_UPLOAD_DIR=os.path.join(str(data_dir), 'uploads'))
+    env.update(extra_env or {})
+    if async_mode == 'threading':
+        command = [sys.executable, '-c', DEV_SERVER_CODE, str(port)]
+    else:
+        env.update(CHAT_HOST='127.0.0.1', CHAT_PORT=str(port))
+        command = [sys.executable, 'server.py']
+    output = log_file if log_file is not None else subprocess.DEVNULL
+    return subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=output, stderr=output)
+
+
+def stop_instance(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
@@ -0,0 +1,62 @@
+// 会话令牌：登录时由 /api/login 返回，保存在 sessionStorage 的 chat-token 中
+// 对本站 /api/ 和 /metrics 的 fetch 请求自动附带 Authorization: Bearer <令牌>，
+// 响应头中有续期的新令牌（X-Auth-Token）时替换保存的令牌；令牌失效时回到登录页
+(function() {
+    const TOKEN_KEY = 'chat-token';
+
+    function getToken() {
+        return sessionStorage.getItem(TOKEN_KEY);
+    }
+
+    function setToken(token) {
+        if (token) {
+            sessionStorage.setItem(TOKEN_KEY, token);
+        }
+    }
+
+    function clearSession() {
+        sessionStorage.removeItem('chat-user');
+        sessionStorage.removeItem('user-info');
+        sessionStorage.removeItem(TOKEN_KEY);
+    }
+
+    function needsToken(url) {
+        if (url.origin !== location.origin) {
+            return false;
+        }
+        if (url.pathname === '/api/login') {
+            return false;
+        }
+        return url.pathname.startsWith('/api/') || url.pathname === '/metrics';
+    }
+
+    const originalFetch = window.fetch.bind(window);
+
+    window.fetch = async function(input, init) {
+        const url = new URL(input instanceof Request ? input.url : input, location.href);
+        const token = getToken();
+        if (!token || !needsToken(url)) {
+            return originalFetch(input, init);
+        }
+
+        const headers = new Headers((init && init.headers) || (input instanceof Request ? input.headers : undefined));
+        headers.set('Authorization', `Bearer ${token}`);
+        const response = await originalFetch(input, Object.assign({}, init, { headers }));
+
+        setToken(response.headers.get('X-Auth-Token'));
+        if (response.status === 401) {
+            // 令牌过期或已失效（例如在其他设备上修改了密码），需要重新登录
+            console.log('登录已失效，跳转到登录页');
+            clearSession();
+            location.href = '/login';
+        }
+        return response;
+    };
+
+    window.chatAuth = { getToken, setToken, clearSession };
+
+    // 升级前登录、没有令牌的会话需要重新登录
+    if (location.pathname !== '/login' && sessionStorage.getItem('chat-user') && !getToken()) {
+        clearSession();
+    }
+})();
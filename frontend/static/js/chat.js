@@ -29,6 +29,7 @@ document.getElementById('logout-btn').addEventListener('click', () => {
             // 清除sessionStorage中的用户信息
             sessionStorage.removeItem('chat-user');
             sessionStorage.removeItem('user-info');
+            sessionStorage.removeItem('chat-token');
         } catch(e) {
             console.error('退出登录时出错:', e);
         }
@@ -124,8 +125,7 @@ document.getElementById('save-username-btn').addEventListener('click', async ()
     const res = await fetch('/api/change-username', {
         method: 'POST',
         headers: {
-            'Content-Type': 'application/json',
-            'X-User': currentUser
+            'Content-Type': 'application/json'
         },
         body: JSON.stringify({newUsername: newUsername})
     });
@@ -133,6 +133,8 @@ document.getElementById('save-username-btn').addEventListener('click', async ()
     if (data.ok) {
         try {
             sessionStorage.setItem('chat-user', newUsername);
+            // 旧令牌对应原用户名，换用服务器返回的新令牌
+            sessionStorage.setItem('chat-token', data.token);
             document.getElementById('uname').textContent = newUsername;
             // 更新sessionStorage中的用户信息
             const userInfo = JSON.parse(sessionStorage.getItem('user-info') || '{}');
@@ -158,7 +160,6 @@ document.getElementById('save-username-btn').addEventListener('click', async ()
 // 保存密码按钮点击事件
 document.getElementById('save-password-btn').addEventListener('click', async () => {
     const newPassword = document.getElementById('password-input').value.trim();
-    const currentUser = sessionStorage.getItem('chat-user');
 
     // 检查输入
     if (!newPassword) {
@@ -177,8 +178,7 @@ document.getElementById('save-password-btn').addEventListener('click', async ()
     const res = await fetch('/api/change-password', {
         method: 'POST',
         headers: {
-            'Content-Type': 'application/json',
-            'X-User': currentUser
+            'Content-Type': 'application/json'
         },
         body: JSON.stringify({newPassword: newPassword})
     });
@@ -189,6 +189,8 @@ document.getElementById('save-password-btn').addEventListener('click', async ()
             const userInfo = JSON.parse(sessionStorage.getItem('user-info') || '{}');
             userInfo.password = newPassword;
             sessionStorage.setItem('user-info', JSON.stringify(userInfo));
+            // 修改密码后旧令牌失效，换用服务器返回的新令牌
+            sessionStorage.setItem('chat-token', data.token);
         } catch(e) {
             console.error('更新会话信息时出错:', e);
             alert('会话信息更新失败！');
@@ -204,11 +206,7 @@ document.getElementById('save-password-btn').addEventListener('click', async ()
 // 检查未读消息
 async function checkUnreadMessages() {
     try {
-        const res = await fetch('/api/unread-messages', {
-            headers: {
-                'X-User': sessionStorage.getItem('chat-user')
-            }
-        });
+        const res = await fetch('/api/unread-messages');
         const data = await res.json();
         if (data.ok) {
             // 更新好友列表中的未读消息提示
@@ -246,8 +244,7 @@ function updateUnreadIndicators(unreadCounts) {
 // 加载好友列表
 async function loadFriends() {
     try {
-        const currentUser = sessionStorage.getItem('chat-user');
-        const res = await fetch('/api/friends?u=' + encodeURIComponent(currentUser));
+        const res = await fetch('/api/friends');
         const list = await res.json();
         const html = list.map(name => {
             // 为每个好友卡片添加data-friend属性，方便后续扩展
@@ -302,8 +299,7 @@ document.getElementById('add-friend-btn').addEventListener('click', async () =>
     const res = await fetch('/api/add-friend', {
         method: 'POST',
         headers: {
-            'Content-Type': 'application/json',
-            'X-User': currentUser
+            'Content-Type': 'application/json'
         },
         body: JSON.stringify({friendName: friendName})
     });
@@ -337,13 +333,115 @@ function showAddFriendFeedback(message, type) {
     }
 }
 
-// 页面加载完成后检查未读消息
+// 通过WebSocket接收未读消息更新，事件中直接携带最新的未读计数，无需轮询
+function subscribeUnreadUpdates() {
+    if (typeof io === 'undefined') {
+        return;
+    }
+    const currentUser = sessionStorage.getItem('chat-user');
+    if (!currentUser) {
+        return;
+    }
+
+    // 每次（重新）连接时读取最新的令牌
+    const socket = io({
+        auth: (cb) => cb({token: sessionStorage.getItem('chat-token')})
+    });
+    socket.on('connect', () => {
+        // 加入自己的房间；断线重连后重新同步一次，补上断线期间错过的更新
+        socket.emit('join_user', {username: currentUser});
+        checkUnreadMessages();
+    });
+    socket.on('unread_update', (data) => {
+        if (data && data.recipient === currentUser && data.unread_counts) {
+            updateUnreadIndicators(data.unread_counts);
+        }
+    });
+    // 管理员公告：广播发到所有连接所在的公告房间，多播发到接收者自己的房间
+    socket.on('announcement', (announcement) => {
+        addAnnouncement(announcement, true);
+    });
+}
+
+// 管理员公告（只在主页显示）
+let latestAnnouncementId = 0;
+let unreadAnnouncements = 0;
+
+function renderAnnouncementUnread() {
+    const unreadElement = document.getElementById('announcement-unread');
+    const readButton = document.getElementById('announcement-read-btn');
+    unreadElement.textContent = unreadAnnouncements > 0 ? `（${unreadAnnouncements} 条未读）` : '';
+    readButton.style.display = unreadAnnouncements > 0 ? 'block' : 'none';
+}
+
+function addAnnouncement(announcement, isNew) {
+    const section = document.getElementById('announcement-section');
+    const list = document.getElementById('announcement-list');
+    if (!section || !announcement || list.querySelector(`[data-id="${announcement.id}"]`)) {
+        return;
+    }
+    const item = document.createElement('div');
+    item.className = 'feedback-message' + (announcement.read ? '' : ' success');
+    item.style.display = 'block';
+    item.setAttribute('data-id', announcement.id);
+    // 公告内容作为纯文本显示
+    item.textContent = `${announcement.content}（${announcement.sender}，${announcement.createdAt.substring(0, 16).replace('T', ' ')}）`;
+    if (isNew) {
+        list.insertBefore(item, list.firstChild);
+        unreadAnnouncements += 1;
+    } else {
+        list.appendChild(item);
+    }
+    latestAnnouncementId = Math.max(latestAnnouncementId, announcement.id);
+    section.style.display = 'block';
+    renderAnnouncementUnread();
+}
+
+async function loadAnnouncements() {
+    if (!document.getElementById('announcement-section')) {
+        return;
+    }
+    try {
+        const response = await fetch('/api/announcements?limit=5');
+        const data = await response.json();
+        if (!data.ok) {
+            return;
+        }
+        unreadAnnouncements = data.unread;
+        data.announcements.forEach(announcement => addAnnouncement(announcement, false));
+    } catch (error) {
+        console.error('加载公告失败:', error);
+    }
+}
+
+async function markAnnouncementsRead() {
+    try {
+        const response = await fetch('/api/announcements/read', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ id: latestAnnouncementId })
+        });
+        const data = await response.json();
+        if (data.ok) {
+            unreadAnnouncements = data.unread;
+            document.querySelectorAll('#announcement-list .success').forEach(item => item.classList.remove('success'));
+            renderAnnouncementUnread();
+        }
+    } catch (error) {
+        console.error('标记公告已读失败:', error);
+    }
+}
+
+// 页面加载完成后订阅未读消息更新
 document.addEventListener('DOMContentLoaded', () => {
-    // 初始检查未读消息
-    checkUnreadMessages();
-    
-    // 每5秒检查一次未读消息
-    setInterval(checkUnreadMessages, 5000);
+    subscribeUnreadUpdates();
+    const readButton = document.getElementById('announcement-read-btn');
+    if (readButton && sessionStorage.getItem('chat-user')) {
+        readButton.addEventListener('click', markAnnouncementsRead);
+        loadAnnouncements();
+    }
 });
 
 // 监听来自聊天界面的未读消息更新通知
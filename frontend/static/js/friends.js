@@ -11,6 +11,9 @@ class ChatApp {
         this.messages = [];
         this.pollingInterval = null;
         this.lastMessageCount = 0;
+        this.lastMessageId = 0; // 已加载的最后一条消息ID，用于增量同步
+        this.lastMessageTime = null; // 已加载的最后一条消息时间，用于判断是否显示时间分隔符
+        this.isCheckingMessages = false; // 防止并发轮询重复追加消息
         this.hasNewMessage = false;
         this.originalTitle = document.title;
         this.isUnloading = false; // 标记页面是否正在卸载
@@ -267,8 +270,7 @@ class ChatApp {
             const response = await fetch('/api/send-message', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json',
-                    'X-User': this.me
+                    'Content-Type': 'application/json'
                 },
                 body: JSON.stringify({
                     recipient: this.peer,
@@ -683,13 +685,9 @@ class ChatApp {
                 URL.revokeObjectURL(viewerImage.src);
             }
             
-            // 通过API获取图片数据
+            // 通过API获取图片数据（查看器使用预览图，下载时获取原图）
             try {
-                const response = await fetch(`/api/get-image/${currentImage.id}`, {
-                    headers: {
-                        'X-User': this.me
-                    }
-                });
+                const response = await fetch(`/api/get-image/${currentImage.id}?size=medium`);
                 
                 if (response.ok) {
                     const blob = await response.blob();
@@ -746,11 +744,7 @@ class ChatApp {
         
         try {
             // 通过API获取图片数据
-            const response = await fetch(`/api/get-image/${imageId}`, {
-                headers: {
-                    'X-User': this.me
-                }
-            });
+            const response = await fetch(`/api/get-image/${imageId}`);
             
             if (response.ok) {
                 const blob = await response.blob();
@@ -828,8 +822,7 @@ class ChatApp {
             const response = await fetch('/api/send-message', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json',
-                    'X-User': this.me
+                    'Content-Type': 'application/json'
                 },
                 body: JSON.stringify({
                     recipient: this.peer,
@@ -854,10 +847,6 @@ class ChatApp {
     async uploadImage(imageFile) {
         if (!imageFile) return;
 
-        // 创建FormData对象用于上传文件
-        const formData = new FormData();
-        formData.append('image', imageFile);
-
         try {
             // 显示上传中提示
             const sendButton = document.getElementById('send-btn');
@@ -870,17 +859,11 @@ class ChatApp {
             sendButton.innerHTML = '上传中...';
             morePanelBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> 上传中...';
 
-            // 上传图片
-            const uploadResponse = await fetch('/api/upload-image', {
-                method: 'POST',
-                headers: {
-                    'X-User': this.me
-                },
-                body: formData
+            // 上传图片（分块上传，显示进度；中断后再次选择同一文件会从已上传的位置继续）
+            const uploadResult = await this.chunkedUpload(imageFile, 'image', progress => {
+                morePanelBtn.innerHTML = `<i class="fas fa-spinner fa-spin"></i> 上传中 ${Math.floor(progress * 100)}%`;
             });
 
-            const uploadResult = await uploadResponse.json();
-
             // 恢复按钮状态
             sendButton.disabled = false;
             morePanelBtn.disabled = false;
@@ -893,8 +876,7 @@ class ChatApp {
                 const response = await fetch('/api/send-message', {
                     method: 'POST',
                     headers: {
-                        'Content-Type': 'application/json',
-                        'X-User': this.me
+                        'Content-Type': 'application/json'
                     },
                     body: JSON.stringify({
                         recipient: this.peer,
@@ -931,10 +913,6 @@ class ChatApp {
     async uploadFile(file) {
         if (!file) return;
 
-        // 创建FormData对象用于上传文件
-        const formData = new FormData();
-        formData.append('file', file);
-
         try {
             // 显示上传中提示
             const sendButton = document.getElementById('send-btn');
@@ -947,17 +925,11 @@ class ChatApp {
             sendButton.innerHTML = '上传中...';
             morePanelBtn.innerHTML = '<i class="fas fa-spinner fa-spin"></i> 上传中...';
 
-            // 上传文件
-            const uploadResponse = await fetch('/api/upload-file', {
-                method: 'POST',
-                headers: {
-                    'X-User': this.me
-                },
-                body: formData
+            // 上传文件（分块上传，显示进度；中断后再次选择同一文件会从已上传的位置继续）
+            const uploadResult = await this.chunkedUpload(file, 'file', progress => {
+                morePanelBtn.innerHTML = `<i class="fas fa-spinner fa-spin"></i> 上传中 ${Math.floor(progress * 100)}%`;
             });
 
-            const uploadResult = await uploadResponse.json();
-
             // 恢复按钮状态
             sendButton.disabled = false;
             morePanelBtn.disabled = false;
@@ -970,8 +942,7 @@ class ChatApp {
                 const response = await fetch('/api/send-message', {
                     method: 'POST',
                     headers: {
-                        'Content-Type': 'application/json',
-                        'X-User': this.me
+                        'Content-Type': 'application/json'
                     },
                     body: JSON.stringify({
                         recipient: this.peer,
@@ -1005,6 +976,80 @@ class ChatApp {
         }
     }
 
+    // 分块上传（断点续传），返回完成接口的结果（包含 image_id 或 file_id）
+    async chunkedUpload(file, kind, onProgress) {
+        // 同一用户再次上传同一个文件时复用上传ID，从服务器已接收的位置继续
+        const resumeKey = `upload:${this.me}:${kind}:${file.name}:${file.size}:${file.lastModified}`;
+        let uploadId = localStorage.getItem(resumeKey);
+        let received = 0;
+        let chunkSize = 1024 * 1024;
+
+        if (uploadId) {
+            const statusResponse = await fetch(`/api/upload/${uploadId}`);
+            if (statusResponse.ok) {
+                const status = await statusResponse.json();
+                received = status.received;
+                chunkSize = status.chunk_size;
+            } else {
+                // 上传已过期或已完成，重新开始
+                localStorage.removeItem(resumeKey);
+                uploadId = null;
+            }
+        }
+
+        if (!uploadId) {
+            const initResponse = await fetch('/api/upload/init', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ kind: kind, filename: file.name, size: file.size })
+            });
+            const init = await initResponse.json();
+            if (!init.ok) return init;
+            uploadId = init.upload_id;
+            chunkSize = init.chunk_size;
+            localStorage.setItem(resumeKey, uploadId);
+        }
+
+        let retries = 0;
+        while (received < file.size) {
+            if (onProgress) onProgress(received / file.size);
+            try {
+                const chunkResponse = await fetch(`/api/upload/${uploadId}?offset=${received}`, {
+                    method: 'PUT',
+                    headers: {
+                        'Content-Type': 'application/octet-stream'
+                    },
+                    body: file.slice(received, received + chunkSize)
+                });
+                const chunk = await chunkResponse.json();
+                if (chunk.ok) {
+                    received = chunk.received;
+                    retries = 0;
+                    continue;
+                }
+                // 偏移不一致时服务器会返回已接收的字节数，从该位置重新发送
+                if (typeof chunk.received !== 'number' || ++retries > 3) return chunk;
+                received = chunk.received;
+            } catch (error) {
+                // 网络中断：稍后重试，仍然失败时保留上传ID，下次可以续传
+                if (++retries > 3) throw error;
+                await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+            }
+        }
+
+        if (onProgress) onProgress(1);
+        const completeResponse = await fetch(`/api/upload/${uploadId}/complete`, {
+            method: 'POST'
+        });
+        const result = await completeResponse.json();
+        if (result.ok || completeResponse.status === 404 || completeResponse.status === 422) {
+            localStorage.removeItem(resumeKey);
+        }
+        return result;
+    }
+
     // 显示错误消息
     showErrorMessage(message) {
         // 创建或更新错误消息元素
@@ -1031,10 +1076,7 @@ class ChatApp {
     async loadFileData(fileId, messageElement, isOwnMessage) {
         try {
             const response = await fetch(`/api/get-file/${fileId}`, {
-                method: 'HEAD', // 仅获取头部信息，不下载文件内容
-                headers: {
-                    'X-User': this.me
-                }
+                method: 'HEAD' // 仅获取头部信息，不下载文件内容
             });
 
             if (!response.ok) {
@@ -1060,11 +1102,7 @@ class ChatApp {
     async fetchFileDetailsFromAPI(fileId, messageElement, isOwnMessage) {
         try {
             // 通过专门的API获取文件信息
-            const fileInfoResponse = await fetch(`/api/get-file-info/${fileId}`, {
-                headers: {
-                    'X-User': this.me
-                }
-            });
+            const fileInfoResponse = await fetch(`/api/get-file-info/${fileId}`);
 
             if (fileInfoResponse.ok) {
                 const fileInfoResult = await fileInfoResponse.json();
@@ -1193,11 +1231,7 @@ class ChatApp {
     async downloadFile(fileId, fileName) {
         try {
             // 通过API获取文件并下载
-            const response = await fetch(`/api/get-file/${fileId}`, {
-                headers: {
-                    'X-User': this.me
-                }
-            });
+            const response = await fetch(`/api/get-file/${fileId}`);
 
             if (!response.ok) {
                 throw new Error(`下载失败: ${response.status} ${response.statusText}`);
@@ -1236,11 +1270,7 @@ class ChatApp {
         } else if (fileType === 'pdf') {
             // PDF文件预览，需要通过后端API获取文件
             try {
-                const response = await fetch(`/api/get-file/${fileId}`, {
-                    headers: {
-                        'X-User': this.me
-                    }
-                });
+                const response = await fetch(`/api/get-file/${fileId}`);
 
                 if (!response.ok) {
                     throw new Error(`加载PDF失败: ${response.status}`);
@@ -1330,11 +1360,7 @@ class ChatApp {
 
         try {
             // 使用fetch获取图片blob，确保带上认证信息
-            const response = await fetch(`/api/get-file/${fileId}`, {
-                headers: {
-                    'X-User': this.me
-                }
-            });
+            const response = await fetch(`/api/get-file/${fileId}`);
 
             if (!response.ok) {
                 throw new Error(`加载图片失败: ${response.status}`);
@@ -1373,11 +1399,7 @@ class ChatApp {
     async previewMarkdown(fileId, fileName) {
         try {
             // 获取Markdown文件内容
-            const response = await fetch(`/api/get-file/${fileId}`, {
-                headers: {
-                    'X-User': this.me
-                }
-            });
+            const response = await fetch(`/api/get-file/${fileId}`);
 
             if (!response.ok) {
                 throw new Error(`加载文件失败: ${response.status}`);
@@ -1530,11 +1552,7 @@ class ChatApp {
     async previewHTML(fileId, fileName) {
         try {
             // 获取HTML文件内容
-            const response = await fetch(`/api/get-file/${fileId}`, {
-                headers: {
-                    'X-User': this.me
-                }
-            });
+            const response = await fetch(`/api/get-file/${fileId}`);
 
             if (!response.ok) {
                 throw new Error(`加载文件失败: ${response.status}`);
@@ -1734,11 +1752,7 @@ class ChatApp {
     async previewCode(fileId, fileName, fileType) {
         try {
             // 获取代码文件内容
-            const response = await fetch(`/api/get-file/${fileId}`, {
-                headers: {
-                    'X-User': this.me
-                }
-            });
+            const response = await fetch(`/api/get-file/${fileId}`);
 
             if (!response.ok) {
                 throw new Error(`加载文件失败: ${response.status}`);
@@ -1913,8 +1927,8 @@ class ChatApp {
         }
         // 检查是否是音乐消息
         else if (message.content.startsWith('Music_')) {
-            // 提取音乐信息
-            const musicInfo = JSON.parse(message.content.substring(6));
+            // 提取音乐信息，聊天记录接口附带了歌曲的最新信息时以其为准
+            const musicInfo = Object.assign(JSON.parse(message.content.substring(6)), message.music || {});
 
             // 音乐消息使用特殊样式
             messageElement.className = `message-bubble ${isOwnMessage ? 'me' : 'peer'}`;
@@ -2041,11 +2055,7 @@ class ChatApp {
 
     async loadChatHistory() {
         try {
-            const response = await fetch(`/api/chat-history?friend=${encodeURIComponent(this.peer)}`, {
-                headers: {
-                    'X-User': this.me
-                }
-            });
+            const response = await fetch(`/api/chat-history?friend=${encodeURIComponent(this.peer)}&include=music`);
 
             const result = await response.json();
             if (result.ok) {
@@ -2094,6 +2104,11 @@ class ChatApp {
                 });
 
                 this.lastMessageCount = result.history.length;
+                if (result.history.length > 0) {
+                    const lastMsg = result.history[result.history.length - 1];
+                    this.lastMessageId = lastMsg.id;
+                    this.lastMessageTime = new Date(lastMsg.timestamp);
+                }
 
                 // 等待所有图片加载完成后再滚动到底部
                 if (imagePromises.length > 0) {
@@ -2160,8 +2175,7 @@ class ChatApp {
             const response = await fetch('/api/mark-messages-as-read', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json',
-                    'X-User': this.me
+                    'Content-Type': 'application/json'
                 },
                 body: JSON.stringify({
                     friend: this.peer
@@ -2201,28 +2215,27 @@ class ChatApp {
         }
     }
 
-    // 新增：轮询获取新消息
+    // 新增：轮询获取新消息（增量同步，只拉取lastMessageId之后的消息）
     async checkForNewMessages() {
+        if (this.isCheckingMessages) {
+            return;
+        }
+        this.isCheckingMessages = true;
+
         try {
-            const response = await fetch(`/api/chat-history?friend=${encodeURIComponent(this.peer)}`, {
-                headers: {
-                    'X-User': this.me
-                }
-            });
+            const response = await fetch(`/api/chat-history?friend=${encodeURIComponent(this.peer)}&since_id=${this.lastMessageId}&include=music`);
+
+            // 会话没有变化时服务器返回304
+            if (response.status === 304) {
+                return;
+            }
 
             const result = await response.json();
             if (result.ok) {
-                // 检查是否有新消息
-                if (result.history.length > this.lastMessageCount) {
-                    // 有新消息，更新显示
-                    const newMessageCount = result.history.length - this.lastMessageCount;
-                    const container = document.getElementById('chat-messages');
-
-                    // 只处理新增的消息，而不是清空整个容器
-                    const startIndex = this.lastMessageCount;
-
-                    for (let i = startIndex; i < result.history.length; i++) {
-                        const msg = result.history[i];
+                // 过滤掉已经显示过的消息
+                const newMessages = result.history.filter(msg => msg.id > this.lastMessageId);
+                if (newMessages.length > 0) {
+                    newMessages.forEach(msg => {
                         const message = {
                             sender: msg.sender,
                             content: msg.content,
@@ -2232,13 +2245,9 @@ class ChatApp {
 
                         // 判断是否显示时间戳
                         let showTime = true;
-                        if (i > 0) {
-                            const previousMsg = result.history[i - 1];
-                            const previousTime = new Date(previousMsg.timestamp);
-                            const currentTime = new Date(msg.timestamp);
-
+                        if (this.lastMessageTime) {
                             // 计算时间差（毫秒）
-                            const timeDiff = Math.abs(currentTime - previousTime);
+                            const timeDiff = Math.abs(message.timestamp - this.lastMessageTime);
 
                             // 如果时间差小于5分钟（300,000毫秒），不显示时间戳
                             if (timeDiff < 300000) {
@@ -2253,19 +2262,24 @@ class ChatApp {
 
                         // 添加消息到UI
                         this.addMessageToUI(message, isOwnMessage);
-                    }
 
-                    this.lastMessageCount = result.history.length;
+                        this.lastMessageId = msg.id;
+                        this.lastMessageTime = message.timestamp;
+                    });
+
+                    this.lastMessageCount += newMessages.length;
 
                     // 如果不是自己发送的消息，则显示新消息提示
-                    const lastMessage = result.history[result.history.length - 1];
+                    const lastMessage = newMessages[newMessages.length - 1];
                     if (lastMessage.sender !== this.me) {
-                        this.showNewMessageIndicator(newMessageCount);
+                        this.showNewMessageIndicator(newMessages.length);
                     }
                 }
             }
         } catch (error) {
             console.error('检查新消息出错:', error);
+        } finally {
+            this.isCheckingMessages = false;
         }
     }
 
@@ -2336,8 +2350,7 @@ class ChatApp {
                 const response = await fetch('/api/remove-friend', {
                     method: 'POST',
                     headers: {
-                        'Content-Type': 'application/json',
-                        'X-User': this.me
+                        'Content-Type': 'application/json'
                     },
                     body: JSON.stringify({
                         friendName: this.peer
@@ -2366,8 +2379,7 @@ class ChatApp {
                 const response = await fetch('/api/clear-chat-history', {
                     method: 'POST',
                     headers: {
-                        'Content-Type': 'application/json',
-                        'X-User': this.me
+                        'Content-Type': 'application/json'
                     },
                     body: JSON.stringify({
                         friendName: this.peer
@@ -2380,6 +2392,8 @@ class ChatApp {
                     // 清空聊天界面
                     document.getElementById('chat-messages').innerHTML = '';
                     this.lastMessageCount = 0;
+                    this.lastMessageId = 0;
+                    this.lastMessageTime = null;
                 } else {
                     alert(result.msg || '清空聊天记录失败');
                 }
@@ -2406,7 +2420,7 @@ class ChatApp {
         // 停止轮询
         this.stopPolling();
         
-        // 标记消息为已读（使用sendBeacon发送，不等待响应）
+        // 标记消息为已读（keepalive请求，不等待响应）
         this.markMessagesAsReadOnDestroy();
         
         // 关闭图片查看器
@@ -2417,7 +2431,7 @@ class ChatApp {
         this.pauseMusic();
     }
 
-    // 在页面卸载时标记消息为已读（使用sendBeacon）
+    // 在页面卸载时标记消息为已读
     markMessagesAsReadOnDestroy() {
         // 检查用户是否已登录
         if (!this.me) {
@@ -2430,34 +2444,18 @@ class ChatApp {
         }
 
         try {
-            // 使用sendBeacon发送请求，不等待响应
-            // 由于sendBeacon不支持自定义请求头，我们需要将用户信息放在URL参数中
-            const data = JSON.stringify({
-                friend: this.peer,
-                user: this.me  // 在请求体中包含用户信息
+            // sendBeacon不能附带Authorization请求头，改用keepalive的fetch（由auth.js附带令牌），
+            // 页面关闭后请求仍会发送完成，不等待响应
+            fetch('/api/mark-messages-as-read', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ friend: this.peer }),
+                keepalive: true
+            }).catch(() => {
+                // 忽略错误
             });
-            
-            // 创建Blob对象
-            const blob = new Blob([data], { type: 'application/json' });
-            
-            // 使用sendBeacon发送请求
-            if (navigator.sendBeacon) {
-                navigator.sendBeacon('/api/mark-messages-as-read', blob);
-                console.log('已使用sendBeacon发送标记消息为已读请求');
-            } else {
-                // 如果不支持sendBeacon，尝试使用fetch但不等待响应
-                fetch('/api/mark-messages-as-read', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'X-User': this.me
-                    },
-                    body: data,
-                    keepalive: true
-                }).catch(() => {
-                    // 忽略错误
-                });
-            }
         } catch (error) {
             // 忽略错误
         }
@@ -2467,11 +2465,8 @@ class ChatApp {
     async loadImageData(imageId, loadingElement) {
         return new Promise((resolve) => {
             try {
-                fetch(`/api/get-image/${imageId}`, {
-                    headers: {
-                        'X-User': this.me
-                    }
-                }).then(response => {
+                // 聊天记录中只显示缩略图
+                fetch(`/api/get-image/${imageId}?size=thumb`).then(response => {
                     if (response.ok) {
                         return response.blob();
                     } else {
@@ -160,11 +160,15 @@ async function login() {
         if (data.ok) {
             // 保存用户信息到 sessionStorage
             sessionStorage.setItem('chat-user', username);
+            sessionStorage.setItem('chat-token', data.token);
             showFeedback('登录成功，正在跳转...', 'success');
             // 跳转到主页
             setTimeout(() => {
                 location.href = '/';
             }, 1000);
+        } else if (response.status === 503) {
+            // 登录请求过多，服务器暂时拒绝
+            showFeedback(data.msg || '服务器繁忙，请稍后重试', 'error');
         } else {
             showFeedback('用户名或密码错误', 'error');
         }
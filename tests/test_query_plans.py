@@ -0,0 +1,116 @@
+"""热点查询的查询计划：聊天记录、未读数、附件权限、群聊记录和短词搜索都通过索引查找 messages，不全表扫描
+
+在临时数据目录中导入应用、执行全部迁移并写入少量消息（单聊、图片消息、群聊），
+然后调用应用中执行这些查询的函数，记录它们实际执行的SQL（已代入参数），
+对每条语句执行 EXPLAIN QUERY PLAN：不能出现对任何表的 SCAN（全表或整个索引的扫描），
+读取 messages 的语句必须通过 SEARCH ... USING INDEX（或按主键）查找 messages。
+
+    python -m pytest tests
+"""
+import json
+import logging
+import os
+import pathlib
+import re
+import sqlite3
+import sys
+
+import pytest
+
+BACKEND_DIR = pathlib.Path(__file__).resolve().parent.parent / 'backend'
+
+# 查询计划中对表的扫描，以及对 messages（或查询中使用的别名 m）的索引查找
+_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)')
+_SEARCH = re.compile(r'^SEARCH (messages|m) USING (COVERING INDEX|INDEX|INTEGER PRIMARY KEY)\b')
+# 只检查读取或按条件修改数据的语句
+_CHECKED = re.compile(r'^\s*(SELECT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+_READS_MESSAGES = re.compile(r'\bmessages\b')
+
+
+@pytest.fixture(scope='module')
+def chat(tmp_path_factory):
+    """在临时数据目录中初始化的应用，以及写入的图片ID和群聊ID"""
+    data_dir = tmp_path_factory.mktemp('chat-plans')
+    with open(data_dir / 'users.json', 'w', encoding='utf-8') as f:
+        json.dump({user: user for user in ('alice', 'bob', 'carol')}, f)
+    os.environ.update(CHAT_DATA_DIR=str(data_dir), CHAT_UPLOAD_DIR=str(data_dir / 'uploads'),
+                      # 只有一个连接，所有查询都经过设置了跟踪回调的连接
+                      CHAT_DB_POOL_SIZE='1')
+    sys.path.insert(0, str(BACKEND_DIR))
+    logging.disable(logging.INFO)
+
+    import app
+    import db
+    import groups
+
+    app.init_db()
+    for i in range(20):
+        app.save_chat_message('alice', 'bob', 'alice', f'你好 {i}')
+        app.save_chat_message('bob', 'alice', 'bob', f'回复 {i}')
+        app.save_chat_message('alice', 'carol', 'carol', f'消息 {i}')
+    with db.transaction() as cursor:
+        image_id = app.register_upload(cursor, 'image', 'plans.png', None, 'plans.png', 0, 'alice')
+    app.save_chat_message('alice', 'bob', 'alice', f'Pic_{image_id}')
+    group = groups.create('alice', '群聊', ['bob'])
+    for i in range(20):
+        groups.send(group['id'], 'bob', 'text', f'群消息 {i}')
+    yield app, db, groups, image_id, group['id']
+    logging.disable(logging.NOTSET)
+
+
+def _mark_read(app, db):
+    with db.transaction() as cursor:
+        app.mark_conversation_read(cursor, 'alice', 'bob')
+
+
+def _search_short(app, db, **scope):
+    """只有短词的搜索不能使用全文索引，按用户参与的会话查找 messages"""
+    with db.connection() as conn:
+        return app.search.search_messages(conn, 'bob', '你好', **scope)
+
+
+CASES = {
+    '聊天记录（分页）': lambda app, db, groups, image_id, group_id: app.load_chat_history('alice', 'bob', limit=50),
+    '聊天记录（since_id 增量）': lambda app, db, groups, image_id, group_id: app.load_chat_history(
+        'alice', 'bob', since_id=10),
+    '会话版本（ETag）': lambda app, db, groups, image_id, group_id: app.get_conversation_version('alice', 'bob'),
+    '标记会话已读': lambda app, db, groups, image_id, group_id: _mark_read(app, db),
+    '未读计数': lambda app, db, groups, image_id, group_id: app.count_unread_messages('alice', ['bob', 'carol']),
+    '附件权限（参与者）': lambda app, db, groups, image_id, group_id: app.is_user_involved_in_attachment_chat(
+        'bob', 'image', image_id),
+    '附件权限（非参与者）': lambda app, db, groups, image_id, group_id: app.is_user_involved_in_attachment_chat(
+        'carol', 'image', image_id),
+    '群聊记录': lambda app, db, groups, image_id, group_id: groups.history(group_id),
+    '短词搜索（全部会话）': lambda app, db, groups, image_id, group_id: _search_short(app, db),
+    '短词搜索（指定好友）': lambda app, db, groups, image_id, group_id: _search_short(app, db, peer='alice'),
+    '短词搜索（指定群聊）': lambda app, db, groups, image_id, group_id: _search_short(
+        app, db, conversation_id=group_id),
+}
+
+
+@pytest.mark.parametrize('name', list(CASES))
+def test_hot_query_uses_index(chat, name):
+    app, db = chat[0], chat[1]
+    statements = []
+    with db.connection() as conn:
+        conn.set_trace_callback(statements.append)
+    try:
+        CASES[name](*chat)
+    finally:
+        with db.connection() as conn:
+            conn.set_trace_callback(None)
+
+    checked = [sql for sql in statements if _CHECKED.match(sql)]
+    # 没有记录到查询，说明函数没有经过跟踪的连接，检查本身无效
+    assert checked, f'{name}: 没有记录到查询'
+    plans = sqlite3.connect(str(app.DB_FILE))
+    try:
+        for sql in checked:
+            details = [row[3] for row in plans.execute('EXPLAIN QUERY PLAN ' + sql)]
+            statement = ' '.join(sql.split())
+            assert not [d for d in details if _SCAN.match(d)], f'{name}: 全表扫描\n{statement}\n{details}'
+            if _READS_MESSAGES.search(sql):
+                assert [d for d in details if _SEARCH.match(d)], \
+                    f'{name}: 没有通过索引查找 messages\n{statement}\n{details}'
+    finally:
+        plans.close()